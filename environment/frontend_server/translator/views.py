@@ -3,6 +3,7 @@ Author: Joon Sung Park (joonspk@stanford.edu)
 File: views.py
 """
 import os
+import sys
 import json
 
 import datetime
@@ -10,6 +11,9 @@ from django.shortcuts import render
 from django.http import HttpResponse, JsonResponse
 from global_methods import check_if_file_exists, find_filenames
 from django.conf import settings
+sys.path.append("../../reverie/backend_server")
+from movement_log import MovementLog, movement_log_folder, read_movement
+from sim_fork import replace_file
 
 if settings.USE_MQTT:
   from .mqtt_client import DjangoMQTTClient, MQTTConnectionError
@@ -28,6 +32,9 @@ if settings.USE_MQTT:
 
 # Store movement data temporarily
 movement_data = {}
+# The movement logs of the simulations we have served movements of, by
+# sim_code, so that each request only reads the index records appended since.
+movement_logs = {}
 
 def _handle_movement_update(data):
   """Handle movement updates from backend via MQTT."""
@@ -223,6 +230,29 @@ def replay_persona_state(request, sim_code, step, persona_name):
   with open(memory + "/associative_memory/nodes.json") as json_file:  
     associative = json.load(json_file)
 
+  # Memories saved in journal mode keep their newest nodes in a journal next
+  # to nodes.json, one JSON record per line in the same form. Only the nodes
+  # up to its last commit marker were saved; the rest belong to steps that
+  # have not been saved (see memory_journal.py).
+  journal = memory + "/associative_memory/journal.jsonl"
+  if os.path.exists(journal): 
+    pending = []
+    with open(journal) as journal_file: 
+      for line in journal_file: 
+        if not line.endswith("\n"): 
+          break
+        try: 
+          node_details = json.loads(line)
+        except ValueError: 
+          break
+        if "saved_step" not in node_details: 
+          pending += [node_details]
+          continue
+        for node_details in pending: 
+          if node_details["node_count"] == len(associative) + 1: 
+            associative[f"node_{node_details['node_count']}"] = node_details
+        pending = []
+
   a_mem_event = []
   a_mem_chat = []
   a_mem_thought = []
@@ -295,8 +325,9 @@ def send_environment(request):
         return JsonResponse({"status": "success"})
       else:
         env_file = f"{sim_folder}/environment/{step}.json"
-        with open(env_file, 'w') as f:
-          json.dump(environment, f, indent=2)
+        # The file may be hardlinked from the simulation this one was forked
+        # from, so it is replaced rather than rewritten.
+        replace_file(env_file, json.dumps(environment, indent=2))
         return JsonResponse({"status": "success"})
 
     except Exception as e:
@@ -310,8 +341,8 @@ def get_movements(request):
   <BACKEND to FRONTEND> 
   This sends the backend computation of the persona behavior to the frontend
   client.
-  It does this by reading the new movement information from 
-  "storage/movement/{step}.json" file.
+  It does this by reading the new movement information from the
+  simulation's movement log (or its "storage/movement/{step}.json" file).
 
   ARGS:
     request: Django request
@@ -343,10 +374,12 @@ def get_movements(request):
 
       else:
         # File-based communication if MQTT is disabled
-        movement_file = f"storage/{sim_code}/movement/{step}.json"
-        if os.path.exists(movement_file):
-          with open(movement_file, 'r') as f:
-            movement_data = json.load(f)
+        sim_folder = f"storage/{sim_code}"
+        if sim_code not in movement_logs:
+          movement_logs[sim_code] = MovementLog(movement_log_folder(sim_folder))
+        movements = read_movement(sim_folder, int(step), movement_logs[sim_code])
+        if movements is not None:
+          movement_data = movements
           return JsonResponse(movement_data)
         return JsonResponse({"<step>": step})
 
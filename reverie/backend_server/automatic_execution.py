@@ -15,9 +15,10 @@ from pathlib import Path
 from datetime import datetime
 from multiprocessing import Process
 from openai_cost_logger import OpenAICostLoggerViz
+from movement_log import movement_steps
 
 
-def parse_args() -> Tuple[str, str, int, str, str, str, str, bool]:
+def parse_args() -> Tuple[str, str, int, str, str, str, str, bool, Optional[int]]:
     """Parse bash arguments
 
     Returns:
@@ -30,6 +31,7 @@ def parse_args() -> Tuple[str, str, int, str, str, str, str, bool]:
             - port number
             - history file path
             - use MQTT
+            - number of personas stepped concurrently
     """
     parser = argparse.ArgumentParser(description='Reverie Server')
     parser.add_argument(
@@ -80,6 +82,12 @@ def parse_args() -> Tuple[str, str, int, str, str, str, str, bool]:
         action='store_true',
         help='Enable MQTT mode for communication'
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        required=False,
+        help='Number of personas stepped concurrently (default from utils.py)'
+    )
     args = parser.parse_args()
 
     origin = args.origin
@@ -90,8 +98,9 @@ def parse_args() -> Tuple[str, str, int, str, str, str, str, bool]:
     port = args.port
     history_file = args.load_history
     use_mqtt = args.mqtt
+    workers = args.workers
     
-    return origin, target, steps, ui, browser_path, port, history_file, use_mqtt
+    return origin, target, steps, ui, browser_path, port, history_file, use_mqtt, workers
 
 
 def get_starting_step(exp_name: str) -> int:
@@ -102,10 +111,8 @@ def get_starting_step(exp_name: str) -> int:
     """
     current_step = 0
     experiments_directory = "../../environment/frontend_server/storage"
-    full_path = Path(experiments_directory, exp_name, "movement")  
-    if full_path.exists():
-        files = os.listdir(full_path)
-        steps = [int(os.path.splitext(filename)[0]) for filename in files]
+    steps = movement_steps(str(Path(experiments_directory, exp_name)))
+    if steps:
         current_step = max(steps)
     return current_step
 
@@ -202,7 +209,7 @@ if __name__ == '__main__':
     curr_stepbacks = 0
     log_path = "cost-logs" # where the simulations' prints are stored
     idx = 0
-    origin, target, tot_steps, ui, browser_path, port, history_file, use_mqtt = parse_args()
+    origin, target, tot_steps, ui, browser_path, port, history_file, use_mqtt, workers = parse_args()
     current_step = get_starting_step(origin)
     exp_name = target
     start_time = datetime.now()
@@ -222,7 +229,7 @@ if __name__ == '__main__':
             target = f"{exp_name}-s-{idx}-{current_step}-{curr_checkpoint}"
             print(f"(Auto-Exec): STAGE {idx}", flush=True)
             print(f"(Auto-Exec): Running experiment '{exp_name}' from step '{current_step}' to '{curr_checkpoint}'", flush=True)
-            rs = reverie.ReverieServer(origin, target, use_mqtt=use_mqtt)
+            rs = reverie.ReverieServer(origin, target, use_mqtt=use_mqtt, persona_workers=workers)
 
             # Load agent history if provided
             if history_file and current_step == 0:
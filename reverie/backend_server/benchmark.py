@@ -0,0 +1,414 @@
+"""
+File: benchmark.py
+Description: End-to-end benchmarks of the simulation engine.
+
+The benchmarks time the parts of the engine a simulation spends its time in:
+  maze          -- Maze construction from the maze cache, and compiling the
+                   maze from its CSV files;
+  path_finder   -- path_finder on the_ville, between tiles of randomly picked
+                   (but fixed) pairs of arenas;
+  retrieve      -- new_retrieve on synthetic memories of --memory-sizes nodes;
+  memory        -- AssociativeMemory save and load of those memories;
+  headless_step -- full headless steps of base_the_ville_n25 (the first step
+                   of a simulation makes every persona plan its day, so it is
+                   reported apart from the steps after it);
+  compress      -- compress_sim_storage.compress on skip-morning-s-14.
+"retrieve" and "headless_step" call the LLM, so they only run with the "stub"
+clients in openai_config.json (see stub_llm_server.py). The stub server is
+started for the run if it is not running already.
+
+Every run appends one JSON line to --out (by default logs/benchmarks.jsonl):
+  {"timestamp": "...", "commit": "...", "python": "...", "stub-server": {...},
+   "results": [{"name": "path_finder", "repeat": 5, "min": 0.01,
+                "median": 0.012, "mean": 0.013, "max": 0.02, ...}, ...]}
+The times are in seconds. The table printed at the end compares the medians
+with the latest earlier run in the file.
+
+Usage:
+  python benchmark.py [--only maze path_finder ...] [--repeat 5]
+                      [--memory-sizes 1000 10000 100000] [--steps 3]
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+
+from utils import collision_block_id, fs_storage, fs_temp_storage
+
+BENCHMARKS = ("maze", "path_finder", "retrieve", "memory", "headless_step",
+              "compress")
+
+# Benchmarks that call the LLM, and so only run against the stub server.
+LLM_BENCHMARKS = ("retrieve", "headless_step")
+
+DEFAULT_OUT = "../../logs/benchmarks.jsonl"
+
+
+def summarize(name, times, **extra):
+  """Returns the result record of benchmark <name> from its run <times>."""
+  result = {"name": name, "repeat": len(times),
+            "min": round(min(times), 6),
+            "median": round(statistics.median(times), 6),
+            "mean": round(statistics.mean(times), 6),
+            "max": round(max(times), 6)}
+  result.update(extra)
+  return result
+
+
+def time_repeated(fn, repeat):
+  """Returns the run times of <repeat> calls of <fn>."""
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times += [time.perf_counter() - start]
+  return times
+
+
+@contextlib.contextmanager
+def quiet():
+  """Silences the engine's prints within the block."""
+  with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    yield
+
+
+# ============================================================================
+# Benchmarks
+# ============================================================================
+
+def bench_maze(args):
+  from maze import Maze, compile_maze
+
+  results = []
+  with quiet():
+    Maze("the_ville")
+    times = time_repeated(lambda: Maze("the_ville"), args.repeat)
+  results += [summarize("maze.construct", times)]
+  with quiet():
+    times = time_repeated(compile_maze, args.repeat)
+  results += [summarize("maze.compile", times)]
+  return results
+
+
+def bench_path_finder(args):
+  from maze import Maze
+  from path_finder import path_finder
+
+  with quiet():
+    maze = Maze("the_ville")
+  # Personas mostly walk from an arena to another one.
+  arenas = sorted(address for address in maze.address_tiles
+                  if address.count(":") == 2)
+  rng = random.Random(0)
+  pairs = []
+  while len(pairs) < args.path_pairs:
+    start, end = rng.sample(arenas, 2)
+    pairs += [(rng.choice(sorted(maze.address_tiles[start])),
+               rng.choice(sorted(maze.address_tiles[end])))]
+
+  path_lengths = []
+  def find_paths():
+    path_lengths.clear()
+    for start, end in pairs:
+      path_lengths.append(len(path_finder(maze.collision_grid, start, end,
+                                          collision_block_id)))
+  times = time_repeated(find_paths, args.repeat)
+  return [summarize("path_finder", times, pairs=len(pairs),
+                    path_tiles=sum(path_lengths),
+                    unreachable=path_lengths.count(0))]
+
+
+def make_synthetic_persona(folder, n_nodes, seed=0):
+  """
+  Creates a persona in <folder> from Isabella Rodriguez of base_the_ville_n25
+  whose associative memory holds <n_nodes> synthetic events and thoughts.
+  Like in a simulation, many memories share their description (and so their
+  embedding).
+  """
+  from persona.persona import Persona
+  from persona.prompt_template.gpt_structure import openai_config
+  from stub_llm_server import (ACTIVITIES, DEFAULT_EMBEDDINGS_DIMENSIONS,
+                               pseudo_embedding)
+
+  name = "Isabella Rodriguez"
+  shutil.copytree(f"{fs_storage}/base_the_ville_n25/personas/{name}", folder)
+  with quiet():
+    persona = Persona(name, folder)
+
+  stub_config = openai_config.get("stub-server", {})
+  dimensions = stub_config.get("embeddings-dimensions",
+                               DEFAULT_EMBEDDINGS_DIMENSIONS)
+  rng = random.Random(seed)
+  subjects = ["Isabella Rodriguez", "Klaus Mueller", "Maria Lopez",
+              "Sam Moore", "the cafe", "the bed", "the piano", "the desk"]
+  descriptions = []
+  for _ in range(min(n_nodes, 5000)):
+    s = rng.choice(subjects)
+    o = rng.choice(ACTIVITIES)
+    descriptions += [(s, "is", o, f"{s} is {o}")]
+  embeddings = dict()
+
+  if not persona.scratch.curr_time:
+    persona.scratch.curr_time = datetime.datetime(2023, 2, 13)
+  # One memory every 10 seconds, up to the persona's current time.
+  created = persona.scratch.curr_time - datetime.timedelta(seconds=10 * n_nodes)
+  for count in range(n_nodes):
+    s, p, o, description = rng.choice(descriptions)
+    if description not in embeddings:
+      embeddings[description] = pseudo_embedding(
+        description, dimensions, seed).tolist()
+    created += datetime.timedelta(seconds=10)
+    add = persona.a_mem.add_thought if count % 5 == 0 else persona.a_mem.add_event
+    add(created, None, s, p, o, description, {s, o}, rng.randint(1, 10),
+        (description, embeddings[description]), [])
+  return persona
+
+
+def bench_retrieve(args):
+  from persona.cognitive_modules.retrieve import new_retrieve
+
+  results = []
+  focal_points = ["Isabella Rodriguez is planning a party at the cafe",
+                  "Klaus Mueller is writing a research paper",
+                  "the piano is being played"]
+  for n_nodes in args.memory_sizes:
+    with tempfile.TemporaryDirectory() as tmp:
+      persona = make_synthetic_persona(f"{tmp}/persona", n_nodes)
+      with quiet():
+        # The first call embeds the focal points.
+        new_retrieve(persona, focal_points)
+        times = time_repeated(lambda: new_retrieve(persona, focal_points),
+                              args.repeat)
+    results += [summarize(f"retrieve.{n_nodes}", times, nodes=n_nodes,
+                          focal_points=len(focal_points))]
+  return results
+
+
+def bench_memory(args):
+  from persona.memory_structures.associative_memory import AssociativeMemory
+
+  results = []
+  for n_nodes in args.memory_sizes:
+    with tempfile.TemporaryDirectory() as tmp:
+      persona = make_synthetic_persona(f"{tmp}/persona", n_nodes)
+      out = f"{tmp}/saved"
+      os.makedirs(out)
+      times = time_repeated(lambda: persona.a_mem.save(out), args.repeat)
+      results += [summarize(f"memory.save.{n_nodes}", times, nodes=n_nodes,
+                            bytes=sum(os.path.getsize(f"{out}/{f}")
+                                      for f in os.listdir(out)))]
+      times = time_repeated(lambda: AssociativeMemory(out), args.repeat)
+      results += [summarize(f"memory.load.{n_nodes}", times, nodes=n_nodes)]
+  return results
+
+
+def bench_headless_step(args):
+  import reverie
+
+  sim_code = f"benchmark-{uuid.uuid4().hex[:8]}"
+  sim_folder = f"{fs_storage}/{sim_code}"
+  # The server records the simulation it runs in the temp storage, which the
+  # frontend reads; the benchmark puts back what was there.
+  temp_files = dict()
+  for file_name in ("curr_sim_code.json", "curr_step.json"):
+    try:
+      with open(f"{fs_temp_storage}/{file_name}") as f:
+        temp_files[file_name] = f.read()
+    except FileNotFoundError:
+      temp_files[file_name] = None
+
+  try:
+    with quiet():
+      start = time.perf_counter()
+      rs = reverie.ReverieServer("base_the_ville_n25", sim_code)
+      fork_time = time.perf_counter() - start
+      times = time_repeated(lambda: rs.start_server(1, headless=True),
+                            args.steps)
+      rs.save()
+  finally:
+    shutil.rmtree(sim_folder, ignore_errors=True)
+    for file_name, content in temp_files.items():
+      if content is None:
+        with contextlib.suppress(FileNotFoundError):
+          os.remove(f"{fs_temp_storage}/{file_name}")
+      else:
+        with open(f"{fs_temp_storage}/{file_name}", "w") as f:
+          f.write(content)
+
+  results = [summarize("headless_step.fork", [fork_time]),
+             summarize("headless_step.first", times[:1],
+                       personas=len(rs.personas))]
+  if len(times) > 1:
+    results += [summarize("headless_step.next", times[1:],
+                          personas=len(rs.personas))]
+  return results
+
+
+def bench_compress(args):
+  sim_code = "skip-morning-s-14"
+  reverie_folder = os.path.abspath("..")
+  sys.path.append(reverie_folder)
+  import compress_sim_storage
+
+  compressed = f"{reverie_folder}/../environment/frontend_server/compressed_storage/{sim_code}"
+  backup = f"{compressed}.benchmark-backup"
+  if os.path.exists(compressed):
+    os.rename(compressed, backup)
+  cwd = os.getcwd()
+  # compress() works with paths relative to the reverie folder.
+  os.chdir(reverie_folder)
+  try:
+    def run():
+      shutil.rmtree(compressed, ignore_errors=True)
+      compress_sim_storage.compress(sim_code)
+    times = time_repeated(run, args.repeat)
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(compressed, ignore_errors=True)
+    if os.path.exists(backup):
+      os.rename(backup, compressed)
+  return [summarize("compress", times, sim_code=sim_code)]
+
+
+# ============================================================================
+# Running
+# ============================================================================
+
+def stub_stats(endpoint):
+  """Returns the counters of the stub server at <endpoint>, or None."""
+  try:
+    stats_url = endpoint.rsplit("/v1", 1)[0] + "/stats"
+    with urllib.request.urlopen(stats_url, timeout=1) as response:
+      return json.load(response)
+  except OSError:
+    return None
+
+
+@contextlib.contextmanager
+def stub_server(endpoint):
+  """Starts the stub server for the block, unless it is running already."""
+  if stub_stats(endpoint) is not None:
+    yield
+    return
+  process = subprocess.Popen([sys.executable, "stub_llm_server.py"],
+                             stdout=subprocess.DEVNULL)
+  try:
+    deadline = time.monotonic() + 10
+    while stub_stats(endpoint) is None:
+      if process.poll() is not None or time.monotonic() > deadline:
+        raise RuntimeError(f"The stub server did not start at {endpoint}")
+      time.sleep(0.1)
+    yield
+  finally:
+    process.terminate()
+    process.wait()
+
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                          capture_output=True, text=True,
+                          check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def previous_run(out):
+  """Returns the latest run recorded in the results file <out>, or None."""
+  try:
+    with open(out) as f:
+      lines = [line for line in f if line.strip()]
+  except FileNotFoundError:
+    return None
+  return json.loads(lines[-1]) if lines else None
+
+
+def format_results(results, previous):
+  previous_medians = dict()
+  if previous:
+    previous_medians = {result["name"]: result["median"]
+                        for result in previous["results"]}
+  lines = [f"{'benchmark':<28}{'median s':>12}{'min s':>12}{'vs last':>10}"]
+  for result in results:
+    change = ""
+    if previous_medians.get(result["name"]):
+      change = f"{result['median'] / previous_medians[result['name']] - 1:+.0%}"
+    lines += [f"{result['name']:<28}{result['median']:>12.4f}"
+              f"{result['min']:>12.4f}{change:>10}"]
+  return "\n".join(lines)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Simulation engine benchmarks")
+  parser.add_argument("--only", nargs="+", choices=BENCHMARKS,
+                      default=list(BENCHMARKS))
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--memory-sizes", type=int, nargs="+",
+                      default=[1000, 10000, 100000])
+  parser.add_argument("--path-pairs", type=int, default=50)
+  parser.add_argument("--steps", type=int, default=3,
+                      help="headless steps to run (the first one included)")
+  parser.add_argument("--out", default=DEFAULT_OUT)
+  args = parser.parse_args()
+
+  benchmarks = list(args.only)
+  stub_config = None
+  endpoint = None
+  if any(name in LLM_BENCHMARKS for name in benchmarks):
+    from persona.prompt_template.gpt_structure import openai_config
+    from stub_llm_server import stub_endpoint
+    if (openai_config["client"], openai_config["embeddings-client"]) != ("stub", "stub"):
+      print("Skipping", ", ".join(name for name in benchmarks
+                                  if name in LLM_BENCHMARKS),
+            "(set \"client\" and \"embeddings-client\" to \"stub\" in "
+            "openai_config.json to run them)")
+      benchmarks = [name for name in benchmarks if name not in LLM_BENCHMARKS]
+    else:
+      stub_config = openai_config.get("stub-server", {})
+      endpoint = openai_config.get("model-endpoint",
+                                   stub_endpoint(openai_config))
+
+  results = []
+  with stub_server(endpoint) if endpoint else contextlib.nullcontext():
+    stats_before = stub_stats(endpoint) if endpoint else None
+    for name in benchmarks:
+      print(f"Running {name}...", flush=True)
+      results += globals()[f"bench_{name}"](args)
+    stats_after = stub_stats(endpoint) if endpoint else None
+
+  run = {
+    "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+    "commit": git_commit(),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "stub-server": stub_config,
+    "results": results,
+  }
+  if stats_before and stats_after:
+    run["stub-requests"] = {
+      key: stats_after[key] - stats_before[key]
+      for key in stats_after if isinstance(stats_after[key], int)
+    }
+
+  previous = previous_run(args.out)
+  os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+  with open(args.out, "a") as outfile:
+    outfile.write(json.dumps(run) + "\n")
+  print(format_results(results, previous))
+  print(f"Results appended to {args.out}")
+
+
+if __name__ == "__main__":
+  main()
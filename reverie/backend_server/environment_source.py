@@ -0,0 +1,213 @@
+"""
+File: environment_source.py
+Description: Wait sources for the environment of the next simulation step.
+
+The backend server runs a step once the environment of that step (the
+personas' positions, as reported by the frontend) is available. It used to
+poll for environment/{step}.json every 100ms. A wait source instead blocks
+until the environment arrives and returns it right away:
+  "queue"   -- environments handed over in-process with put(), e.g. by the
+               MQTT handler or by the headless engine feeding itself.
+  "inotify" -- files written to the environment folder by the frontend,
+               watched with Linux inotify.
+  "poll"    -- the same files, checked every <interval> seconds.
+Every source also takes environments handed over with put() and reads the
+file of the requested step if it is already on disk (e.g., the first step
+after forking or resuming a simulation).
+"""
+
+import json
+import os
+import select
+import threading
+import time
+
+try:
+  import ctypes
+  import ctypes.util
+  _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                      use_errno=True)
+  _libc.inotify_init1
+  _libc.inotify_add_watch
+except (OSError, AttributeError):
+  _libc = None
+
+ENVIRONMENT_WAIT_MODES = ("auto", "queue", "inotify", "poll")
+
+# inotify event masks (see inotify(7)).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+
+class EnvironmentSource:
+  def __init__(self, env_folder):
+    """
+    In-process wait source: wait() returns as soon as put() hands over the
+    environment of the requested step.
+
+    ARGS:
+      env_folder: the simulation's environment folder.
+    """
+    self.env_folder = env_folder
+    self.cond = threading.Condition()
+    self.pending = dict()
+
+  def put(self, step, environment):
+    """Hands over the environment of <step> to the waiting server."""
+    with self.cond:
+      self.pending[step] = environment
+      self.cond.notify_all()
+
+  def read_file(self, step):
+    """
+    Returns the environment of <step> from its file, or None if the file is
+    not there yet or only partly written.
+    """
+    try:
+      with open(f"{self.env_folder}/{step}.json") as json_file:
+        return json.load(json_file)
+    except (FileNotFoundError, ValueError):
+      return None
+
+  def _wait_for_change(self, step, timeout):
+    """
+    Blocks until something may have changed for <step>, or for <timeout>
+    seconds. The pending environments are checked again under the condition
+    so that a put() right before the wait is not missed.
+    """
+    with self.cond:
+      if step not in self.pending:
+        self.cond.wait(timeout)
+
+  def wait(self, step, timeout=None):
+    """
+    Waits for the environment of <step>.
+
+    ARGS:
+      step: the step whose environment we need.
+      timeout: the number of seconds to wait at most; None waits forever.
+    RETURNS:
+      the environment dictionary, or None if <timeout> ran out.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+      with self.cond:
+        if step in self.pending:
+          return self.pending.pop(step)
+      environment = self.read_file(step)
+      if environment is not None:
+        return environment
+
+      remaining = None
+      if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          return None
+      self._wait_for_change(step, remaining)
+
+  def close(self):
+    pass
+
+
+class PollingSource(EnvironmentSource):
+  def __init__(self, env_folder, interval=0.1):
+    """Also checks for the file of the requested step every <interval>s."""
+    super().__init__(env_folder)
+    self.interval = interval
+
+  def _wait_for_change(self, step, timeout):
+    if timeout is None or timeout > self.interval:
+      timeout = self.interval
+    super()._wait_for_change(step, timeout)
+
+
+class InotifySource(EnvironmentSource):
+  def __init__(self, env_folder):
+    """Also wakes up whenever a file is written to <env_folder>."""
+    super().__init__(env_folder)
+    os.makedirs(env_folder, exist_ok=True)
+    self.inotify_fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.inotify_fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    watch = _libc.inotify_add_watch(self.inotify_fd,
+                                    os.fsencode(env_folder),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO)
+    if watch < 0:
+      errno = ctypes.get_errno()
+      os.close(self.inotify_fd)
+      raise OSError(errno, f"inotify_add_watch failed on {env_folder}")
+    # put() writes to this pipe to wake up a wait on the inotify descriptor.
+    self.wake_r, self.wake_w = os.pipe()
+    os.set_blocking(self.wake_r, False)
+    os.set_blocking(self.wake_w, False)
+
+  def put(self, step, environment):
+    super().put(step, environment)
+    try:
+      os.write(self.wake_w, b"\0")
+    except BlockingIOError:
+      # The pipe is full, so a wake-up is pending already.
+      pass
+
+  def _wait_for_change(self, step, timeout):
+    # A put() or a file written since the last check has already made one of
+    # the descriptors readable, so nothing is missed here either.
+    ready, _, _ = select.select([self.inotify_fd, self.wake_r], [], [],
+                                timeout)
+    # We only need to know that something happened, not what.
+    for fd in ready:
+      try:
+        while os.read(fd, 65536):
+          pass
+      except BlockingIOError:
+        pass
+
+  def close(self):
+    for fd in (self.inotify_fd, self.wake_r, self.wake_w):
+      try:
+        os.close(fd)
+      except OSError:
+        pass
+
+
+def make_environment_source(env_folder, mode="auto", in_process=False,
+                            poll_interval=0.1):
+  """
+  Returns the wait source for a simulation's environment folder.
+
+  ARGS:
+    env_folder: the simulation's environment folder.
+    mode: one of ENVIRONMENT_WAIT_MODES. "auto" picks "queue" when the
+          environments are handed over in-process, and otherwise "inotify"
+          where it is available and "poll" elsewhere. "queue" never reads
+          the files the frontend writes, so it requires <in_process>.
+    in_process: whether every environment is handed over with put() (MQTT
+                or headless mode), rather than written by the frontend.
+    poll_interval: the interval of the "poll" source, in seconds.
+  RETURNS:
+    an EnvironmentSource.
+  """
+  if mode not in ENVIRONMENT_WAIT_MODES:
+    raise ValueError(f"Invalid environment wait mode: {mode}")
+  if mode == "queue" and not in_process:
+    raise ValueError(
+      'The "queue" environment wait mode only works when the environments '
+      'are handed over in-process (MQTT or headless mode); use "auto", '
+      '"inotify" or "poll" with the frontend'
+    )
+  if mode == "auto":
+    if in_process:
+      mode = "queue"
+    elif _libc is not None:
+      mode = "inotify"
+    else:
+      mode = "poll"
+
+  if mode == "queue":
+    return EnvironmentSource(env_folder)
+  if mode == "inotify":
+    try:
+      return InotifySource(env_folder)
+    except (OSError, TypeError, AttributeError) as e:
+      print(f"inotify is not available ({e}); polling for environment files")
+  return PollingSource(env_folder, poll_interval)
@@ -6,12 +6,303 @@ Description: Defines the Maze class, which represents the map of the simulated
 world in a 2-dimensional matrix. 
 """
 
+import hashlib
 import json
 import math
+import os
+import tempfile
+from collections.abc import Sequence
 from typing import Union
 
+import numpy as np
+
 from global_methods import read_file_to_list
-from utils import env_matrix
+from path_finder import CollisionGrid
+from utils import collision_block_id, env_matrix, maze_cache
+
+# The name layers of the maze. Each one is compiled into a grid of ids into a
+# table of names, where id 0 is the empty name. 
+MAZE_LAYERS = ("sector", "arena", "game_object", "spawning_location")
+# Bump this whenever the layout of the compiled maze file changes. 
+COMPILED_MAZE_VERSION = 1
+
+
+def maze_source_files(): 
+  """
+  Returns the paths of all the files a maze is built from. 
+  """
+  blocks_folder = f"{env_matrix}/special_blocks"
+  maze_folder = f"{env_matrix}/maze"
+  return ([f"{env_matrix}/maze_meta_info.json"]
+          + [f"{blocks_folder}/{i}_blocks.csv" 
+             for i in ("world",) + MAZE_LAYERS]
+          + [f"{maze_folder}/{i}_maze.csv" 
+             for i in ("collision",) + MAZE_LAYERS])
+
+
+def compile_maze(block_remaps=None): 
+  """
+  Parses the CSV exports of the Tiled map into the layered arrays that make
+  up a compiled maze. 
+
+  INPUT
+    block_remaps: the block_remaps of the simulation's meta.json, if any.
+  OUTPUT
+    a dictionary of numpy arrays: 
+      "world": the world name. 
+      "collision": the raw collision matrix (as str), indexed by [y][x]. 
+      "<layer>", "<layer>_names": for each of MAZE_LAYERS, an int32 grid of
+        ids into the array of names. 
+      "addresses", "address_offsets", "address_tiles": the reverse index of
+        Maze.address_tiles. The (x, y) tiles of addresses[i] are 
+        address_tiles[address_offsets[i]:address_offsets[i+1]].
+  """
+  meta_info = json.load(open(f"{env_matrix}/maze_meta_info.json"))
+  maze_width = int(meta_info["maze_width"])
+  maze_height = int(meta_info["maze_height"])
+
+  # READING IN SPECIAL BLOCKS
+  # Special blocks are those that are colored in the Tiled map. 
+
+  # Here is an example row for the arena block file: 
+  # e.g., "25335, Double Studio, Studio, Common Room"
+  # And here is another example row for the game object block file: 
+  # e.g, "25331, Double Studio, Studio, Bedroom 2, Painting"
+
+  # Notice that the first element here is the color marker digit from the 
+  # Tiled export. Then we basically have the block path: 
+  # World, Sector, Arena, Game Object -- again, these paths need to be 
+  # unique within an instance of Reverie. 
+  blocks_folder = f"{env_matrix}/special_blocks"
+
+  _wb = blocks_folder + "/world_blocks.csv"
+  wb_rows = read_file_to_list(_wb, header=False)
+  wb = wb_rows[0][-1]
+
+  _sb = blocks_folder + "/sector_blocks.csv"
+  sb_rows = read_file_to_list(_sb, header=False)
+  # Apply any applicable sector remaps
+  if block_remaps is not None:
+    new_sb_rows = []
+    for row in sb_rows:
+      new_row = row.copy()
+      if row[2] in block_remaps["sector"]:
+        new_row[2] = block_remaps["sector"][row[2]]
+      new_sb_rows.append(new_row)
+    sb_rows = new_sb_rows
+  sb_dict = dict()
+  for i in sb_rows: sb_dict[i[0]] = i[-1]
+
+  _ab = blocks_folder + "/arena_blocks.csv"
+  ab_rows = read_file_to_list(_ab, header=False)
+  # Apply any applicable arena remaps
+  if block_remaps is not None:
+    new_ab_rows = []
+    for row in ab_rows:
+      new_row = row.copy()
+      if row[2] in block_remaps["sector"]:
+        new_row[2] = block_remaps["sector"][row[2]]
+      if row[3] in block_remaps["arena"]:
+        new_row[3] = block_remaps["arena"][row[3]]
+      new_ab_rows.append(new_row)
+    ab_rows = new_ab_rows
+  ab_dict = dict()
+  for i in ab_rows: ab_dict[i[0]] = i[-1]
+
+  _gob = blocks_folder + "/game_object_blocks.csv"
+  gob_rows = read_file_to_list(_gob, header=False)
+  # Apply any applicable game object remaps
+  if block_remaps is not None:
+    new_gob_rows = []
+    for row in gob_rows:
+      new_row = row.copy()
+      if row[3] in block_remaps["game_object"]:
+        new_row[3] = block_remaps["game_object"][row[3]]
+      new_gob_rows.append(new_row)
+    gob_rows = new_gob_rows
+  gob_dict = dict()
+  for i in gob_rows: gob_dict[i[0]] = i[-1]
+
+  _slb = blocks_folder + "/spawning_location_blocks.csv"
+  slb_rows = read_file_to_list(_slb, header=False)
+  slb_dict = dict()
+  for i in slb_rows: slb_dict[i[0]] = i[-1]
+
+  # [SECTION 3] Reading in the matrices 
+  # This is your typical two dimensional matrices. It's made up of 0s and 
+  # the number that represents the color block from the blocks folder. 
+  maze_folder = f"{env_matrix}/maze"
+
+  _cm = maze_folder + "/collision_maze.csv"
+  collision_maze_raw = read_file_to_list(_cm, header=False)[0]
+  _sm = maze_folder + "/sector_maze.csv"
+  sector_maze_raw = read_file_to_list(_sm, header=False)[0]
+  _am = maze_folder + "/arena_maze.csv"
+  arena_maze_raw = read_file_to_list(_am, header=False)[0]
+  _gom = maze_folder + "/game_object_maze.csv"
+  game_object_maze_raw = read_file_to_list(_gom, header=False)[0]
+  _slm = maze_folder + "/spawning_location_maze.csv"
+  spawning_location_maze_raw = read_file_to_list(_slm, header=False)[0]
+
+  # Loading the maze. The mazes are taken directly from the json exports of
+  # Tiled maps. They should be in csv format. 
+  # Importantly, they are "not" in a 2-d matrix format -- they are single 
+  # row matrices with the length of width x height of the maze. So we need
+  # to convert here. 
+  # We can do this all at once since the dimension of all these matrices are
+  # identical (e.g., 70 x 40).
+  # example format: [['0', '0', ... '25309', '0',...], ['0',...]...]
+  # 25309 is the collision bar number right now.
+  collision_maze = []
+  sector_maze = []
+  arena_maze = []
+  game_object_maze = []
+  spawning_location_maze = []
+  for i in range(0, len(collision_maze_raw), maze_width): 
+    tw = maze_width
+    collision_maze += [collision_maze_raw[i:i+tw]]
+    sector_maze += [sector_maze_raw[i:i+tw]]
+    arena_maze += [arena_maze_raw[i:i+tw]]
+    game_object_maze += [game_object_maze_raw[i:i+tw]]
+    spawning_location_maze += [spawning_location_maze_raw[i:i+tw]]
+
+  # Turning the color markers into names. Every layer gets a table of the
+  # names it uses, and a grid of ids into that table. 
+  layer_sources = {"sector": (sector_maze, sb_dict), 
+                   "arena": (arena_maze, ab_dict), 
+                   "game_object": (game_object_maze, gob_dict), 
+                   "spawning_location": (spawning_location_maze, slb_dict)}
+  layers = {"world": np.array(wb, dtype=str), 
+            "collision": np.array(collision_maze, dtype=str)}
+  tile_names = dict()
+  for layer, (layer_maze, block_dict) in layer_sources.items(): 
+    names = [""]
+    name_ids = {"": 0}
+    ids = np.zeros((maze_height, maze_width), dtype=np.int32)
+    for i in range(maze_height): 
+      for j in range(maze_width): 
+        name = block_dict.get(layer_maze[i][j], "")
+        if name not in name_ids: 
+          name_ids[name] = len(names)
+          names += [name]
+        ids[i][j] = name_ids[name]
+    layers[layer] = ids
+    layers[f"{layer}_names"] = np.array(names, dtype=str)
+    tile_names[layer] = [[names[k] for k in row] for row in ids.tolist()]
+
+  # Reverse tile access. 
+  # Given a string address, the set of all tile coordinates belonging to that
+  # address (see Maze.address_tiles). 
+  address_tiles = dict()
+  for i in range(maze_height):
+    for j in range(maze_width): 
+      sector = tile_names["sector"][i][j]
+      arena = tile_names["arena"][i][j]
+      game_object = tile_names["game_object"][i][j]
+      spawning_location = tile_names["spawning_location"][i][j]
+      addresses = []
+      if sector: 
+        addresses += [f'{wb}:{sector}']
+      if arena: 
+        addresses += [f'{wb}:{sector}:{arena}']
+      if game_object: 
+        addresses += [f'{wb}:{sector}:{arena}:{game_object}']
+      if spawning_location: 
+        addresses += [f'<spawn_loc>{spawning_location}']
+
+      for add in addresses: 
+        if add not in address_tiles: 
+          address_tiles[add] = []
+        address_tiles[add] += [(j, i)]
+
+  offsets = [0]
+  for tiles in address_tiles.values(): 
+    offsets += [offsets[-1] + len(tiles)]
+  layers["addresses"] = np.array(list(address_tiles.keys()), dtype=str)
+  layers["address_offsets"] = np.array(offsets, dtype=np.int64)
+  layers["address_tiles"] = np.array(
+    [tile for tiles in address_tiles.values() for tile in tiles], 
+    dtype=np.int32).reshape(-1, 2)
+  return layers
+
+
+def load_maze(maze_name, block_remaps=None): 
+  """
+  Returns the compiled layers of a maze (see compile_maze). They are read
+  from a .npz file in the maze cache, which is (re)compiled from the CSV 
+  files whenever it is missing or older than them. 
+
+  INPUT
+    maze_name: the name of the maze, e.g., "the_ville". 
+    block_remaps: the block_remaps of the simulation's meta.json, if any.
+  OUTPUT
+    a dictionary of numpy arrays. 
+  """
+  remaps = json.dumps(block_remaps, sort_keys=True)
+  # The fingerprint covers the content of every source file, so that any 
+  # change to the map invalidates the compiled file. 
+  fingerprint = hashlib.sha256(
+    f"{COMPILED_MAZE_VERSION}:{remaps}".encode("utf-8"))
+  for f_source in maze_source_files(): 
+    with open(f_source, "rb") as f: 
+      fingerprint.update(f.read())
+  fingerprint = fingerprint.hexdigest()
+
+  remaps_key = hashlib.sha256(remaps.encode("utf-8")).hexdigest()[:16]
+  f_compiled = f"{maze_cache}/{maze_name}-{remaps_key}.npz"
+  try: 
+    with np.load(f_compiled) as data: 
+      if str(data["fingerprint"]) == fingerprint: 
+        return {key: data[key] for key in data.files if key != "fingerprint"}
+  except (OSError, ValueError, KeyError): 
+    pass
+
+  layers = compile_maze(block_remaps)
+  try: 
+    os.makedirs(maze_cache, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=maze_cache, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f: 
+      np.savez(f, fingerprint=np.array(fingerprint), **layers)
+    os.replace(tmp_path, f_compiled)
+  except OSError as e: 
+    print (f"Could not write the compiled maze {f_compiled}: {e}")
+  return layers
+
+
+class TileRow(Sequence): 
+  """One row of a TileGrid."""
+  def __init__(self, maze, y): 
+    self.maze = maze
+    self.y = y
+
+  def __len__(self): 
+    return self.maze.maze_width
+
+  def __getitem__(self, x): 
+    x = range(self.maze.maze_width)[x]
+    if isinstance(x, range): 
+      return [self.maze.tile_details((j, self.y)) for j in x]
+    return self.maze.tile_details((x, self.y))
+
+
+class TileGrid(Sequence): 
+  """
+  Read-only view of a maze's tiles as the matrix of tile detail dictionaries
+  it used to be, accessed by [y][x] (see Maze.tile_details). The dictionaries
+  are built on access, so writing to them does not change the maze. 
+  """
+  def __init__(self, maze): 
+    self.maze = maze
+
+  def __len__(self): 
+    return self.maze.maze_height
+
+  def __getitem__(self, y): 
+    y = range(self.maze.maze_height)[y]
+    if isinstance(y, range): 
+      return [TileRow(self.maze, i) for i in y]
+    return TileRow(self.maze, y)
+
 
 class Maze:
   def __init__(self, maze_name, block_remaps: Union[dict, None] = None):
@@ -32,168 +323,97 @@ class Maze:
     # e.g., "planning to stay at home all day and never go out of her home"
     self.special_constraint = meta_info["special_constraint"]
 
-    # READING IN SPECIAL BLOCKS
-    # Special blocks are those that are colored in the Tiled map. 
-
-    # Here is an example row for the arena block file: 
-    # e.g., "25335, Double Studio, Studio, Common Room"
-    # And here is another example row for the game object block file: 
-    # e.g, "25331, Double Studio, Studio, Bedroom 2, Painting"
-
-    # Notice that the first element here is the color marker digit from the 
-    # Tiled export. Then we basically have the block path: 
-    # World, Sector, Arena, Game Object -- again, these paths need to be 
-    # unique within an instance of Reverie. 
-    blocks_folder = f"{env_matrix}/special_blocks"
-
-    _wb = blocks_folder + "/world_blocks.csv"
-    wb_rows = read_file_to_list(_wb, header=False)
-    wb = wb_rows[0][-1]
-
-    _sb = blocks_folder + "/sector_blocks.csv"
-    sb_rows = read_file_to_list(_sb, header=False)
-    # Apply any applicable sector remaps
-    if block_remaps is not None:
-      new_sb_rows = []
-      for row in sb_rows:
-        new_row = row.copy()
-        if row[2] in block_remaps["sector"]:
-          new_row[2] = block_remaps["sector"][row[2]]
-        new_sb_rows.append(new_row)
-      sb_rows = new_sb_rows
-    sb_dict = dict()
-    for i in sb_rows: sb_dict[i[0]] = i[-1]
-
-    _ab = blocks_folder + "/arena_blocks.csv"
-    ab_rows = read_file_to_list(_ab, header=False)
-    # Apply any applicable arena remaps
-    if block_remaps is not None:
-      new_ab_rows = []
-      for row in ab_rows:
-        new_row = row.copy()
-        if row[2] in block_remaps["sector"]:
-          new_row[2] = block_remaps["sector"][row[2]]
-        if row[3] in block_remaps["arena"]:
-          new_row[3] = block_remaps["arena"][row[3]]
-        new_ab_rows.append(new_row)
-      ab_rows = new_ab_rows
-    ab_dict = dict()
-    for i in ab_rows: ab_dict[i[0]] = i[-1]
-
-    _gob = blocks_folder + "/game_object_blocks.csv"
-    gob_rows = read_file_to_list(_gob, header=False)
-    # Apply any applicable game object remaps
-    if block_remaps is not None:
-      new_gob_rows = []
-      for row in gob_rows:
-        new_row = row.copy()
-        if row[3] in block_remaps["game_object"]:
-          new_row[3] = block_remaps["game_object"][row[3]]
-        new_gob_rows.append(new_row)
-      gob_rows = new_gob_rows
-    gob_dict = dict()
-    for i in gob_rows: gob_dict[i[0]] = i[-1]
-
-    _slb = blocks_folder + "/spawning_location_blocks.csv"
-    slb_rows = read_file_to_list(_slb, header=False)
-    slb_dict = dict()
-    for i in slb_rows: slb_dict[i[0]] = i[-1]
-
-    # [SECTION 3] Reading in the matrices 
-    # This is your typical two dimensional matrices. It's made up of 0s and 
-    # the number that represents the color block from the blocks folder. 
-    maze_folder = f"{env_matrix}/maze"
-
-    _cm = maze_folder + "/collision_maze.csv"
-    collision_maze_raw = read_file_to_list(_cm, header=False)[0]
-    _sm = maze_folder + "/sector_maze.csv"
-    sector_maze_raw = read_file_to_list(_sm, header=False)[0]
-    _am = maze_folder + "/arena_maze.csv"
-    arena_maze_raw = read_file_to_list(_am, header=False)[0]
-    _gom = maze_folder + "/game_object_maze.csv"
-    game_object_maze_raw = read_file_to_list(_gom, header=False)[0]
-    _slm = maze_folder + "/spawning_location_maze.csv"
-    spawning_location_maze_raw = read_file_to_list(_slm, header=False)[0]
-
-    # Loading the maze. The mazes are taken directly from the json exports of
-    # Tiled maps. They should be in csv format. 
-    # Importantly, they are "not" in a 2-d matrix format -- they are single 
-    # row matrices with the length of width x height of the maze. So we need
-    # to convert here. 
-    # We can do this all at once since the dimension of all these matrices are
-    # identical (e.g., 70 x 40).
-    # example format: [['0', '0', ... '25309', '0',...], ['0',...]...]
-    # 25309 is the collision bar number right now.
-    self.collision_maze = []
-    sector_maze = []
-    arena_maze = []
-    game_object_maze = []
-    spawning_location_maze = []
-    for i in range(0, len(collision_maze_raw), meta_info["maze_width"]): 
-      tw = meta_info["maze_width"]
-      self.collision_maze += [collision_maze_raw[i:i+tw]]
-      sector_maze += [sector_maze_raw[i:i+tw]]
-      arena_maze += [arena_maze_raw[i:i+tw]]
-      game_object_maze += [game_object_maze_raw[i:i+tw]]
-      spawning_location_maze += [spawning_location_maze_raw[i:i+tw]]
-
-    # Once we are done loading in the maze, we now set up self.tiles. This is
-    # a matrix accessed by row:col where each access point is a dictionary
-    # that contains all the things that are taking place in that tile. 
-    # More specifically, it contains information about its "world," "sector,"
-    # "arena," "game_object," "spawning_location," as well as whether it is a
-    # collision block, and a set of all events taking place in it. 
+    # READING IN THE MAZE
+    # The Tiled map exports (the special blocks and the maze matrices) are 
+    # compiled into layered arrays once, and then loaded from the maze cache.
+    # See compile_maze() for the details. 
+    layers = load_maze(maze_name, block_remaps)
+    # e.g., self.collision_maze[9][58] == "0"
+    self.collision_maze = layers["collision"].tolist()
+    # <collision_grid> is the boolean form of the collision maze that the path
+    # finder searches on. It is built once here rather than on every search.
+    self.collision_grid = CollisionGrid(layers["collision"], collision_block_id)
+
+    # Once we are done loading in the maze, we now set up the tiles. Each tile
+    # has a "world," "sector," "arena," "game_object," and
+    # "spawning_location," whether it is a collision block, and a set of all
+    # events taking place in it. 
+    # The names are kept as one grid of ids per layer, indexed by [y][x], 
+    # into a table of names (id 0 is the empty name). 
+    # e.g., self.layer_names["arena"][self.layer_ids["arena"][9][58]] 
+    #         == 'bedroom 2'
+    self.world = str(layers["world"])
+    self.layer_ids = {layer: layers[layer] for layer in MAZE_LAYERS}
+    self.layer_names = {layer: layers[f"{layer}_names"].tolist() 
+                        for layer in MAZE_LAYERS}
+    # Plain nested lists of the same ids, which are faster to index one tile
+    # at a time. 
+    self._layer_id_rows = {layer: layers[layer].tolist() 
+                           for layer in MAZE_LAYERS}
+    # <arena_path_ids> gives every tile the id of its arena path, the string 
+    # that get_tile_path(tile, "arena") returns, in the <arena_paths> table.
+    # e.g., self.arena_paths[self.arena_path_ids[9][58]] 
+    #         == 'double studio:double studio:bedroom 2'
+    arena_keys = (self.layer_ids["sector"].astype(np.int64) 
+                  * len(self.layer_names["arena"]) 
+                  + self.layer_ids["arena"])
+    unique_keys, arena_path_ids = np.unique(arena_keys, return_inverse=True)
+    self.arena_path_ids = arena_path_ids.reshape(arena_keys.shape)
+    self.arena_paths = []
+    for key in unique_keys.tolist(): 
+      sector, arena = divmod(key, len(self.layer_names["arena"]))
+      self.arena_paths += [f'{self.world}:{self.layer_names["sector"][sector]}'
+                           f':{self.layer_names["arena"][arena]}']
+    self._arena_path_id_rows = self.arena_path_ids.tolist()
+    # Likewise, <object_path_ids> gives every tile the id of its full 
+    # (world, sector, arena, game_object) path in the <object_paths> table. 
+    # e.g., self.object_paths[self.object_path_ids[9][58]] 
+    #         == ('double studio', 'double studio', 'bedroom 2', 'bed')
+    object_keys = (arena_keys * len(self.layer_names["game_object"]) 
+                   + self.layer_ids["game_object"])
+    unique_keys, object_path_ids = np.unique(object_keys, return_inverse=True)
+    self.object_path_ids = object_path_ids.reshape(object_keys.shape)
+    self.object_paths = []
+    for key in unique_keys.tolist(): 
+      key, game_object = divmod(key, len(self.layer_names["game_object"]))
+      sector, arena = divmod(key, len(self.layer_names["arena"]))
+      self.object_paths += [(self.world, 
+                             self.layer_names["sector"][sector], 
+                             self.layer_names["arena"][arena], 
+                             self.layer_names["game_object"][game_object])]
+
+    # <tile_events> holds the set of events of the tiles, keyed by their 
+    # (x, y) coordinate; tiles that never had an event are left out (see 
+    # get_tile_events()). 
+    # <arena_event_tiles> is the per-arena index of the same events: for 
+    # every arena path id, the set of (x, y) tiles of that arena that have 
+    # events. Both are kept up to date by the event methods below (e.g., 
+    # add_event_from_tile), which is how events should be changed. 
+    self.tile_events = dict()
+    self.arena_event_tiles = dict()
+    # Each game object occupies an event in the tile. We are setting up the 
+    # default event value here. 
+    for i, j in zip(*np.nonzero(self.layer_ids["game_object"])): 
+      tile = (int(j), int(i))
+      go_event = (self.get_tile_path(tile, "game object"), None, None, None)
+      self.add_event_from_tile(go_event, tile)
+
+    # <self.tiles> is the compatibility view of all of the above: a matrix 
+    # accessed by row:col where each access point is a dictionary with the 
+    # tile's details (see tile_details()). It is a read-only snapshot: the
+    # dictionaries are built on access and their "events" are a frozenset, so
+    # events are changed through the *_event_from_tile methods instead. 
     # e.g., self.tiles[32][59] = {'world': 'double studio', 
     #            'sector': '', 'arena': '', 'game_object': '', 
-    #            'spawning_location': '', 'collision': False, 'events': set()}
+    #            'spawning_location': '', 'collision': False, 
+    #            'events': frozenset()}
     # e.g., self.tiles[9][58] = {'world': 'double studio', 
     #         'sector': 'double studio', 'arena': 'bedroom 2', 
     #         'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
     #         'collision': False,
-    #         'events': {('double studio:double studio:bedroom 2:bed',
-    #                    None, None)}} 
-    self.tiles = []
-    for i in range(self.maze_height): 
-      row = []
-      for j in range(self.maze_width):
-        tile_details = dict()
-        tile_details["world"] = wb
-        
-        tile_details["sector"] = ""
-        if sector_maze[i][j] in sb_dict: 
-          tile_details["sector"] = sb_dict[sector_maze[i][j]]
-        
-        tile_details["arena"] = ""
-        if arena_maze[i][j] in ab_dict: 
-          tile_details["arena"] = ab_dict[arena_maze[i][j]]
-        
-        tile_details["game_object"] = ""
-        if game_object_maze[i][j] in gob_dict: 
-          tile_details["game_object"] = gob_dict[game_object_maze[i][j]]
-        
-        tile_details["spawning_location"] = ""
-        if spawning_location_maze[i][j] in slb_dict: 
-          tile_details["spawning_location"] = slb_dict[spawning_location_maze[i][j]]
-        
-        tile_details["collision"] = False
-        if self.collision_maze[i][j] != "0": 
-          tile_details["collision"] = True
-
-        tile_details["events"] = set()
-        
-        row += [tile_details]
-      self.tiles += [row]
-    # Each game object occupies an event in the tile. We are setting up the 
-    # default event value here. 
-    for i in range(self.maze_height):
-      for j in range(self.maze_width): 
-        if self.tiles[i][j]["game_object"]:
-          object_name = ":".join([self.tiles[i][j]["world"], 
-                                  self.tiles[i][j]["sector"], 
-                                  self.tiles[i][j]["arena"], 
-                                  self.tiles[i][j]["game_object"]])
-          go_event = (object_name, None, None, None)
-          self.tiles[i][j]["events"].add(go_event)
+    #         'events': frozenset({('double studio:double studio:bedroom 2:bed',
+    #                              None, None)})} 
+    self.tiles = TileGrid(self)
 
     # Reverse tile access. 
     # <self.address_tiles> -- given a string address, we return a set of all 
@@ -204,33 +424,94 @@ class Maze:
     # self.address_tiles['double studio:recreation:pool table'] 
     #   == {(29, 14), (31, 11), (30, 14), (32, 11), ...}, 
     self.address_tiles = dict()
-    for i in range(self.maze_height):
-      for j in range(self.maze_width): 
-        addresses = []
-        if self.tiles[i][j]["sector"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}'
-          addresses += [add]
-        if self.tiles[i][j]["arena"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}:'
-          add += f'{self.tiles[i][j]["arena"]}'
-          addresses += [add]
-        if self.tiles[i][j]["game_object"]: 
-          add = f'{self.tiles[i][j]["world"]}:'
-          add += f'{self.tiles[i][j]["sector"]}:'
-          add += f'{self.tiles[i][j]["arena"]}:'
-          add += f'{self.tiles[i][j]["game_object"]}'
-          addresses += [add]
-        if self.tiles[i][j]["spawning_location"]: 
-          add = f'<spawn_loc>{self.tiles[i][j]["spawning_location"]}'
-          addresses += [add]
-
-        for add in addresses: 
-          if add in self.address_tiles: 
-            self.address_tiles[add].add((j, i))
-          else: 
-            self.address_tiles[add] = set([(j, i)])
+    offsets = layers["address_offsets"].tolist()
+    address_tiles = list(zip(layers["address_tiles"][:, 0].tolist(), 
+                             layers["address_tiles"][:, 1].tolist()))
+    for count, add in enumerate(layers["addresses"].tolist()): 
+      self.address_tiles[add] = set(
+        address_tiles[offsets[count]:offsets[count+1]])
+
+    # Distance fields to the addresses above, computed the first time they are
+    # needed (see distance_field()). They are also kept on disk in a folder
+    # keyed by the maze name, the block remaps and the collision grid, so
+    # that all simulations forked from the same map share them. 
+    self.distance_fields = dict()
+    cache_key = hashlib.sha256(
+      json.dumps(block_remaps, sort_keys=True).encode("utf-8")
+      + self.collision_grid.blocked.tobytes()).hexdigest()[:16]
+    self.distance_field_folder = f"{maze_cache}/{maze_name}-{cache_key}"
+
+
+  def distance_field(self, address): 
+    """
+    Returns the distance field of a string address: the number of steps from
+    every tile to the nearest tile of the address (-1 where it cannot be
+    reached). It is computed once per address and cached in memory and on
+    disk.
+
+    INPUT
+      address: a key of self.address_tiles. 
+        e.g., "the Ville:Johnson Park:park:park garden"
+    OUTPUT
+      a numpy int32 array of shape (maze_height, maze_width), indexed by 
+      [y][x]. 
+    """
+    if address in self.distance_fields: 
+      return self.distance_fields[address]
+
+    tiles = sorted(self.address_tiles[address])
+    # The file name covers the tiles too, so a stale field is never read back
+    # if the map files change. 
+    field_key = hashlib.sha256(
+      json.dumps([address, tiles]).encode("utf-8")).hexdigest()[:32]
+    f_field = f"{self.distance_field_folder}/{field_key}.npy"
+
+    field = None
+    try: 
+      field = np.load(f_field)
+      if field.shape != (self.maze_height, self.maze_width): 
+        field = None
+    except (OSError, ValueError): 
+      pass
+
+    if field is None: 
+      field = self.collision_grid.distance_field([(y, x) for x, y in tiles])
+      # The field is only cached on disk if it can be written; otherwise it 
+      # is kept in memory alone. 
+      tmp_path = None
+      try: 
+        os.makedirs(self.distance_field_folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.distance_field_folder, 
+                                        suffix=".tmp")
+        with os.fdopen(fd, "wb") as f: 
+          np.save(f, field)
+        os.replace(tmp_path, f_field)
+      except OSError as e: 
+        print (f"Could not write the distance field {f_field}: {e}")
+        if tmp_path and os.path.exists(tmp_path): 
+          os.remove(tmp_path)
+
+    self.distance_fields[address] = field
+    return field
+
+
+  def path_to_address(self, tile, address): 
+    """
+    Shortest path from a tile to the nearest tile of a string address, read
+    off the address's distance field without searching. 
+
+    INPUT
+      tile: The tile coordinate to start from in (x, y) form.
+      address: a key of self.address_tiles. 
+    OUTPUT
+      the path as a list of (x, y) tiles, starting with <tile>, or an empty
+      list if no tile of the address can be reached. 
+    """
+    path = self.collision_grid.descend(self.distance_field(address), 
+                                       (tile[1], tile[0]))
+    if path is None: 
+      return []
+    return [(x, y) for y, x in path]
 
 
   def turn_coordinate_to_tile(self, px_coordinate): 
@@ -251,6 +532,46 @@ class Maze:
     return (x, y)
 
 
+  def tile_details(self, tile): 
+    """
+    Builds the tile details dictionary of the designated x, y location. 
+
+    INPUT
+      tile: The tile coordinate of our interest in (x, y) form.
+    OUTPUT
+      A new tile detail dictionary for the designated tile. Its "events" are a
+      frozenset snapshot of the tile's events; change them through the 
+      *_event_from_tile methods, which keep the arena event index current. 
+    """
+    x = tile[0]
+    y = tile[1]
+    ids = self._layer_id_rows
+    names = self.layer_names
+    return {"world": self.world, 
+            "sector": names["sector"][ids["sector"][y][x]], 
+            "arena": names["arena"][ids["arena"][y][x]], 
+            "game_object": names["game_object"][ids["game_object"][y][x]], 
+            "spawning_location": 
+              names["spawning_location"][ids["spawning_location"][y][x]], 
+            "collision": self.collision_maze[y][x] != "0", 
+            "events": frozenset(self.tile_events.get((x, y), ()))}
+
+
+  def get_tile_events(self, tile): 
+    """
+    Returns the set of events taking place in a tile. 
+
+    INPUT
+      tile: The tile coordinate of our interest in (x, y) form.
+    OUTPUT
+      The tile's own set of events (not a copy). 
+    """
+    tile = (tile[0], tile[1])
+    if tile not in self.tile_events: 
+      self.tile_events[tile] = set()
+    return self.tile_events[tile]
+
+
   def access_tile(self, tile): 
     """
     Returns the tiles details dictionary that is stored in self.tiles of the 
@@ -259,19 +580,18 @@ class Maze:
     INPUT
       tile: The tile coordinate of our interest in (x, y) form.
     OUTPUT
-      The tile detail dictionary for the designated tile. 
+      The tile detail dictionary for the designated tile. It is a read-only
+      snapshot (see tile_details). 
     EXAMPLE OUTPUT
       Given (58, 9), 
       self.tiles[9][58] = {'world': 'double studio', 
             'sector': 'double studio', 'arena': 'bedroom 2', 
             'game_object': 'bed', 'spawning_location': 'bedroom-2-a', 
             'collision': False,
-            'events': {('double studio:double studio:bedroom 2:bed',
-                       None, None)}} 
+            'events': frozenset({('double studio:double studio:bedroom 2:bed',
+                                  None, None)})} 
     """
-    x = tile[0]
-    y = tile[1]
-    return self.tiles[y][x]
+    return self.tile_details(tile)
 
 
   def get_tile_path(self, tile, level): 
@@ -290,27 +610,49 @@ class Maze:
     """
     x = tile[0]
     y = tile[1]
-    tile = self.tiles[y][x]
 
-    path = f"{tile['world']}"
+    path = f"{self.world}"
     if level == "world": 
       return path
-    else: 
-      path += f":{tile['sector']}"
-    
+
     if level == "sector": 
-      return path
-    else: 
-      path += f":{tile['arena']}"
+      sector_id = self._layer_id_rows["sector"][y][x]
+      return f"{path}:{self.layer_names['sector'][sector_id]}"
 
+    path = self.arena_paths[self._arena_path_id_rows[y][x]]
     if level == "arena": 
       return path
-    else: 
-      path += f":{tile['game_object']}"
 
+    game_object_id = self._layer_id_rows["game_object"][y][x]
+    path += f":{self.layer_names['game_object'][game_object_id]}"
     return path
 
 
+  def get_nearby_bounds(self, tile, vision_r): 
+    """
+    Returns the (left, right, top, bottom) bounds of the square of tiles
+    within <vision_r> of a tile, as used by get_nearby_tiles. The right and 
+    bottom bounds are exclusive. 
+    """
+    left_end = 0
+    if tile[0] - vision_r > left_end: 
+      left_end = tile[0] - vision_r
+
+    right_end = self.maze_width - 1
+    if tile[0] + vision_r + 1 < right_end: 
+      right_end = tile[0] + vision_r + 1
+
+    bottom_end = self.maze_height - 1
+    if tile[1] + vision_r + 1 < bottom_end: 
+      bottom_end = tile[1] + vision_r + 1
+
+    top_end = 0
+    if tile[1] - vision_r > top_end: 
+      top_end = tile[1] - vision_r 
+
+    return left_end, right_end, top_end, bottom_end
+
+
   def get_nearby_tiles(self, tile, vision_r): 
     """
     Given the current tile and vision_r, return a list of tiles that are 
@@ -329,21 +671,8 @@ class Maze:
     OUTPUT: 
       nearby_tiles: a list of tiles that are within the radius. 
     """
-    left_end = 0
-    if tile[0] - vision_r > left_end: 
-      left_end = tile[0] - vision_r
-
-    right_end = self.maze_width - 1
-    if tile[0] + vision_r + 1 < right_end: 
-      right_end = tile[0] + vision_r + 1
-
-    bottom_end = self.maze_height - 1
-    if tile[1] + vision_r + 1 < bottom_end: 
-      bottom_end = tile[1] + vision_r + 1
-
-    top_end = 0
-    if tile[1] - vision_r > top_end: 
-      top_end = tile[1] - vision_r 
+    left_end, right_end, top_end, bottom_end = self.get_nearby_bounds(
+      tile, vision_r)
 
     nearby_tiles = []
     for i in range(left_end, right_end): 
@@ -352,6 +681,40 @@ class Maze:
     return nearby_tiles
 
 
+  def get_nearby_arena_event_tiles(self, tile, vision_r): 
+    """
+    Given the current tile and vision_r, return the tiles within the radius
+    (see get_nearby_tiles) that have events and are in the same arena as the
+    current tile. They are read off the per-arena event index, without 
+    looking at the other tiles. 
+
+    INPUT: 
+      tile: The tile coordinate of our interest in (x, y) form.
+      vision_r: The radius of the persona's vision. 
+    OUTPUT: 
+      a list of (x, y) tiles, in the same order as get_nearby_tiles. 
+    """
+    arena_path_id = self._arena_path_id_rows[tile[1]][tile[0]]
+    left_end, right_end, top_end, bottom_end = self.get_nearby_bounds(
+      tile, vision_r)
+    return sorted((x, y) 
+                  for x, y in self.arena_event_tiles.get(arena_path_id, ())
+                  if left_end <= x < right_end and top_end <= y < bottom_end)
+
+
+  def _update_event_index(self, tile): 
+    """Keeps <tile> in the per-arena event index iff it has events."""
+    x = tile[0]
+    y = tile[1]
+    arena_path_id = self._arena_path_id_rows[y][x]
+    if self.tile_events.get((x, y)): 
+      if arena_path_id not in self.arena_event_tiles: 
+        self.arena_event_tiles[arena_path_id] = set()
+      self.arena_event_tiles[arena_path_id].add((x, y))
+    elif arena_path_id in self.arena_event_tiles: 
+      self.arena_event_tiles[arena_path_id].discard((x, y))
+
+
   def add_event_from_tile(self, curr_event, tile): 
     """
     Add an event triple to a tile.  
@@ -364,7 +727,8 @@ class Maze:
     OUPUT: 
       None
     """
-    self.tiles[tile[1]][tile[0]]["events"].add(curr_event)
+    self.get_tile_events(tile).add(curr_event)
+    self._update_event_index(tile)
 
 
   def remove_event_from_tile(self, curr_event, tile):
@@ -379,19 +743,15 @@ class Maze:
     OUPUT: 
       None
     """
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event == curr_event:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
+    self.get_tile_events(tile).discard(curr_event)
+    self._update_event_index(tile)
 
 
   def turn_event_from_tile_idle(self, curr_event, tile):
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event == curr_event:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
-        new_event = (event[0], None, None, None)
-        self.tiles[tile[1]][tile[0]]["events"].add(new_event)
+    events = self.get_tile_events(tile)
+    if curr_event in events: 
+      events.remove(curr_event)
+      events.add((curr_event[0], None, None, None))
 
 
   def remove_subject_events_from_tile(self, subject, tile):
@@ -404,7 +764,7 @@ class Maze:
     OUPUT: 
       None
     """
-    curr_tile_ev_cp = self.tiles[tile[1]][tile[0]]["events"].copy()
-    for event in curr_tile_ev_cp: 
-      if event[0] == subject:  
-        self.tiles[tile[1]][tile[0]]["events"].remove(event)
+    events = self.get_tile_events(tile)
+    for event in [event for event in events if event[0] == subject]: 
+      events.remove(event)
+    self._update_event_index(tile)
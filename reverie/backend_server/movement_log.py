@@ -0,0 +1,423 @@
+"""
+File: movement_log.py
+Description: Append-only log of the personas' movements, one record per step.
+
+The server used to write the movements of every step to its own
+movement/{step}.json file. The movement log instead keeps them in
+<sim_folder>/movement_log/:
+  {n:06d}.jsonl -- segments holding one compact JSON line per step,
+                   {"step": <step>, "movements": <movements>}. A new segment
+                   is started once the current one grows past <segment_size>.
+  index.bin     -- fixed-size records (int64 step, uint32 segment, uint64
+                   offset, uint32 length) pointing at the line of each step.
+Both are append-only. The writer appends the line before its index record, so
+a reader never sees a record whose line has not been written yet. When a step
+is written again (e.g., after a step back), the last record wins.
+
+Simulations written before the log, or with movement_log = False in utils.py,
+still have movement/{step}.json files; read_movement(), read_movements() and
+movement_steps() read either layout, following the lineage of simulations
+that were forked by lineage (see sim_fork.py), and export_legacy() writes the
+movements back out as per-step files.
+
+Run "python movement_log.py export <sim_folder>" to export a simulation's log
+to its movement/ folder.
+"""
+
+import argparse
+import json
+import os
+import struct
+import time
+
+from sim_fork import read_lineage
+
+INDEX_RECORD = struct.Struct("<qIQI")
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+
+
+class MovementLog:
+  def __init__(self, folder, segment_size=DEFAULT_SEGMENT_SIZE):
+    """
+    ARGS:
+      folder: the log folder, <sim_folder>/movement_log.
+      segment_size: the size in bytes past which a new segment is started.
+    """
+    self.folder = folder
+    self.index_path = os.path.join(folder, "index.bin")
+    self.segment_size = segment_size
+
+    # <records> holds the index records in the order they were appended, and
+    # <entries> maps each step to its last record.
+    self.records = []
+    self.entries = dict()
+    self.index_offset = 0
+
+    self.index_file = None
+    self.segment_file = None
+    self.segment = 0
+
+  def _segment_path(self, segment):
+    return os.path.join(self.folder, f"{segment:06d}.jsonl")
+
+  def _sync_index(self):
+    """Reads the index records appended since the last sync."""
+    try:
+      size = os.path.getsize(self.index_path)
+    except OSError:
+      size = 0
+    size -= size % INDEX_RECORD.size
+    if size < self.index_offset:
+      # The log was truncated by a step back, so we read it again.
+      self.records = []
+      self.entries = dict()
+      self.index_offset = 0
+    if size == self.index_offset:
+      return
+    with open(self.index_path, "rb") as f:
+      f.seek(self.index_offset)
+      data = f.read(size - self.index_offset)
+    for record in INDEX_RECORD.iter_unpack(data):
+      self.records += [record]
+      self.entries[record[0]] = record
+    self.index_offset = size
+
+  def _read_records(self, records):
+    """Yields (step, movements) for each of the index <records>."""
+    files = dict()
+    try:
+      for step, segment, offset, length in records:
+        if segment not in files:
+          files[segment] = open(self._segment_path(segment), "rb")
+        f = files[segment]
+        f.seek(offset)
+        yield step, json.loads(f.read(length))["movements"]
+    finally:
+      for f in files.values():
+        f.close()
+
+  def steps(self):
+    """Returns the sorted steps that are in the log."""
+    self._sync_index()
+    return sorted(self.entries)
+
+  def last_step(self):
+    """Returns the last step in the log, or None if it is empty."""
+    self._sync_index()
+    return max(self.entries) if self.entries else None
+
+  def get(self, step):
+    """
+    Returns the movements of <step>, or None if the step is not in the log.
+    """
+    self._sync_index()
+    if step not in self.entries:
+      return None
+    for _, movements in self._read_records([self.entries[step]]):
+      return movements
+
+  def range(self, start=None, end=None):
+    """
+    Yields (step, movements) for the steps in the log from <start> up to, but
+    not including, <end>, in step order. None leaves that side open.
+    """
+    self._sync_index()
+    steps = sorted(step for step in self.entries
+                   if (start is None or step >= start)
+                   and (end is None or step < end))
+    yield from self._read_records([self.entries[step] for step in steps])
+
+  def tail(self, start=None, poll_interval=0.2, timeout=None):
+    """
+    Yields (step, movements) for the steps already in the log from <start> on
+    (or none if <start> is None), and then for every record appended to the
+    log as it arrives.
+
+    ARGS:
+      start: the first step to yield from the records already in the log.
+      poll_interval: how often to check for new records, in seconds.
+      timeout: stop after this many seconds without a new record; None
+               follows the log forever.
+    """
+    if start is not None:
+      yield from self.range(start)
+    else:
+      self._sync_index()
+    position = len(self.records)
+
+    last_record = time.monotonic()
+    while True:
+      self._sync_index()
+      if position > len(self.records):
+        position = len(self.records)
+      new = self.records[position:]
+      position = len(self.records)
+      if new:
+        yield from self._read_records(new)
+        last_record = time.monotonic()
+      elif timeout is not None and time.monotonic() - last_record >= timeout:
+        return
+      else:
+        time.sleep(poll_interval)
+
+  def _open_for_append(self):
+    """
+    Opens the last segment and the index for appending. Anything written
+    past the last complete index record (e.g., because the process died
+    between writing a line and its record) is cut off.
+    """
+    if self.index_file:
+      return
+    os.makedirs(self.folder, exist_ok=True)
+    self._sync_index()
+    self.index_file = open(self.index_path, "ab")
+    if self.index_file.tell() != self.index_offset:
+      self.index_file.truncate(self.index_offset)
+      self.index_file.seek(self.index_offset)
+
+    end = 0
+    self.segment = 0
+    if self.records:
+      _, self.segment, offset, length = self.records[-1]
+      end = offset + length
+    self.segment_file = open(self._segment_path(self.segment), "ab")
+    if self.segment_file.tell() != end:
+      self.segment_file.truncate(end)
+      self.segment_file.seek(end)
+
+  def append(self, step, movements):
+    """Appends the <movements> of <step> to the log."""
+    self._open_for_append()
+    line = (json.dumps({"step": step, "movements": movements},
+                       separators=(",", ":"))
+            + "\n").encode("utf-8")
+    offset = self.segment_file.tell()
+    if offset and offset + len(line) > self.segment_size:
+      self.segment_file.close()
+      self.segment += 1
+      self.segment_file = open(self._segment_path(self.segment), "ab")
+      offset = self.segment_file.tell()
+    self.segment_file.write(line)
+    self.segment_file.flush()
+
+    record = (step, self.segment, offset, len(line))
+    self.index_file.write(INDEX_RECORD.pack(*record))
+    self.index_file.flush()
+    self.records += [record]
+    self.entries[step] = record
+    self.index_offset += INDEX_RECORD.size
+
+  def truncate(self, step):
+    """
+    Drops <step> and everything appended after it from the end of the log.
+    Used when the server steps back after an error in <step>.
+    """
+    self._sync_index()
+    position = next((i for i, record in enumerate(self.records)
+                     if record[0] >= step), None)
+    if position is None:
+      return
+    self.close()
+    _, segment, offset, _ = self.records[position]
+    with open(self.index_path, "r+b") as f:
+      f.truncate(position * INDEX_RECORD.size)
+    segment_path = self._segment_path(segment)
+    if os.stat(segment_path).st_nlink > 1:
+      # The segment is hardlinked from the simulation we forked from, so we
+      # replace our link with a truncated copy instead.
+      with open(segment_path, "rb") as f:
+        data = f.read(offset)
+      with open(segment_path + ".tmp", "wb") as f:
+        f.write(data)
+      os.replace(segment_path + ".tmp", segment_path)
+    else:
+      with open(segment_path, "r+b") as f:
+        f.truncate(offset)
+    later = segment + 1
+    while os.path.exists(self._segment_path(later)):
+      os.remove(self._segment_path(later))
+      later += 1
+    self._sync_index()
+
+  def export_legacy(self, out_folder, start=None, end=None):
+    """
+    Writes the steps from <start> up to <end> as <out_folder>/{step}.json
+    files, in the layout of the movement/ folder.
+
+    RETURNS:
+      the number of files written.
+    """
+    return _write_legacy(out_folder, self.range(start, end))
+
+  def close(self):
+    for f in (self.segment_file, self.index_file):
+      if f:
+        f.close()
+    self.segment_file = None
+    self.index_file = None
+
+
+def movement_log_folder(sim_folder):
+  return os.path.join(sim_folder, "movement_log")
+
+
+def _write_legacy(out_folder, movements):
+  """
+  Writes (step, movements) pairs as <out_folder>/{step}.json files. Each file
+  is replaced rather than rewritten, since it may be hardlinked from the
+  simulation we forked from.
+  """
+  os.makedirs(out_folder, exist_ok=True)
+  count = 0
+  for step, step_movements in movements:
+    path = os.path.join(out_folder, f"{step}.json")
+    with open(path + ".tmp", "w") as outfile:
+      outfile.write(json.dumps(step_movements, indent=2))
+    os.replace(path + ".tmp", path)
+    count += 1
+  return count
+
+
+def _legacy_steps(sim_folder):
+  """Returns {step: path} for the movement/{step}.json files of a sim."""
+  movement_folder = os.path.join(sim_folder, "movement")
+  if not os.path.isdir(movement_folder):
+    return dict()
+  files = dict()
+  for file_name in os.listdir(movement_folder):
+    name, ext = os.path.splitext(file_name)
+    if ext == ".json" and name.isdigit():
+      files[int(name)] = os.path.join(movement_folder, file_name)
+  return files
+
+
+def _lineage_ranges(sim_folder):
+  """
+  Returns (folder, start, end) for a simulation and the simulations it was
+  forked from by lineage (see sim_fork.py), in step order: each folder holds
+  the movements of the steps from <start> up to <end> (None: no end).
+  """
+  ranges = []
+  end = None
+  for folder, first_step in read_lineage(sim_folder):
+    ranges += [(folder, first_step, end)]
+    end = first_step
+  return ranges[::-1]
+
+
+def _clip(start, end, range_start, range_end):
+  """Returns the intersection of [start, end) and [range_start, range_end)."""
+  if start is None or start < range_start:
+    start = range_start
+  if end is None or (range_end is not None and range_end < end):
+    end = range_end
+  return start, end
+
+
+def _own_movements(sim_folder, start, end):
+  """
+  Yields (step, movements) for the steps in a simulation folder itself, from
+  <start> up to <end>, in step order.
+  """
+  log = MovementLog(movement_log_folder(sim_folder))
+  log_steps = set(log.steps())
+  legacy = {step: path for step, path in _legacy_steps(sim_folder).items()
+            if step not in log_steps
+            and (start is None or step >= start)
+            and (end is None or step < end)}
+
+  log_movements = log.range(start, end)
+  next_log = next(log_movements, None)
+  for step in sorted(legacy):
+    while next_log and next_log[0] < step:
+      yield next_log
+      next_log = next(log_movements, None)
+    try:
+      with open(legacy[step]) as json_file:
+        movements = json.load(json_file)
+    except ValueError:
+      # Skip files that were only partly written.
+      continue
+    yield step, movements
+  while next_log:
+    yield next_log
+    next_log = next(log_movements, None)
+
+
+def movement_steps(sim_folder):
+  """
+  Returns the sorted steps whose movements a simulation has, from its log
+  and its movement/{step}.json files, and those of the simulations it was
+  forked from by lineage.
+  """
+  steps = []
+  for folder, start, end in _lineage_ranges(sim_folder):
+    folder_steps = set(_legacy_steps(folder))
+    folder_steps.update(MovementLog(movement_log_folder(folder)).steps())
+    steps += sorted(step for step in folder_steps
+                    if step >= start and (end is None or step < end))
+  return steps
+
+
+def read_movement(sim_folder, step, log=None):
+  """
+  Returns the movements of <step> in a simulation, or None if they have not
+  been written yet. <log> is the simulation's MovementLog, for callers that
+  keep one around between calls.
+  """
+  for folder, start, end in _lineage_ranges(sim_folder)[::-1]:
+    if step >= start and (end is None or step < end):
+      break
+  if folder != sim_folder or log is None:
+    log = MovementLog(movement_log_folder(folder))
+  movements = log.get(step)
+  if movements is not None:
+    return movements
+  path = os.path.join(folder, "movement", f"{step}.json")
+  try:
+    with open(path) as json_file:
+      return json.load(json_file)
+  except (FileNotFoundError, ValueError):
+    return None
+
+
+def read_movements(sim_folder, start=None, end=None):
+  """
+  Yields (step, movements) for the steps of a simulation from <start> up to,
+  but not including, <end>, in step order, following its lineage. Steps in
+  the log take precedence over movement/{step}.json files, and files that
+  cannot be parsed are skipped.
+  """
+  for folder, range_start, range_end in _lineage_ranges(sim_folder):
+    folder_start, folder_end = _clip(start, end, range_start, range_end)
+    if folder_end is None or folder_start < folder_end:
+      yield from _own_movements(folder, folder_start, folder_end)
+
+
+def export_legacy(sim_folder, out_folder=None, start=None, end=None):
+  """
+  Exports a simulation's movements, including those it inherits by lineage,
+  to per-step files in <out_folder> (default: <sim_folder>/movement).
+
+  RETURNS:
+    the number of files written.
+  """
+  out_folder = out_folder or os.path.join(sim_folder, "movement")
+  return _write_legacy(out_folder, read_movements(sim_folder, start, end))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Movement log tools")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  export_parser = subparsers.add_parser(
+    "export", help="Write the log out as per-step movement/{step}.json files"
+  )
+  export_parser.add_argument("sim_folder", type=str)
+  export_parser.add_argument("--out", type=str, default=None,
+                             help="Output folder (default: <sim_folder>/movement)")
+  export_parser.add_argument("--start", type=int, default=None)
+  export_parser.add_argument("--end", type=int, default=None)
+  args = parser.parse_args()
+
+  count = export_legacy(args.sim_folder, args.out, args.start, args.end)
+  print(f"Exported {count} steps")
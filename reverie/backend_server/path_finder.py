@@ -5,6 +5,9 @@ File: path_finder.py
 Description: Implements various path finding functions for generative agents.
 Some of the functions are defunct. 
 """
+import heapq
+from collections import deque
+
 import numpy as np
 
 def print_maze(maze):
@@ -93,75 +96,221 @@ def path_finder_v1(maze, start, end, collision_block_char, verbose=False):
   return path
 
 
-def path_finder_v2(a, start, end, collision_block_char, verbose=False):
-  def make_step(m, k):
-    for i in range(len(m)):
-      for j in range(len(m[i])):
-        if m[i][j] == k:
-          if i>0 and m[i-1][j] == 0 and a[i-1][j] == 0:
-            m[i-1][j] = k + 1
-          if j>0 and m[i][j-1] == 0 and a[i][j-1] == 0:
-            m[i][j-1] = k + 1
-          if i<len(m)-1 and m[i+1][j] == 0 and a[i+1][j] == 0:
-            m[i+1][j] = k + 1
-          if j<len(m[i])-1 and m[i][j+1] == 0 and a[i][j+1] == 0:
-             m[i][j+1] = k + 1
+class CollisionGrid:
+  def __init__(self, maze, collision_block_char):
+    """
+    Boolean collision grid of a maze, built once and shared by every search
+    on that maze.
+
+    INPUT:
+      maze: the collision matrix, as a list of rows (e.g., 
+            Maze.collision_maze) or a numpy array.
+      collision_block_char: the cell value that marks a collision block.
+    """
+    if isinstance(maze, np.ndarray):
+      self.blocked = maze == collision_block_char
+    else:
+      self.blocked = np.array(
+        [[cell == collision_block_char for cell in row] for row in maze],
+        dtype=bool)
+    self.height, self.width = self.blocked.shape
+    # The searches below walk the grid one cell at a time, where Python lists
+    # index much faster than numpy arrays.
+    self.flat_blocked = self.blocked.ravel().tolist()
+    # Column of every flat index, for the vectorized searches.
+    self.flat_col = np.arange(self.blocked.size) % self.width
+
+  def neighbors(self, node):
+    """Yields the walkable neighbors of a flat index (up, left, down, right)."""
+    width = self.width
+    blocked = self.flat_blocked
+    col = node % width
+    if node >= width and not blocked[node - width]:
+      yield node - width
+    if col > 0 and not blocked[node - 1]:
+      yield node - 1
+    if node + width < len(blocked) and not blocked[node + width]:
+      yield node + width
+    if col < width - 1 and not blocked[node + 1]:
+      yield node + 1
+
+  def to_path(self, parent, node):
+    """Follows <parent> back from <node>, returning a (row, col) path."""
+    width = self.width
+    path = []
+    while node != -1:
+      path += [divmod(node, width)]
+      node = parent[node]
+    path.reverse()
+    return path
+
+  def find_path(self, start, end):
+    """
+    A* search with a Manhattan heuristic between two tiles.
+
+    INPUT:
+      start: the (row, col) tile to start from.
+      end: the (row, col) tile to reach.
+    OUTPUT:
+      a shortest path as a list of (row, col) tiles, from <start> to <end>
+      both included, or None if <end> cannot be reached from <start>.
+    """
+    width = self.width
+    source = start[0] * width + start[1]
+    target = end[0] * width + end[1]
+    if source == target:
+      return [tuple(start)]
+    if self.flat_blocked[target]:
+      return None
+
+    end_row, end_col = end
+    cost = [-1] * len(self.flat_blocked)
+    parent = [-1] * len(self.flat_blocked)
+    cost[source] = 0
+    h = abs(start[0] - end_row) + abs(start[1] - end_col)
+    # Entries are (f, h, node): among equal f, expand the nodes closest to the
+    # target first.
+    frontier = [(h, h, source)]
+    while frontier:
+      f, h, node = heapq.heappop(frontier)
+      if f - h > cost[node]:
+        continue
+      if node == target:
+        return self.to_path(parent, node)
+      next_cost = cost[node] + 1
+      for neighbor in self.neighbors(node):
+        if cost[neighbor] == -1 or next_cost < cost[neighbor]:
+          cost[neighbor] = next_cost
+          parent[neighbor] = node
+          row, col = divmod(neighbor, width)
+          h = abs(row - end_row) + abs(col - end_col)
+          heapq.heappush(frontier, (next_cost + h, h, neighbor))
+    return None
+
+  def find_path_to_any(self, start, ends):
+    """
+    Breadth-first search from a tile to the nearest of a set of tiles. The
+    search stops at the first of <ends> it reaches, so it costs one search no
+    matter how many candidate tiles there are.
+
+    INPUT:
+      start: the (row, col) tile to start from.
+      ends: an iterable of (row, col) tiles, any of which will do.
+    OUTPUT:
+      a shortest path as a list of (row, col) tiles, from <start> to the
+      nearest tile of <ends>, or None if none of them can be reached.
+    """
+    width = self.width
+    targets = set(row * width + col for row, col in ends)
+    if not targets:
+      return None
+    source = start[0] * width + start[1]
+    # parent[node] is -2 for unvisited nodes and -1 for the source.
+    parent = [-2] * len(self.flat_blocked)
+    parent[source] = -1
+    queue = deque([source])
+    while queue:
+      node = queue.popleft()
+      if node in targets:
+        return self.to_path(parent, node)
+      for neighbor in self.neighbors(node):
+        if parent[neighbor] == -2:
+          parent[neighbor] = node
+          queue.append(neighbor)
+    return None
+
+  def distance_field(self, sources):
+    """
+    Breadth-first distances from a set of tiles to every tile of the grid.
+    The search expands a whole distance layer at a time with numpy.
+
+    INPUT:
+      sources: an iterable of (row, col) tiles.
+    OUTPUT:
+      an int32 array of the grid's shape holding the number of steps from
+      each tile to the nearest walkable tile of <sources>, and -1 for the
+      tiles that cannot reach any of them (including collision blocks).
+    """
+    width = self.width
+    size = self.blocked.size
+    blocked = self.blocked.ravel()
+    dist = np.full(size, -1, dtype=np.int32)
+    frontier = np.unique(
+      np.array([row * width + col for row, col in sources], dtype=np.int64))
+    frontier = frontier[~blocked[frontier]]
+    layer = 0
+    while frontier.size:
+      dist[frontier] = layer
+      layer += 1
+      cols = self.flat_col[frontier]
+      frontier = np.unique(np.concatenate([
+        frontier[frontier >= width] - width,
+        frontier[cols > 0] - 1,
+        frontier[frontier < size - width] + width,
+        frontier[cols < width - 1] + 1]))
+      frontier = frontier[(dist[frontier] == -1) & ~blocked[frontier]]
+    return dist.reshape(self.blocked.shape)
+
+  def descend(self, field, start):
+    """
+    Follows a distance field downhill from a tile to its nearest source.
+
+    INPUT:
+      field: a distance field from distance_field().
+      start: the (row, col) tile to start from.
+    OUTPUT:
+      a shortest path as a list of (row, col) tiles, from <start> to the
+      nearest source, or None if <start> cannot reach any source.
+    """
+    width = self.width
+    flat = field.ravel()
+    node = start[0] * width + start[1]
+    dist = int(flat[node])
+    if dist < 0:
+      return None
+    path = [divmod(node, width)]
+    while dist > 0:
+      for neighbor in self.neighbors(node):
+        if flat[neighbor] == dist - 1:
+          node = neighbor
+          break
+      dist -= 1
+      path += [divmod(node, width)]
+    return path
 
-  new_maze = []
-  for row in a: 
-    new_row = []
-    for j in row:
-      if j == collision_block_char: 
-        new_row += [1]
-      else: 
-        new_row += [0]
-    new_maze += [new_row]
-  a = new_maze
-
-  m = []
-  for i in range(len(a)):
-      m.append([])
-      for j in range(len(a[i])):
-          m[-1].append(0)
-  i,j = start
-  m[i][j] = 1 
-
-  k = 0
-  except_handle = 150
-  while m[end[0]][end[1]] == 0:
-      k += 1
-      make_step(m, k)
-
-      if except_handle == 0: 
-        break
-      except_handle -= 1 
-
-  i, j = end
-  k = m[i][j]
-  the_path = [(i,j)]
-  while k > 1:
-    if i > 0 and m[i - 1][j] == k-1:
-      i, j = i-1, j
-      the_path.append((i, j))
-      k-=1
-    elif j > 0 and m[i][j - 1] == k-1:
-      i, j = i, j-1
-      the_path.append((i, j))
-      k-=1
-    elif i < len(m) - 1 and m[i + 1][j] == k-1:
-      i, j = i+1, j
-      the_path.append((i, j))
-      k-=1
-    elif j < len(m[i]) - 1 and m[i][j + 1] == k-1:
-      i, j = i, j+1
-      the_path.append((i, j))
-      k -= 1
-        
-  the_path.reverse()
-  return the_path
+
+def path_finder_v2(a, start, end, collision_block_char, verbose=False):
+  """
+  Shortest path between two tiles in (row, col) form.
+
+  INPUT:
+    a: the collision matrix, or its CollisionGrid.
+    start: the (row, col) tile to start from.
+    end: the (row, col) tile to reach.
+    collision_block_char: the cell value that marks a collision block.
+  OUTPUT:
+    the path as a list of (row, col) tiles from <start> to <end>, or an empty
+    list if <end> cannot be reached.
+  """
+  grid = a
+  if not isinstance(grid, CollisionGrid):
+    grid = CollisionGrid(a, collision_block_char)
+  path = grid.find_path(start, end)
+  if path is None:
+    if verbose:
+      print (f"No path from {start} to {end}")
+    return []
+  return path
 
 
 def path_finder(maze, start, end, collision_block_char, verbose=False):
+  """
+  Same as path_finder_v2, but with tiles in (x, y) form.
+
+  OUTPUT:
+    the path as a list of (x, y) tiles from <start> to <end>, or an empty list
+    if <end> cannot be reached.
+  """
   # EMERGENCY PATCH
   start = (start[1], start[0])
   end = (end[1], end[0])
@@ -177,6 +326,30 @@ def path_finder(maze, start, end, collision_block_char, verbose=False):
   return path
 
 
+def path_finder_to_any(maze, start, ends, collision_block_char):
+  """
+  Shortest path from a tile to the nearest of several tiles, all in (x, y)
+  form.
+
+  INPUT:
+    maze: the collision matrix, or its CollisionGrid.
+    start: the (x, y) tile to start from.
+    ends: an iterable of candidate (x, y) tiles.
+    collision_block_char: the cell value that marks a collision block.
+  OUTPUT:
+    the path as a list of (x, y) tiles from <start> to the nearest reachable
+    tile of <ends>, or an empty list if none can be reached.
+  """
+  grid = maze
+  if not isinstance(grid, CollisionGrid):
+    grid = CollisionGrid(maze, collision_block_char)
+  path = grid.find_path_to_any((start[1], start[0]),
+                               [(end[1], end[0]) for end in ends])
+  if path is None:
+    return []
+  return [(col, row) for row, col in path]
+
+
 def closest_coordinate(curr_coordinate, target_coordinates): 
   min_dist = None
   closest_coordinate = None
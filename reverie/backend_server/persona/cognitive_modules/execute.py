@@ -8,7 +8,7 @@ import random
 
 import sys
 sys.path.append('../../')
-from path_finder import path_finder
+from path_finder import path_finder, path_finder_to_any
 from utils import collision_block_id
 
 def execute(persona, maze, personas, plan): 
@@ -40,6 +40,10 @@ def execute(persona, maze, personas, plan):
     # <target_tiles> is a list of tile coordinates where the persona may go 
     # to execute the current action. The goal is to pick one of them.
     target_tiles = None
+    # <target_address> is the string address the target tiles come from, if
+    # the action takes us to a fixed address. The maze keeps a distance field
+    # for these, which gives us the path to the closest tile without a search.
+    target_address = None
 
     print (plan)
 
@@ -47,25 +51,20 @@ def execute(persona, maze, personas, plan):
       # Executing persona-persona interaction.
       target_p_tile = (personas[plan.split("<persona>")[-1].strip()]
                        .scratch.curr_tile)
-      potential_path = path_finder(maze.collision_maze, 
+      potential_path = path_finder(maze.collision_grid, 
                                    persona.scratch.curr_tile, 
                                    target_p_tile, 
                                    collision_block_id)
-      if len(potential_path) <= 2: 
+      if not potential_path: 
+        # The other persona cannot be reached; we stay where we are. 
+        target_tiles = [persona.scratch.curr_tile]
+      elif len(potential_path) <= 2: 
         target_tiles = [potential_path[0]]
       else: 
-        potential_1 = path_finder(maze.collision_maze, 
-                                persona.scratch.curr_tile, 
-                                potential_path[int(len(potential_path)/2)], 
-                                collision_block_id)
-        potential_2 = path_finder(maze.collision_maze, 
-                                persona.scratch.curr_tile, 
-                                potential_path[int(len(potential_path)/2)+1], 
-                                collision_block_id)
-        if len(potential_1) <= len(potential_2): 
-          target_tiles = [potential_path[int(len(potential_path)/2)]]
-        else: 
-          target_tiles = [potential_path[int(len(potential_path)/2+1)]]
+        # We meet halfway. On a shortest path the tile at index k is exactly k
+        # steps away, so the midpoint is always the closer of the two middle
+        # tiles and no further search is needed. 
+        target_tiles = [potential_path[int(len(potential_path)/2)]]
     
     elif "<waiting>" in plan: 
       # Executing interaction where the persona has decided to wait before 
@@ -91,17 +90,15 @@ def execute(persona, maze, personas, plan):
       # string form. <maze.address_tiles> takes this and returns candidate 
       # coordinates. 
       if plan not in maze.address_tiles: 
-        target_tiles = maze.address_tiles["the Ville:Johnson Park:park:park garden"]
+        target_address = "the Ville:Johnson Park:park:park garden"
       else: 
-        target_tiles = maze.address_tiles[plan]
+        target_address = plan
+      target_tiles = maze.address_tiles[target_address]
 
     # There are sometimes more than one tile returned from this (e.g., a tabe
-    # may stretch many coordinates). So, we sample a few here. And from that 
-    # random sample, we will take the closest ones. 
-    if len(target_tiles) < 4: 
-      target_tiles = random.sample(list(target_tiles), len(target_tiles))
-    else:
-      target_tiles = random.sample(list(target_tiles), 4)
+    # may stretch many coordinates). We consider all of them, and the search
+    # below takes us to the closest one. 
+    target_tiles = list(target_tiles)
     # If possible, we want personas to occupy different tiles when they are 
     # headed to the same location on the maze. It is ok if they end up on the 
     # same time, but we try to lower that probability. 
@@ -120,32 +117,35 @@ def execute(persona, maze, personas, plan):
       new_target_tiles = target_tiles
     target_tiles = new_target_tiles
 
-    # Now that we've identified the target tile, we find the shortest path to
-    # one of the target tiles.
+    # Now that we've identified the target tiles, we find the shortest path to
+    # the closest one of them. For a fixed address, we first read the path off
+    # the address's distance field. If there is none, or the closest tile is 
+    # taken by another persona, path_finder_to_any searches outward from the 
+    # curr_tile once and stops at the first target tile it reaches. Both
+    # return a list of coordinate tuples that becomes the path, or an empty
+    # list if none of the target tiles can be reached.
+    # e.g., [(0, 1), (1, 1), (1, 2), (1, 3), (1, 4)...]
     curr_tile = persona.scratch.curr_tile
-    # collision_maze = maze.collision_maze
-    closest_target_tile = None
     path = None
-    for i in target_tiles:
-      # path_finder takes a collision_mze and the curr_tile coordinate as
-      # an input, and returns a list of coordinate tuples that becomes the
-      # path.
-      # e.g., [(0, 1), (1, 1), (1, 2), (1, 3), (1, 4)...]
-      curr_path = path_finder(
-        maze.collision_maze, curr_tile, i, collision_block_id
+    if target_address: 
+      path = maze.path_to_address(curr_tile, target_address)
+      if path and path[-1] not in set(target_tiles): 
+        path = None
+    if not path: 
+      path = path_finder_to_any(
+        maze.collision_grid, curr_tile, target_tiles, collision_block_id
       )
-      if not closest_target_tile or not path:
-        closest_target_tile = i
-        path = curr_path
-      elif len(curr_path) < len(path):
-        closest_target_tile = i
-        path = curr_path
 
     # Actually setting the <planned_path> and <act_path_set>. We cut the
     # first element in the planned_path because it includes the curr_tile.
+    # If none of the target tiles can be reached, we stay where we are
+    # instead of searching again on every step.
     if path:
       persona.scratch.planned_path = path[1:]
-      persona.scratch.act_path_set = True
+    else:
+      print (f"No path from {curr_tile} to any of {target_tiles}")
+      persona.scratch.planned_path = []
+    persona.scratch.act_path_set = True
 
   # Setting up the next immediate step. We stay at our curr_tile if there is
   # no <planned_path> left, but otherwise, we go to the next tile in the path.
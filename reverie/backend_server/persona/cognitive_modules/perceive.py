@@ -6,18 +6,84 @@ Description: This defines the "Perceive" module for generative agents.
 """
 
 import sys
-import math
+from collections import deque
+from functools import lru_cache
+
+import numpy as np
 
 sys.path.append("../../")
 
-from operator import itemgetter
-from persona.prompt_template.gpt_structure import get_embedding
+from persona.cognitive_modules.retrieve import top_highest_x_indices
+from persona.prompt_template.gpt_structure import get_embeddings
 from persona.prompt_template.run_gpt_prompt import (
   run_gpt_prompt_event_poignancy,
+  run_gpt_prompt_event_poignancy_batch,
   run_gpt_prompt_chat_poignancy,
 )
 
 
+def event_embedding_key(desc):
+  """
+  Returns the text that is embedded for an event description: the part in
+  parentheses if there is one, the full description otherwise.
+  """
+  if "(" in desc:
+    return desc.split("(")[1].split(")")[0].strip()
+  return desc
+
+
+@lru_cache(maxsize=None)
+def vision_kernel(vision_r):
+  """
+  Returns the distance from the center of the square of tiles within
+  <vision_r> to each of its tiles, as a list of rows indexed by
+  [dy + vision_r][dx + vision_r]. It is computed once per radius.
+  """
+  offsets = np.arange(-vision_r, vision_r + 1)
+  return np.sqrt(offsets[:, None] ** 2 + offsets[None, :] ** 2).tolist()
+
+
+def perceive_events(persona, maze):
+  """
+  Returns the <att_bandwidth> closest events taking place within the
+  persona's vision and in its current arena, closest first.
+
+  The event tiles come from the maze's per-arena event index, and their
+  distances from the vision kernel, so the cost only depends on the number
+  of events around the persona, not on the number of tiles it sees.
+
+  INPUT:
+    persona: An instance of <Persona> that represents the current persona.
+    maze: An instance of <Maze> that represents the current maze.
+  OUTPUT:
+    a list of event tuples.
+  """
+  curr_x, curr_y = persona.scratch.curr_tile
+  vision_r = persona.scratch.vision_r
+  kernel = vision_kernel(vision_r)
+
+  # We do not perceive the same event twice (this can happen if an object is
+  # extended across multiple tiles); it keeps the distance of the first tile
+  # it is seen in.
+  percept_events_set = set()
+  percept_events = []
+  percept_dists = []
+  for x, y in maze.get_nearby_arena_event_tiles((curr_x, curr_y), vision_r):
+    dist = kernel[y - curr_y + vision_r][x - curr_x + vision_r]
+    for event in maze.get_tile_events((x, y)):
+      if event not in percept_events_set:
+        percept_events += [event]
+        percept_dists += [dist]
+        percept_events_set.add(event)
+
+  # We perceive only persona.scratch.att_bandwidth of the closest events,
+  # with a partial sort. Events at the same distance keep the order above.
+  closest = top_highest_x_indices(-np.array(percept_dists, dtype=float),
+                                  persona.scratch.att_bandwidth,
+                                  np.arange(len(percept_dists)))
+  return [percept_events[i] for i in closest.tolist()]
+
+
 def generate_poig_score(persona, event_type, description):
   if "is idle" in description:
     return 1
@@ -44,6 +110,35 @@ def generate_poig_score(persona, event_type, description):
       return 0
 
 
+def generate_poig_scores(persona, descriptions):
+  """
+  Returns the poignancy of every event in <descriptions>, in order. The
+  events are rated in a single request; if its response does not validate,
+  they are rated one at a time with generate_poig_score.
+  """
+  scores = dict()
+  to_score = []
+  for description in dict.fromkeys(descriptions):
+    if "is idle" in description:
+      scores[description] = 1
+    else:
+      to_score += [description]
+
+  if len(to_score) > 1:
+    response = run_gpt_prompt_event_poignancy_batch(persona, to_score)
+    if response:
+      scores.update(zip(to_score, response[0]))
+    else:
+      print(
+        "ERROR: <generate_poig_scores>: Could not get the batched event "
+        "poignancy scores. Rating the events one at a time."
+      )
+  for description in to_score:
+    if description not in scores:
+      scores[description] = generate_poig_score(persona, "event", description)
+  return [scores[description] for description in descriptions]
+
+
 def perceive(persona, maze):
   """
   Perceives events around the persona and saves it to the memory, both events
@@ -63,74 +158,34 @@ def perceive(persona, maze):
     ret_events: a list of <ConceptNode> that are perceived and new.
   """
   # PERCEIVE SPACE
-  # We get the nearby tiles given our current tile and the persona's vision
-  # radius.
-  nearby_tiles = maze.get_nearby_tiles(
-    persona.scratch.curr_tile, persona.scratch.vision_r
+  # We store the space within the persona's vision radius. Note that the s_mem
+  # of the persona is in the form of a tree constructed using dictionaries,
+  # and that it only looks at the tiles whose places it has not seen yet.
+  persona.s_mem.perceive_area(
+    maze,
+    *maze.get_nearby_bounds(
+      persona.scratch.curr_tile, persona.scratch.vision_r
+    ),
   )
 
-  # We then store the perceived space. Note that the s_mem of the persona is
-  # in the form of a tree constructed using dictionaries.
-  for i in nearby_tiles:
-    i = maze.access_tile(i)
-    if i["world"]:
-      if i["world"] not in persona.s_mem.tree:
-        persona.s_mem.tree[i["world"]] = {}
-    if i["sector"]:
-      if i["sector"] not in persona.s_mem.tree[i["world"]]:
-        persona.s_mem.tree[i["world"]][i["sector"]] = {}
-    if i["arena"]:
-      if i["arena"] not in persona.s_mem.tree[i["world"]][i["sector"]]:
-        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] = []
-    if i["game_object"]:
-      if (
-        i["game_object"]
-        not in persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]]
-      ):
-        persona.s_mem.tree[i["world"]][i["sector"]][i["arena"]] += [
-          i["game_object"]
-        ]
-
   # PERCEIVE EVENTS.
   # We will perceive events that take place in the same arena as the
-  # persona's current arena.
-  curr_arena_path = maze.get_tile_path(persona.scratch.curr_tile, "arena")
-  # We do not perceive the same event twice (this can happen if an object is
-  # extended across multiple tiles).
-  percept_events_set = set()
-  # We will order our percept based on the distance, with the closest ones
-  # getting priorities.
-  percept_events_list = []
-  # First, we put all events that are occuring in the nearby tiles into the
-  # percept_events_list
-  for tile in nearby_tiles:
-    tile_details = maze.access_tile(tile)
-    if tile_details["events"]:
-      if maze.get_tile_path(tile, "arena") == curr_arena_path:
-        # This calculates the distance between the persona's current tile,
-        # and the target tile.
-        dist = math.dist(
-          [tile[0], tile[1]],
-          [persona.scratch.curr_tile[0], persona.scratch.curr_tile[1]],
-        )
-        # Add any relevant events to our temp set/list with the distant info.
-        for event in tile_details["events"]:
-          if event not in percept_events_set:
-            percept_events_list += [[dist, event]]
-            percept_events_set.add(event)
-
-  # We sort, and perceive only persona.scratch.att_bandwidth of the closest
-  # events. If the bandwidth is larger, then it means the persona can perceive
-  # more elements within a small area.
-  percept_events_list = sorted(percept_events_list, key=itemgetter(0))
-  perceived_events = []
-  for dist, event in percept_events_list[: persona.scratch.att_bandwidth]:
-    perceived_events += [event]
+  # persona's current arena. If the bandwidth is larger, then it means the
+  # persona can perceive more elements within a small area.
+  perceived_events = perceive_events(persona, maze)
 
   # Storing events.
-  # <ret_events> is a list of <ConceptNode> instances from the persona's
-  # associative memory.
-  ret_events = []
+  # We first work out which of the perceived events are new, so that the
+  # embeddings of all of them can be requested at once.
+  # We retrieve the latest persona.scratch.retention events. If there is
+  # something new that is happening (that is, p_event not in latest_events),
+  # then we add that event to the a_mem and return it. Every event we add
+  # becomes one of the latest events for the ones that follow.
+  latest_events = deque(
+    persona.a_mem.get_latest_events(persona.scratch.retention),
+    maxlen=persona.scratch.retention,
+  )
+  new_events = []
   for p_event in perceived_events:
     s, p, o, desc = p_event
     if not p:
@@ -141,83 +196,92 @@ def perceive(persona, maze):
     desc = f"{s.split(':')[-1]} is {desc}"
     p_event = (s, p, o)
 
-    # We retrieve the latest persona.scratch.retention events. If there is
-    # something new that is happening (that is, p_event not in latest_events),
-    # then we add that event to the a_mem and return it.
-    latest_events = persona.a_mem.get_summarized_latest_events(
-      persona.scratch.retention
-    )
     if p_event not in latest_events:
-      # We start by managing keywords.
-      keywords = set()
-      sub = p_event[0]
-      obj = p_event[2]
-      if ":" in p_event[0]:
-        sub = p_event[0].split(":")[-1]
-      if ":" in p_event[2]:
-        obj = p_event[2].split(":")[-1]
-      keywords.update([sub, obj])
-
-      # Get event embedding
-      desc_embedding_in = desc
-      if "(" in desc:
-        desc_embedding_in = (
-          desc_embedding_in.split("(")[1].split(")")[0].strip()
-        )
-      if desc_embedding_in in persona.a_mem.embeddings:
-        event_embedding = persona.a_mem.embeddings[desc_embedding_in]
+      latest_events.appendleft(p_event)
+      new_events += [(s, p, o, desc)]
+
+  # Get the embeddings of the new events (and of the persona's own chat, if
+  # it is among them) that are not in the memory yet, in one request.
+  to_embed = []
+  for s, p, o, desc in new_events:
+    to_embed += [event_embedding_key(desc)]
+    if p == "chat with" and s == f"{persona.name}":
+      to_embed += [persona.scratch.act_description]
+  to_embed = [i for i in to_embed if i not in persona.a_mem.embeddings]
+  new_embeddings = dict(zip(to_embed, get_embeddings(to_embed)))
+
+  # Rate the poignancy of all the new events in one request as well.
+  event_poignancies = generate_poig_scores(
+    persona, [event_embedding_key(desc) for s, p, o, desc in new_events]
+  )
+
+  # <ret_events> is a list of <ConceptNode> instances from the persona's
+  # associative memory.
+  ret_events = []
+  for (s, p, o, desc), event_poignancy in zip(new_events, event_poignancies):
+    # We start by managing keywords.
+    keywords = set()
+    sub = s
+    obj = o
+    if ":" in s:
+      sub = s.split(":")[-1]
+    if ":" in o:
+      obj = o.split(":")[-1]
+    keywords.update([sub, obj])
+
+    # Get event embedding
+    desc_embedding_in = event_embedding_key(desc)
+    if desc_embedding_in in persona.a_mem.embeddings:
+      event_embedding = persona.a_mem.embeddings[desc_embedding_in]
+    else:
+      event_embedding = new_embeddings[desc_embedding_in]
+    event_embedding_pair = (desc_embedding_in, event_embedding)
+
+    # If we observe the persona's self chat, we include that in the memory
+    # of the persona here.
+    chat_node_ids = []
+    if p == "chat with" and s == f"{persona.name}":
+      curr_event = persona.scratch.act_event
+      if persona.scratch.act_description in persona.a_mem.embeddings:
+        chat_embedding = persona.a_mem.embeddings[
+          persona.scratch.act_description
+        ]
       else:
-        event_embedding = get_embedding(desc_embedding_in)
-      event_embedding_pair = (desc_embedding_in, event_embedding)
-
-      # Get event poignancy.
-      event_poignancy = generate_poig_score(persona, "event", desc_embedding_in)
-
-      # If we observe the persona's self chat, we include that in the memory
-      # of the persona here.
-      chat_node_ids = []
-      if p_event[1] == "chat with" and p_event[0] == f"{persona.name}":
-        curr_event = persona.scratch.act_event
-        if persona.scratch.act_description in persona.a_mem.embeddings:
-          chat_embedding = persona.a_mem.embeddings[
-            persona.scratch.act_description
-          ]
-        else:
-          chat_embedding = get_embedding(persona.scratch.act_description)
-        chat_embedding_pair = (persona.scratch.act_description, chat_embedding)
-        chat_poignancy = generate_poig_score(
-          persona, "chat", persona.scratch.act_description
-        )
-        chat_node = persona.a_mem.add_chat(
-          persona.scratch.curr_time,
-          None,
-          curr_event[0],
-          curr_event[1],
-          curr_event[2],
-          persona.scratch.act_description,
-          keywords,
-          chat_poignancy,
-          chat_embedding_pair,
-          persona.scratch.chat,
-        )
-        chat_node_ids = [chat_node.node_id]
-
-      # Finally, we add the current event to the agent's memory.
-      ret_events += [
-        persona.a_mem.add_event(
-          persona.scratch.curr_time,
-          None,
-          s,
-          p,
-          o,
-          desc,
-          keywords,
-          event_poignancy,
-          event_embedding_pair,
-          chat_node_ids,
-        )
-      ]
-      persona.scratch.importance_trigger_curr -= event_poignancy
-      persona.scratch.importance_ele_n += 1
+        chat_embedding = new_embeddings[persona.scratch.act_description]
+      chat_embedding_pair = (persona.scratch.act_description, chat_embedding)
+      chat_poignancy = generate_poig_score(
+        persona, "chat", persona.scratch.act_description
+      )
+      chat_node = persona.a_mem.add_chat(
+        persona.scratch.curr_time,
+        None,
+        curr_event[0],
+        curr_event[1],
+        curr_event[2],
+        persona.scratch.act_description,
+        keywords,
+        chat_poignancy,
+        chat_embedding_pair,
+        persona.scratch.chat,
+      )
+      chat_node_ids = [chat_node.node_id]
+
+    # Finally, we add the current event to the agent's memory.
+    ret_events += [
+      persona.a_mem.add_event(
+        persona.scratch.curr_time,
+        None,
+        s,
+        p,
+        o,
+        desc,
+        keywords,
+        event_poignancy,
+        event_embedding_pair,
+        chat_node_ids,
+      )
+    ]
+    persona.scratch.importance_trigger_curr -= event_poignancy
+    persona.scratch.importance_ele_n += 1
 
   return ret_events
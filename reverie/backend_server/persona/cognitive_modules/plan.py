@@ -4,14 +4,18 @@ Author: Joon Sung Park (joonspk@stanford.edu)
 File: plan.py
 Description: This defines the "Plan" module for generative agents. 
 """
+import contextvars
 import datetime
 import math
 import random
+import threading
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import sys
 sys.path.append('../../')
-from utils import debug
+from utils import debug, action_fanout_workers
+from profiler import profiler
 from persona.prompt_template.run_gpt_prompt import (
     run_gpt_prompt_wake_up_hour,
     run_gpt_prompt_daily_plan,
@@ -34,6 +38,33 @@ from persona.prompt_template.gpt_structure import ChatGPT_single_request, get_em
 from persona.cognitive_modules.retrieve import new_retrieve
 from persona.cognitive_modules.converse import agent_chat_v2
 
+# The thread pool running the independent LLM calls of _determine_action,
+# shared by all personas. It is created on first use.
+_action_pool = None
+_action_pool_lock = threading.Lock()
+
+
+def _submit_action_call(fn, *args):
+  """
+  Starts fn(*args) on the action thread pool and returns its future. The call
+  runs within the profiler phases of the caller. With action_fanout_workers
+  below 2, it runs right away and the returned future is already done.
+  """
+  global _action_pool
+  if action_fanout_workers < 2:
+    future = Future()
+    try:
+      future.set_result(fn(*args))
+    except Exception as e:
+      future.set_exception(e)
+    return future
+
+  with _action_pool_lock:
+    if _action_pool is None:
+      _action_pool = ThreadPoolExecutor(max_workers=action_fanout_workers,
+                                        thread_name_prefix="action")
+  return _action_pool.submit(contextvars.copy_context().run, fn, *args)
+
 
 ##############################################################################
 # CHAPTER 2: Generate
@@ -603,6 +634,11 @@ def generate_prioritized_event_reaction(persona, priority):
       )
     print("-------End of DEBUG Priotize Events------")
 
+  # The tie-breaker draws from a generator of its own, seeded with the persona
+  # and the time, so that it does not depend on the order in which
+  # concurrently stepping personas draw from the shared one.
+  tie_breaker = random.Random(f"{persona.name}:{persona.scratch.curr_time}")
+
   # urgency sorting function
   def urgency_sort_key(event):
     node_id = event[
@@ -612,7 +648,7 @@ def generate_prioritized_event_reaction(persona, priority):
       urgency_scored_dict[node_id][
         "urgency_score"
       ],  # order by urgency score with a random tiebreaker
-      random.uniform(0, 1),  # Tie-breaker
+      tie_breaker.uniform(0, 1),  # Tie-breaker
     )
 
   # higher urgency scores listed first with a random tie breaker (if the urgency value and weighted importance_out are still equal)
@@ -797,6 +833,16 @@ def _determine_action(persona, maze):
 
   # Finding the target location of the action and creating action-related
   # variables.
+  # The LLM calls below form a small dependency graph, and the calls that do
+  # not depend on each other run at the same time:
+  #   sector -> arena -> game object -> object description -> object emoji
+  #                                                         -> object event
+  #   action emoji, action event (only need the action description)
+  act_pron_future = _submit_action_call(generate_action_pronunciatio,
+                                        act_desp, persona)
+  act_event_future = _submit_action_call(generate_action_event_triple,
+                                         act_desp, persona)
+
   act_world = maze.access_tile(persona.scratch.curr_tile)["world"]
   # act_sector = maze.access_tile(persona.scratch.curr_tile)["sector"]
   act_sector = generate_action_sector(act_desp, persona, maze)
@@ -805,15 +851,17 @@ def _determine_action(persona, maze):
   act_game_object = generate_action_game_object(act_desp, act_address,
                                                 persona, maze)
   new_address = f"{act_world}:{act_sector}:{act_arena}:{act_game_object}"
-  act_pron = generate_action_pronunciatio(act_desp, persona)
-  act_event = generate_action_event_triple(act_desp, persona)
   # Persona's actions also influence the object states. We set those up here.
   act_obj_desp_response = generate_act_obj_desc(act_game_object, act_desp, persona)
   act_obj_desp = act_obj_desp_response[0] if act_obj_desp_response else None
 
-  act_obj_pron = generate_action_pronunciatio(act_obj_desp, persona)
+  act_obj_pron_future = _submit_action_call(generate_action_pronunciatio,
+                                            act_obj_desp, persona)
   act_obj_event = generate_act_obj_event_triple(act_game_object, 
                                                 act_obj_desp, persona)
+  act_pron = act_pron_future.result()
+  act_event = act_event_future.result()
+  act_obj_pron = act_obj_pron_future.result()
 
   # Adding the action to persona's queue. 
   persona.scratch.add_new_action(new_address, 
@@ -1134,13 +1182,30 @@ def plan(persona, maze, personas, new_day, retrieved):
   OUTPUT 
     The target action address of the persona (persona.scratch.act_address).
   """ 
+  focused_event = plan_action(persona, maze, new_day, retrieved)
+  return plan_react(persona, maze, personas, focused_event)
+
+
+def plan_action(persona, maze, new_day, retrieved):
+  """
+  The first half of plan(): the long term planning, the next action, and the
+  choice of the event to react to. It only reads and writes <persona>'s own
+  state (and reads the maze), so personas can run it at the same time.
+
+  INPUT: 
+    See plan().
+  OUTPUT 
+    The focused event (see below), or False.
+  """
   # PART 1: Generate the hourly schedule. 
   if new_day:
-    _long_term_planning(persona, new_day)
+    with profiler.phase("plan.long_term"):
+      _long_term_planning(persona, new_day)
 
   # PART 2: If the current action has expired, we want to create a new plan.
   if persona.scratch.act_check_finished(): 
-    _determine_action(persona, maze)
+    with profiler.phase("plan.determine_action"):
+      _determine_action(persona, maze)
 
   # PART 3: If you perceived an event that needs to be responded to (saw 
   # another persona), and retrieved relevant information. 
@@ -1154,8 +1219,25 @@ def plan(persona, maze, personas, new_day, retrieved):
   focused_event = False
   if retrieved.keys():
      # Will later add more logic to consider multiple events
-    focused_event = _choose_retrieved(persona, retrieved)
-  
+    with profiler.phase("plan.react"):
+      focused_event = _choose_retrieved(persona, retrieved)
+  return focused_event
+
+
+def plan_react(persona, maze, personas, focused_event):
+  """
+  The second half of plan(): the reaction to <focused_event>. Reactions
+  (chatting, waiting) read and write the state of other personas, so
+  personas must run it one after another.
+
+  INPUT: 
+    maze: Current <Maze> instance of the world. 
+    personas: A dictionary that contains all persona names as keys, and the 
+              Persona instance as values. 
+    focused_event: The output of plan_action().
+  OUTPUT 
+    The target action address of the persona (persona.scratch.act_address).
+  """
   # Step 2: Once we choose an event, we need to determine whether the
   #         persona will take any actions for the perceived event. There are
   #         three possible modes of reaction returned by _should_react. 
@@ -1163,13 +1245,14 @@ def plan(persona, maze, personas, new_day, retrieved):
   #         b) "react"
   #         c) False
   if focused_event: 
-    reaction_mode = _should_react(persona, focused_event, personas)
-    if reaction_mode: 
-      # If we do want to chat, then we generate conversation 
-      if reaction_mode[:9] == "chat with":
-        _chat_react(maze, persona, focused_event, reaction_mode, personas)
-      elif reaction_mode[:4] == "wait": 
-        _wait_react(persona, reaction_mode)
+    with profiler.phase("plan.react"):
+      reaction_mode = _should_react(persona, focused_event, personas)
+      if reaction_mode: 
+        # If we do want to chat, then we generate conversation 
+        if reaction_mode[:9] == "chat with":
+          _chat_react(maze, persona, focused_event, reaction_mode, personas)
+        elif reaction_mode[:4] == "wait": 
+          _wait_react(persona, reaction_mode)
       # elif reaction_mode == "do other things": 
       #   _chat_react(persona, focused_event, reaction_mode, personas)
 
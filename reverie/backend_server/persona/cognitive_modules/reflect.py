@@ -22,7 +22,7 @@ from persona.prompt_template.run_gpt_prompt import (
     run_gpt_prompt_planning_thought_on_convo,
     run_gpt_prompt_memo_on_convo,
 )
-from persona.prompt_template.gpt_structure import get_embedding
+from persona.prompt_template.gpt_structure import get_embedding, get_embeddings
 from persona.cognitive_modules.retrieve import new_retrieve
 
 
@@ -141,13 +141,15 @@ def run_reflect(persona):
     for xxx in xx: print (xxx)
 
     thoughts = generate_insights_and_evidence(persona, nodes, 5)
-    for thought, evidence in thoughts.items(): 
+    thought_embeddings = get_embeddings(list(thoughts.keys()))
+    for (thought, evidence), thought_embedding in zip(thoughts.items(), 
+                                                      thought_embeddings): 
       created = persona.scratch.curr_time
       expiration = persona.scratch.curr_time + datetime.timedelta(days=30)
       s, p, o = generate_action_event_triple(thought, persona)
       keywords = set([s, p, o])
       thought_poignancy = generate_poig_score(persona, "thought", thought)
-      thought_embedding_pair = (thought, get_embedding(thought))
+      thought_embedding_pair = (thought, thought_embedding)
 
       persona.a_mem.add_thought(created, expiration, s, p, o, 
                                 thought, keywords, thought_poignancy, 
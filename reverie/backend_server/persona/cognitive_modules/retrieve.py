@@ -4,12 +4,13 @@ Author: Joon Sung Park (joonspk@stanford.edu)
 File: retrieve.py
 Description: This defines the "Retrieve" module for generative agents. 
 """
+import numpy as np
 from numpy import dot
 from numpy.linalg import norm
 
 import sys
 sys.path.append('../../')
-from persona.prompt_template.gpt_structure import get_embedding
+from persona.prompt_template.gpt_structure import get_embedding, get_embeddings
 
 def retrieve(persona, perceived):
   """
@@ -30,18 +31,34 @@ def retrieve(persona, perceived):
   # We retrieve events and thoughts separately.
   retrieved = dict()
 
+  # We first collect the relevant events and thoughts of every perceived
+  # event so that all the descriptions can be embedded in a single request.
+  candidates = []
   for event in perceived:
+    relevant_events = persona.a_mem.retrieve_relevant_events(
+      event.subject, event.predicate, event.object
+    )
+    relevant_thoughts = persona.a_mem.retrieve_relevant_thoughts(
+      event.subject, event.predicate, event.object
+    )
+    candidates += [(event, relevant_events, relevant_thoughts)]
+
+  descriptions = []
+  for event, relevant_events, relevant_thoughts in candidates:
+    descriptions += [event.description]
+    descriptions += [ev.description for ev in relevant_events]
+    descriptions += [thought.description for thought in relevant_thoughts]
+  embeddings = dict(zip(descriptions, get_embeddings(descriptions)))
+
+  for event, relevant_events, relevant_thoughts in candidates:
     retrieved[event.description] = dict()
     retrieved[event.description]["curr_event"] = event
-    current_embedding = get_embedding(event.description)
+    current_embedding = embeddings[event.description]
 
     # Events
-    relevant_events = persona.a_mem.retrieve_relevant_events(
-      event.subject, event.predicate, event.object
-    )
-    event_embeddings = {ev: get_embedding(ev.description) for ev in relevant_events}
     event_similarities = {
-      ev: cos_sim(emb, current_embedding) for ev, emb in event_embeddings.items()
+      ev: cos_sim(embeddings[ev.description], current_embedding)
+      for ev in relevant_events
     }
     sorted_events = dict(
       sorted(event_similarities.items(), key=lambda x: x[1], reverse=True)
@@ -49,15 +66,9 @@ def retrieve(persona, perceived):
     retrieved[event.description]["events"] = list(sorted_events.keys())[:5]
 
     # Thoughts
-    relevant_thoughts = persona.a_mem.retrieve_relevant_thoughts(
-      event.subject, event.predicate, event.object
-    )
-    thought_embeddings = {
-      thought: get_embedding(thought.description) for thought in relevant_thoughts
-    }
     thought_similarities = {
-      thought: cos_sim(emb, current_embedding)
-      for thought, emb in thought_embeddings.items()
+      thought: cos_sim(embeddings[thought.description], current_embedding)
+      for thought in relevant_thoughts
     }
     sorted_thoughts = dict(
       sorted(thought_similarities.items(), key=lambda x: x[1], reverse=True)
@@ -224,6 +235,58 @@ def extract_relevance(persona, nodes, focal_pt):
   return relevance_out
 
 
+def normalize_floats(values, target_min, target_max):
+  """
+  Array version of normalize_dict_floats: scales the values of a 1-D array to
+  the target range. If all the values are equal, they are all set to half of
+  the target range.
+
+  INPUT: 
+    values: 1-D numpy array of floats. 
+    target_min: Integer or float. The minimum value of the target range. 
+    target_max: Integer or float. The maximum value of the target range. 
+  OUTPUT: 
+    A new array with the normalized values. 
+  """
+  if len(values) == 0:
+    return values.astype(float)
+
+  min_val = values.min()
+  range_val = values.max() - min_val
+  if range_val == 0: 
+    return np.full(len(values), (target_max - target_min)/2)
+  return ((values - min_val) * (target_max - target_min) 
+          / range_val + target_min)
+
+
+def top_highest_x_indices(scores, x, tie_rank):
+  """
+  Array version of top_highest_x_values: returns the indices of the <x>
+  highest scores, highest first. Equal scores are ordered by <tie_rank>
+  (lowest first), which matches the stable sort of top_highest_x_values over
+  a dictionary in that order.
+
+  INPUT: 
+    scores: 1-D numpy array of floats. 
+    x: Integer. The number of indices to return. 
+    tie_rank: 1-D numpy array with the position of every score in the
+              original order. 
+  OUTPUT: 
+    A 1-D numpy array of indices into <scores>. 
+  """
+  if x <= 0:
+    return np.zeros(0, dtype=np.int64)
+  if x < len(scores):
+    # Every score that ties with the x-th highest one is a candidate, so
+    # that the tie breaking below can pick among them.
+    threshold = scores[np.argpartition(-scores, x - 1)[x - 1]]
+    candidates = np.flatnonzero(scores >= threshold)
+  else:
+    candidates = np.arange(len(scores))
+  order = np.lexsort((tie_rank[candidates], -scores[candidates]))
+  return candidates[order][:x]
+
+
 def new_retrieve(persona, focal_points, n_count=30):
   """
   Given the current persona and focal points (focal points are events or 
@@ -249,23 +312,45 @@ def new_retrieve(persona, focal_points, n_count=30):
   # <retrieved> is the main dictionary that we are returning
   retrieved = dict()
 
-  for focal_pt in focal_points:
-    # Getting all nodes from the agent's memory (both thoughts and events) and
-    # sorting them by the datetime of creation.
-    # You could also imagine getting the raw conversation, but for now. 
-    nodes = [[i.last_accessed, i]
-              for i in persona.a_mem.seq_event + persona.a_mem.seq_thought
-              if "idle" not in i.embedding_key]
-    nodes = sorted(nodes, key=lambda x: x[0])
-    nodes = [i for created, i in nodes]
-
-    # Calculating the component dictionaries and normalizing them.
-    recency_out = extract_recency(persona, nodes)
-    recency_out = normalize_dict_floats(recency_out, 0, 1)
-    importance_out = extract_importance(persona, nodes)
-    importance_out = normalize_dict_floats(importance_out, 0, 1)  
-    relevance_out = extract_relevance(persona, nodes, focal_pt)
-    relevance_out = normalize_dict_floats(relevance_out, 0, 1)
+  # Getting all nodes from the agent's memory (both thoughts and events).
+  # You could also imagine getting the raw conversation, but for now. 
+  nodes = [i for i in persona.a_mem.seq_event + persona.a_mem.seq_thought
+           if "idle" not in i.embedding_key]
+  if not nodes: 
+    for focal_pt in focal_points: 
+      retrieved[focal_pt] = []
+    return retrieved
+
+  # The importance and relevance of a node do not depend on the focal point
+  # being retrieved, so we compute them once for all the focal points. The
+  # relevance of every node to every focal point takes one matrix multiply.
+  importance_out = np.array([node.poignancy if type(node.poignancy) == int 
+                             else 4 for node in nodes], dtype=float)
+  importance_out = normalize_floats(importance_out, 0, 1)
+
+  rows = persona.a_mem.get_embedding_rows(nodes)
+  node_embeddings = persona.a_mem.embedding_matrix[rows]
+  node_norms = persona.a_mem.embedding_norms[rows]
+  focal_embeddings = np.array(get_embeddings(focal_points), dtype=np.float32)
+  focal_norms = np.linalg.norm(focal_embeddings, axis=1)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    relevance_all = ((node_embeddings @ focal_embeddings.T) 
+                     / np.outer(node_norms, focal_norms)).astype(float)
+
+  # The recency of the nodes changes from a focal point to the next, since we
+  # mark the retrieved nodes as accessed.
+  last_accessed = np.array([node.last_accessed for node in nodes], 
+                           dtype="datetime64[us]")
+
+  for count, focal_pt in enumerate(focal_points):
+    # Sorting the nodes by the datetime of their last access. The recency
+    # score decays with the position of the node in that order.
+    order = np.argsort(last_accessed, kind="stable")
+    tie_rank = np.empty(len(nodes), dtype=np.int64)
+    tie_rank[order] = np.arange(len(nodes))
+    recency_out = persona.scratch.recency_decay ** (tie_rank + 1.0)
+    recency_out = normalize_floats(recency_out, 0, 1)
+    relevance_out = normalize_floats(relevance_all[:, count], 0, 1)
 
     # Computing the final scores that combines the component values. 
     # Note to self: test out different weights. [1, 1, 1] tends to work
@@ -274,34 +359,27 @@ def new_retrieve(persona, focal_points, n_count=30):
     # gw = [1, 1, 1]
     # gw = [1, 2, 1]
     gw = [0.5, 3, 2]
-    master_out = dict()
-    for key in recency_out.keys(): 
-      master_out[key] = (persona.scratch.recency_w*recency_out[key]*gw[0] 
-                     + persona.scratch.relevance_w*relevance_out[key]*gw[1] 
-                     + persona.scratch.importance_w*importance_out[key]*gw[2])
+    master_out = (persona.scratch.recency_w*recency_out*gw[0] 
+                  + persona.scratch.relevance_w*relevance_out*gw[1] 
+                  + persona.scratch.importance_w*importance_out*gw[2])
 
-    master_out = top_highest_x_values(master_out, len(master_out.keys()))
+    # Extracting the highest x values and translating them into nodes.
+    top = top_highest_x_indices(master_out, n_count, tie_rank)
 
     print("\n-------- focal_pt: ", focal_pt, flush=True)
-    for key, val in master_out.items():
-      print("key: ", persona.a_mem.id_to_node[key].embedding_key, " val: ", val)
+    for i in top:
+      print("key: ", nodes[i].embedding_key, " val: ", master_out[i])
       print(
-        "recency: ", persona.scratch.recency_w*recency_out[key]*1,
-        " relevance: ", persona.scratch.relevance_w*relevance_out[key]*1,
-        " importance: ", persona.scratch.importance_w*importance_out[key]*1
+        "recency: ", persona.scratch.recency_w*recency_out[i]*1,
+        " relevance: ", persona.scratch.relevance_w*relevance_out[i]*1,
+        " importance: ", persona.scratch.importance_w*importance_out[i]*1
       )
     print(flush=True)
 
-    # Extracting the highest x values.
-    # <master_out> has the key of node.id and value of float. Once we get the 
-    # highest x values, we want to translate the node.id into nodes and return
-    # the list of nodes.
-    master_out = top_highest_x_values(master_out, n_count)
-    master_nodes = [persona.a_mem.id_to_node[key]
-                    for key in list(master_out.keys())]
-
+    master_nodes = [nodes[i] for i in top]
     for n in master_nodes:
       n.last_accessed = persona.scratch.curr_time
+    last_accessed[top] = np.datetime64(persona.scratch.curr_time, "us")
 
     retrieved[focal_pt] = master_nodes
 
@@ -9,47 +9,235 @@ agents paper.
 """
 import json
 import datetime
+import os
+from array import array
+from collections import deque
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from utils import memory_journal_compact_size
+from persona.memory_structures.memory_journal import MemoryJournal
+
+# Datetimes are stored in the columns as microseconds since this epoch.
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+# Marks a node without an expiration in the expiration column.
+_NO_EXPIRATION = -2**63
+
+_NODE_TYPES = ("event", "thought", "chat")
+
+
+def _to_micros(dt):
+  return (dt - _EPOCH) // _MICROSECOND
+
+
+def _from_micros(micros):
+  return _EPOCH + datetime.timedelta(microseconds=micros)
 
 
 class ConceptNode: 
-  def __init__(self,
-               node_id, node_count, type_count, node_type, depth,
-               created, expiration, 
-               s, p, o, 
-               description, embedding_key, poignancy, keywords, filling): 
-    self.node_id = node_id
-    self.node_count = node_count
-    self.type_count = type_count
-    self.type = node_type # thought / event / chat
-    self.depth = depth
-
-    self.created = created
-    self.expiration = expiration
-    self.last_accessed = self.created
-
-    self.subject = s
-    self.predicate = p
-    self.object = o
-
-    self.description = description
-    self.embedding_key = embedding_key
-    self.poignancy = poignancy
-    self.keywords = keywords
-    self.filling = filling
+  """
+  A lightweight view over one row of an AssociativeMemory. The node data
+  lives in the columns of the memory; there is exactly one ConceptNode per
+  row, so nodes can be compared and hashed by identity.
+  """
+  __slots__ = ("_mem", "_row")
+
+  def __init__(self, mem, row): 
+    self._mem = mem
+    self._row = row
+
+  @property
+  def node_id(self): 
+    return f"node_{str(self._row + 1)}"
+
+  @property
+  def node_count(self): 
+    return self._row + 1
+
+  @property
+  def type_count(self): 
+    return self._mem._type_count[self._row]
+
+  @property
+  def type(self): # thought / event / chat
+    return _NODE_TYPES[self._mem._type[self._row]]
+
+  @property
+  def depth(self): 
+    return self._mem._depth[self._row]
+
+  @property
+  def created(self): 
+    return _from_micros(self._mem._created[self._row])
+
+  @property
+  def expiration(self): 
+    micros = self._mem._expiration[self._row]
+    if micros == _NO_EXPIRATION: 
+      return None
+    return _from_micros(micros)
+
+  @property
+  def last_accessed(self): 
+    return _from_micros(self._mem._last_accessed[self._row])
+
+  @last_accessed.setter
+  def last_accessed(self, value): 
+    self._mem._last_accessed[self._row] = _to_micros(value)
+
+  @property
+  def subject(self): 
+    return self._mem._subject[self._row]
+
+  @property
+  def predicate(self): 
+    return self._mem._predicate[self._row]
+
+  @property
+  def object(self): 
+    return self._mem._object[self._row]
+
+  @property
+  def description(self): 
+    return self._mem._description[self._row]
+
+  @property
+  def embedding_key(self): 
+    return self._mem._embedding_key[self._row]
+
+  @property
+  def poignancy(self): 
+    if self._row in self._mem._poignancy_other: 
+      return self._mem._poignancy_other[self._row]
+    return self._mem._poignancy[self._row]
+
+  @property
+  def keywords(self): 
+    return self._mem._keywords[self._row]
+
+  @property
+  def filling(self): 
+    return self._mem._filling[self._row]
 
 
   def spo_summary(self): 
     return (self.subject, self.predicate, self.object)
 
 
-class AssociativeMemory: 
-  def __init__(self, f_saved): 
-    self.id_to_node = dict()
+  def __repr__(self): 
+    return f"<ConceptNode {self.node_id}: {self.description}>"
+
+
+class NodeSequence(Sequence): 
+  """
+  Newest-first view over a list of rows of an AssociativeMemory. Rows are
+  appended in insertion order (so adding a node is O(1)), and read back in
+  reverse, which is the order the memory has always exposed: index 0 is the
+  latest node and index -1 the oldest one.
+  """
+  __slots__ = ("_nodes", "_rows")
+
+  def __init__(self, nodes): 
+    self._nodes = nodes
+    self._rows = array("q")
+
+  def append_row(self, row): 
+    self._rows.append(row)
+
+  def __len__(self): 
+    return len(self._rows)
+
+  def __getitem__(self, index): 
+    n = len(self._rows)
+    if isinstance(index, slice): 
+      return [self._nodes[self._rows[n - 1 - i]] 
+              for i in range(*index.indices(n))]
+    if index < 0: 
+      index += n
+    if not 0 <= index < n: 
+      raise IndexError("NodeSequence index out of range")
+    return self._nodes[self._rows[n - 1 - index]]
+
+  def __iter__(self): 
+    nodes = self._nodes
+    for row in reversed(self._rows): 
+      yield nodes[row]
+
+  def __add__(self, other): 
+    return list(self) + list(other)
 
-    self.seq_event = []
-    self.seq_thought = []
-    self.seq_chat = []
+  def __radd__(self, other): 
+    return list(other) + list(self)
 
+  def __repr__(self): 
+    return repr(list(self))
+
+
+class NodeIndex(Mapping): 
+  """Maps node ids ("node_<n>") to the nodes of an AssociativeMemory."""
+  __slots__ = ("_nodes",)
+
+  def __init__(self, nodes): 
+    self._nodes = nodes
+
+  def __getitem__(self, node_id): 
+    try: 
+      count = int(node_id.removeprefix("node_"))
+    except (AttributeError, ValueError): 
+      raise KeyError(node_id)
+    if not node_id.startswith("node_") or not 1 <= count <= len(self._nodes): 
+      raise KeyError(node_id)
+    return self._nodes[count - 1]
+
+  def __iter__(self): 
+    for row in range(len(self._nodes)): 
+      yield f"node_{str(row + 1)}"
+
+  def __len__(self): 
+    return len(self._nodes)
+
+
+class AssociativeMemory: 
+  def __init__(self, f_saved, journal=False): 
+    # The nodes are stored column by column, one row per node in insertion
+    # order. Rows are only ever appended. <_nodes> holds the ConceptNode view
+    # of every row.
+    self._nodes = []
+    self._type = array("b")
+    self._type_count = array("q")
+    self._depth = array("q")
+    self._created = array("q")
+    self._expiration = array("q")
+    self._last_accessed = array("q")
+    # Integer poignancies are kept in <_poignancy>; anything else (e.g., a
+    # failed LLM response) is kept as is in <_poignancy_other>.
+    self._poignancy = array("q")
+    self._poignancy_other = dict()
+    self._embedding_row = array("q")
+    self._subject = []
+    self._predicate = []
+    self._object = []
+    self._description = []
+    self._embedding_key = []
+    self._keywords = []
+    self._filling = []
+
+    self.id_to_node = NodeIndex(self._nodes)
+    # Set once loading is done, so that loading does not write the journal.
+    self.journal_enabled = False
+
+    self.seq_event = NodeSequence(self._nodes)
+    self.seq_thought = NodeSequence(self._nodes)
+    self.seq_chat = NodeSequence(self._nodes)
+    # Rolling window over the spo summaries of the latest events, newest 
+    # first (see get_latest_events()). It is created on first use and then 
+    # updated as events are added. 
+    self._latest_events = None
+
+    # Keyword posting lists: keyword -> NodeSequence of the nodes that have
+    # that keyword, newest first.
     self.kw_to_event = dict()
     self.kw_to_thought = dict()
     self.kw_to_chat = dict()
@@ -59,43 +247,21 @@ class AssociativeMemory:
 
     self.embeddings = json.load(open(f_saved + "/embeddings.json"))
 
+    # Contiguous copy of the embeddings of the nodes, used for vectorized
+    # retrieval. Every embedding key owns one row of <embedding_matrix>, and
+    # <embedding_norms> holds the norm of every row. Only the first
+    # <embedding_count> rows are in use; the rest is spare capacity.
+    self.embedding_rows = dict()
+    self.embedding_matrix = None
+    self.embedding_norms = None
+    self.embedding_count = 0
+
     nodes_load = json.load(open(f_saved + "/nodes.json"))
     for count in range(len(nodes_load.keys())): 
       node_id = f"node_{str(count+1)}"
       node_details = nodes_load[node_id]
-
-      node_count = node_details["node_count"]
-      type_count = node_details["type_count"]
-      node_type = node_details["type"]
-      depth = node_details["depth"]
-
-      created = datetime.datetime.strptime(node_details["created"], 
-                                           '%Y-%m-%d %H:%M:%S')
-      expiration = None
-      if node_details["expiration"]: 
-        expiration = datetime.datetime.strptime(node_details["expiration"],
-                                                '%Y-%m-%d %H:%M:%S')
-
-      s = node_details["subject"]
-      p = node_details["predicate"]
-      o = node_details["object"]
-
-      description = node_details["description"]
-      embedding_pair = (node_details["embedding_key"], 
-                        self.embeddings[node_details["embedding_key"]])
-      poignancy =node_details["poignancy"]
-      keywords = set(node_details["keywords"])
-      filling = node_details["filling"]
-      
-      if node_type == "event": 
-        self.add_event(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
-      elif node_type == "chat": 
-        self.add_chat(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
-      elif node_type == "thought": 
-        self.add_thought(created, expiration, s, p, o, 
-                   description, keywords, poignancy, embedding_pair, filling)
+      self._add_from_details(node_details, 
+                             self.embeddings[node_details["embedding_key"]])
 
     kw_strength_load = json.load(open(f_saved + "/kw_strength.json"))
     if kw_strength_load["kw_strength_event"]: 
@@ -103,56 +269,219 @@ class AssociativeMemory:
     if kw_strength_load["kw_strength_thought"]: 
       self.kw_strength_thought = kw_strength_load["kw_strength_thought"]
 
+    # JOURNAL
+    # Nodes added since the last snapshot are in the journal (see
+    # memory_journal.py). It is replayed up to its last commit marker, even
+    # when journal mode is off, so that a memory saved in journal mode can 
+    # always be loaded.
+    # A compaction writes kw_strength.json (which records how many nodes it
+    # accounts for) before nodes.json, and empties the journal last. If it
+    # was interrupted, kw_strength may already count nodes that are only in
+    # the journal; those nodes are replayed without counting them again.
+    self.f_saved = f_saved
+    self.journal = MemoryJournal(f"{f_saved}/journal.jsonl")
+    snapshot_count = len(self._nodes)
+    kw_strength_count = kw_strength_load.get("node_count", snapshot_count)
+    for record in self.journal.records: 
+      if record["node_count"] > snapshot_count: 
+        if record["node_count"] != len(self._nodes) + 1: 
+          raise ValueError(f"{self.journal.f_journal}: expected node "
+                           f"{len(self._nodes) + 1}, found "
+                           f"{record['node_count']}")
+        embedding = record.get("embedding")
+        if embedding is None: 
+          embedding = self.embeddings[record["embedding_key"]]
+        self._add_from_details(record, embedding)
+        if record["node_count"] <= kw_strength_count: 
+          self._count_record_keywords(record, -1)
+      elif record["node_count"] > kw_strength_count: 
+        self._count_record_keywords(record, 1)
+    self.journal_enabled = journal
+    if self.journal_enabled: 
+      self.journal.open()
+
+
+  def _add_from_details(self, node_details, embedding): 
+    """
+    Adds a node from its saved form (an entry of nodes.json or a journal
+    record).
+    """
+    created = datetime.datetime.strptime(node_details["created"], 
+                                         '%Y-%m-%d %H:%M:%S')
+    expiration = None
+    if node_details["expiration"]: 
+      expiration = datetime.datetime.strptime(node_details["expiration"],
+                                              '%Y-%m-%d %H:%M:%S')
+
+    s = node_details["subject"]
+    p = node_details["predicate"]
+    o = node_details["object"]
+
+    description = node_details["description"]
+    embedding_pair = (node_details["embedding_key"], embedding)
+    poignancy =node_details["poignancy"]
+    keywords = set(node_details["keywords"])
+    filling = node_details["filling"]
     
-  def save(self, out_json): 
+    node_type = node_details["type"]
+    if node_type == "event": 
+      self.add_event(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+    elif node_type == "chat": 
+      self.add_chat(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+    elif node_type == "thought": 
+      self.add_thought(created, expiration, s, p, o, 
+                 description, keywords, poignancy, embedding_pair, filling)
+
+
+  def _node_details(self, node): 
+    """Returns the saved form of <node>, as stored in nodes.json."""
     r = dict()
-    for count in range(len(self.id_to_node.keys()), 0, -1): 
-      node_id = f"node_{str(count)}"
-      node = self.id_to_node[node_id]
-
-      r[node_id] = dict()
-      r[node_id]["node_count"] = node.node_count
-      r[node_id]["type_count"] = node.type_count
-      r[node_id]["type"] = node.type
-      r[node_id]["depth"] = node.depth
-
-      r[node_id]["created"] = node.created.strftime('%Y-%m-%d %H:%M:%S')
-      r[node_id]["expiration"] = None
-      if node.expiration: 
-        r[node_id]["expiration"] = (node.expiration
-                                        .strftime('%Y-%m-%d %H:%M:%S'))
-
-      r[node_id]["subject"] = node.subject
-      r[node_id]["predicate"] = node.predicate
-      r[node_id]["object"] = node.object
-
-      r[node_id]["description"] = node.description
-      r[node_id]["embedding_key"] = node.embedding_key
-      r[node_id]["poignancy"] = node.poignancy
-      r[node_id]["keywords"] = list(node.keywords)
-      r[node_id]["filling"] = node.filling
-
-    with open(out_json+"/nodes.json", "w") as outfile:
-      json.dump(r, outfile)
+    r["node_count"] = node.node_count
+    r["type_count"] = node.type_count
+    r["type"] = node.type
+    r["depth"] = node.depth
+
+    r["created"] = node.created.strftime('%Y-%m-%d %H:%M:%S')
+    r["expiration"] = None
+    if node.expiration: 
+      r["expiration"] = node.expiration.strftime('%Y-%m-%d %H:%M:%S')
+
+    r["subject"] = node.subject
+    r["predicate"] = node.predicate
+    r["object"] = node.object
+
+    r["description"] = node.description
+    r["embedding_key"] = node.embedding_key
+    r["poignancy"] = node.poignancy
+    r["keywords"] = list(node.keywords)
+    r["filling"] = node.filling
+    return r
+
+
+  def save(self, out_json, compact=False, step=None): 
+    """
+    Saves the memory to the <out_json> folder. In journal mode, saving to the
+    folder the memory was loaded from only commits the journal at <step>,
+    unless the journal has grown past <memory_journal_compact_size> or
+    <compact> is set; then the journal is folded into a new snapshot.
+    """
+    in_place = os.path.abspath(out_json) == os.path.abspath(self.f_saved)
+    if in_place and self.journal_enabled: 
+      # Committed first, so that an interrupted compaction still finds all
+      # of the nodes it was folding in.
+      self.journal.commit(step)
+      if not compact and self.journal.size() < memory_journal_compact_size: 
+        return
+
+    # Embeddings first, then kw_strength, then the nodes: see the JOURNAL
+    # note in __init__ for why a crash in between is safe.
+    with open(out_json+"/embeddings.json.tmp", "w") as outfile:
+      json.dump(self.embeddings, outfile)
+    os.replace(out_json+"/embeddings.json.tmp", out_json+"/embeddings.json")
 
     r = dict()
     r["kw_strength_event"] = self.kw_strength_event
     r["kw_strength_thought"] = self.kw_strength_thought
-    with open(out_json+"/kw_strength.json", "w") as outfile:
+    r["node_count"] = len(self._nodes)
+    with open(out_json+"/kw_strength.json.tmp", "w") as outfile:
       json.dump(r, outfile)
+    os.replace(out_json+"/kw_strength.json.tmp", out_json+"/kw_strength.json")
 
-    with open(out_json+"/embeddings.json", "w") as outfile:
-      json.dump(self.embeddings, outfile)
+    r = dict()
+    for count in range(len(self.id_to_node.keys()), 0, -1): 
+      node_id = f"node_{str(count)}"
+      r[node_id] = self._node_details(self.id_to_node[node_id])
+
+    with open(out_json+"/nodes.json.tmp", "w") as outfile:
+      json.dump(r, outfile)
+    os.replace(out_json+"/nodes.json.tmp", out_json+"/nodes.json")
+
+    if in_place: 
+      self.journal.reset()
+
+
+  def _add_node(self, node_type, seq, kw_to, type_count, depth, 
+                created, expiration, s, p, o, 
+                description, embedding_pair, poignancy, keywords, filling): 
+    """
+    Stores the embedding, appends a row to the columns and returns the
+    ConceptNode view of it. In journal mode, the node is also appended to the
+    journal.
+    """
+    embedding_key, embedding = embedding_pair
+    new_embedding = self.embeddings.get(embedding_key) != embedding
+    self.set_embedding(embedding_key, embedding)
+
+    row = len(self._nodes)
+    node = ConceptNode(self, row)
+
+    self._type.append(_NODE_TYPES.index(node_type))
+    self._type_count.append(type_count)
+    self._depth.append(depth)
+    self._created.append(_to_micros(created))
+    self._expiration.append(_to_micros(expiration) if expiration 
+                            else _NO_EXPIRATION)
+    self._last_accessed.append(_to_micros(created))
+    if type(poignancy) == int: 
+      self._poignancy.append(poignancy)
+    else: 
+      self._poignancy.append(0)
+      self._poignancy_other[row] = poignancy
+    self._embedding_row.append(self.embedding_rows[embedding_key])
+    self._subject.append(s)
+    self._predicate.append(p)
+    self._object.append(o)
+    self._description.append(description)
+    self._embedding_key.append(embedding_key)
+    self._keywords.append(keywords)
+    self._filling.append(filling)
+    self._nodes.append(node)
+
+    # Creating various dictionary cache for fast access. 
+    seq.append_row(row)
+    if seq is self.seq_event and self._latest_events is not None: 
+      self._latest_events.appendleft(node.spo_summary())
+    for kw in [i.lower() for i in keywords]: 
+      if kw not in kw_to: 
+        kw_to[kw] = NodeSequence(self._nodes)
+      kw_to[kw].append_row(row)
+
+    if self.journal_enabled: 
+      record = self._node_details(node)
+      if new_embedding: 
+        record["embedding"] = list(embedding)
+      self.journal.append(record)
+
+    return node
+
+
+  def _count_keywords(self, kw_strength, p, o, keywords, delta=1): 
+    # Adding in the kw_strength
+    if f"{p} {o}" != "is idle":  
+      for kw in [i.lower() for i in keywords]: 
+        if kw in kw_strength: 
+          kw_strength[kw] += delta
+        else: 
+          kw_strength[kw] = delta
+
+
+  def _count_record_keywords(self, record, delta): 
+    """Counts the keywords of a journal record in kw_strength."""
+    if record["type"] == "event": 
+      self._count_keywords(self.kw_strength_event, record["predicate"], 
+                           record["object"], record["keywords"], delta)
+    elif record["type"] == "thought": 
+      self._count_keywords(self.kw_strength_thought, record["predicate"], 
+                           record["object"], record["keywords"], delta)
 
 
   def add_event(self, created, expiration, s, p, o, 
                       description, keywords, poignancy, 
                       embedding_pair, filling):
-    # Setting up the node ID and counts.
-    node_count = len(self.id_to_node.keys()) + 1
+    # Setting up the counts.
     type_count = len(self.seq_event) + 1
-    node_type = "event"
-    node_id = f"node_{str(node_count)}"
     depth = 0
 
     # Node type specific clean up. 
@@ -161,32 +490,12 @@ class AssociativeMemory:
                      + " " 
                      +  description.split("(")[-1][:-1])
 
-    # Creating the <ConceptNode> object.
-    node = ConceptNode(node_id, node_count, type_count, node_type, depth,
-                       created, expiration, 
-                       s, p, o, 
-                       description, embedding_pair[0], 
-                       poignancy, keywords, filling)
-
-    # Creating various dictionary cache for fast access. 
-    self.seq_event[0:0] = [node]
-    keywords = [i.lower() for i in keywords]
-    for kw in keywords: 
-      if kw in self.kw_to_event: 
-        self.kw_to_event[kw][0:0] = [node]
-      else: 
-        self.kw_to_event[kw] = [node]
-    self.id_to_node[node_id] = node 
-
-    # Adding in the kw_strength
-    if f"{p} {o}" != "is idle":  
-      for kw in keywords: 
-        if kw in self.kw_strength_event: 
-          self.kw_strength_event[kw] += 1
-        else: 
-          self.kw_strength_event[kw] = 1
-
-    self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    node = self._add_node("event", self.seq_event, self.kw_to_event, 
+                          type_count, depth, created, expiration, 
+                          s, p, o, 
+                          description, embedding_pair, 
+                          poignancy, keywords, filling)
+    self._count_keywords(self.kw_strength_event, p, o, keywords)
 
     return node
 
@@ -194,11 +503,8 @@ class AssociativeMemory:
   def add_thought(self, created, expiration, s, p, o, 
                         description, keywords, poignancy, 
                         embedding_pair, filling):
-    # Setting up the node ID and counts.
-    node_count = len(self.id_to_node.keys()) + 1
+    # Setting up the counts.
     type_count = len(self.seq_thought) + 1
-    node_type = "thought"
-    node_id = f"node_{str(node_count)}"
     depth = 1 
     try: 
       if filling: 
@@ -206,31 +512,12 @@ class AssociativeMemory:
     except: 
       pass
 
-    # Creating the <ConceptNode> object.
-    node = ConceptNode(node_id, node_count, type_count, node_type, depth,
-                       created, expiration, 
-                       s, p, o, 
-                       description, embedding_pair[0], poignancy, keywords, filling)
-
-    # Creating various dictionary cache for fast access. 
-    self.seq_thought[0:0] = [node]
-    keywords = [i.lower() for i in keywords]
-    for kw in keywords: 
-      if kw in self.kw_to_thought: 
-        self.kw_to_thought[kw][0:0] = [node]
-      else: 
-        self.kw_to_thought[kw] = [node]
-    self.id_to_node[node_id] = node 
-
-    # Adding in the kw_strength
-    if f"{p} {o}" != "is idle":  
-      for kw in keywords: 
-        if kw in self.kw_strength_thought: 
-          self.kw_strength_thought[kw] += 1
-        else: 
-          self.kw_strength_thought[kw] = 1
-
-    self.embeddings[embedding_pair[0]] = embedding_pair[1]
+    node = self._add_node("thought", self.seq_thought, self.kw_to_thought, 
+                          type_count, depth, created, expiration, 
+                          s, p, o, 
+                          description, embedding_pair, 
+                          poignancy, keywords, filling)
+    self._count_keywords(self.kw_strength_thought, p, o, keywords)
 
     return node
 
@@ -238,39 +525,75 @@ class AssociativeMemory:
   def add_chat(self, created, expiration, s, p, o, 
                      description, keywords, poignancy, 
                      embedding_pair, filling): 
-    # Setting up the node ID and counts.
-    node_count = len(self.id_to_node.keys()) + 1
+    # Setting up the counts.
     type_count = len(self.seq_chat) + 1
-    node_type = "chat"
-    node_id = f"node_{str(node_count)}"
     depth = 0
 
-    # Creating the <ConceptNode> object.
-    node = ConceptNode(node_id, node_count, type_count, node_type, depth,
-                       created, expiration, 
-                       s, p, o, 
-                       description, embedding_pair[0], poignancy, keywords, filling)
-
-    # Creating various dictionary cache for fast access. 
-    self.seq_chat[0:0] = [node]
-    keywords = [i.lower() for i in keywords]
-    for kw in keywords: 
-      if kw in self.kw_to_chat: 
-        self.kw_to_chat[kw][0:0] = [node]
-      else: 
-        self.kw_to_chat[kw] = [node]
-    self.id_to_node[node_id] = node 
-
-    self.embeddings[embedding_pair[0]] = embedding_pair[1]
-        
-    return node
+    return self._add_node("chat", self.seq_chat, self.kw_to_chat, 
+                          type_count, depth, created, expiration, 
+                          s, p, o, 
+                          description, embedding_pair, 
+                          poignancy, keywords, filling)
+
+
+  def set_embedding(self, key, embedding):
+    """
+    Stores <embedding> under <key>, both in <embeddings> and in the embedding
+    matrix.
+    """
+    self.embeddings[key] = embedding
+
+    vector = np.asarray(embedding, dtype=np.float32)
+    if self.embedding_matrix is None:
+      self.embedding_matrix = np.zeros((64, len(vector)), dtype=np.float32)
+      self.embedding_norms = np.zeros(64, dtype=np.float32)
+    if len(vector) != self.embedding_matrix.shape[1]:
+      raise ValueError(
+        f"Embedding of {key!r} has {len(vector)} dimensions, but the memory "
+        f"holds embeddings with {self.embedding_matrix.shape[1]} dimensions."
+      )
+
+    row = self.embedding_rows.get(key)
+    if row is None:
+      row = self.embedding_count
+      if row == len(self.embedding_matrix):
+        self.embedding_matrix = np.concatenate(
+          [self.embedding_matrix, np.zeros_like(self.embedding_matrix)]
+        )
+        self.embedding_norms = np.concatenate(
+          [self.embedding_norms, np.zeros_like(self.embedding_norms)]
+        )
+      self.embedding_rows[key] = row
+      self.embedding_count += 1
+    self.embedding_matrix[row] = vector
+    self.embedding_norms[row] = np.linalg.norm(vector)
+
+
+  def get_embedding_rows(self, nodes):
+    """
+    Returns an array with the row of the embedding matrix of every node in
+    <nodes>.
+    """
+    embedding_row = self._embedding_row
+    return np.fromiter((embedding_row[node._row] for node in nodes), 
+                       dtype=np.int64, count=len(nodes))
+
+
+  def get_latest_events(self, retention): 
+    """
+    Returns the spo summaries of the latest <retention> events, newest first.
+    The returned deque is kept up to date as events are added, rather than 
+    rebuilt from seq_event on every call; it must not be modified. 
+    """
+    if self._latest_events is None or self._latest_events.maxlen != retention: 
+      self._latest_events = deque(
+        (e_node.spo_summary() for e_node in self.seq_event[:retention]), 
+        maxlen=retention)
+    return self._latest_events
 
 
   def get_summarized_latest_events(self, retention): 
-    ret_set = set()
-    for e_node in self.seq_event[:retention]: 
-      ret_set.add(e_node.spo_summary())
-    return ret_set
+    return set(self.get_latest_events(retention))
 
 
   def get_str_seq_events(self): 
@@ -0,0 +1,119 @@
+"""
+File: memory_journal.py
+Description: Write-ahead journal for the associative memory.
+
+In journal mode, every node added to a persona's associative memory is
+appended to <associative_memory>/journal.jsonl as soon as it is created: one
+JSON line holding the same fields as the node's entry in nodes.json, plus its
+embedding when that embedding is not in the memory yet. Saving then only has
+to append a commit marker ({"saved_step": <step>}) and flush the journal, and
+a periodic compaction folds the journal back into the
+nodes.json/kw_strength.json/embeddings.json snapshot.
+
+The rest of a persona's state (and the simulation's meta.json) is only written
+when the simulation is saved, so the nodes after the last commit marker belong
+to steps that a resumed simulation runs again. Reading the journal drops them.
+"""
+
+import json
+import os
+
+
+class MemoryJournal:
+  def __init__(self, f_journal):
+    """
+    Reads the node records already in the journal at <f_journal> (if any),
+    up to its last commit marker. The records after it (including a trailing
+    line that was only partly written, e.g., because the process died while
+    writing it) are dropped, and cut off once the journal is opened.
+
+    INPUT:
+      f_journal: the path of the journal file.
+    """
+    self.f_journal = f_journal
+    self.records = []
+    self.valid_size = 0
+    self.file = None
+
+    if not os.path.exists(f_journal):
+      return
+    pending = []
+    size = 0
+    with open(f_journal, "rb") as f:
+      for line in f:
+        if not line.endswith(b"\n"):
+          break
+        try:
+          record = json.loads(line)
+        except ValueError:
+          break
+        size += len(line)
+        if "saved_step" in record:
+          self.records += pending
+          pending = []
+          self.valid_size = size
+        else:
+          pending += [record]
+
+
+  def open(self):
+    """
+    Opens the journal for appending, cutting off the records after its last
+    commit marker.
+    """
+    if self.file:
+      return
+    self.file = open(self.f_journal, "ab")
+    if self.file.tell() != self.valid_size:
+      self.file.truncate(self.valid_size)
+      self.file.seek(self.valid_size)
+
+
+  def append(self, record):
+    """
+    Appends <record> and hands it to the OS right away, so that it survives
+    the process crashing.
+    """
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    self.file.write(line)
+    self.file.flush()
+    self.valid_size += len(line)
+
+
+  def commit(self, step):
+    """
+    Marks the records appended so far as saved at <step> and makes sure the
+    journal is on disk.
+    """
+    self.append({"saved_step": step})
+    self.sync()
+
+
+  def size(self):
+    return self.valid_size
+
+
+  def sync(self):
+    """Makes sure the journal is on disk."""
+    if self.file:
+      self.file.flush()
+      os.fsync(self.file.fileno())
+
+
+  def reset(self):
+    """Empties the journal once its records are part of the snapshot."""
+    self.records = []
+    self.valid_size = 0
+    if self.file:
+      self.file.truncate(0)
+      self.file.seek(0)
+      self.sync()
+    elif os.path.exists(self.f_journal):
+      os.remove(self.f_journal)
+
+
+  def close(self):
+    if self.file:
+      self.sync()
+      self.file.close()
+      self.file = None
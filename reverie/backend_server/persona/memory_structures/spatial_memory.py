@@ -7,6 +7,8 @@ memory that aids in grounding their behavior in the game world.
 """
 import json
 
+import numpy as np
+
 import sys
 sys.path.append('../../')
 from global_methods import check_if_file_exists
@@ -17,6 +19,99 @@ class MemoryTree:
     if check_if_file_exists(f_saved): 
       self.tree = json.load(open(f_saved))
 
+    # <seen_paths> is a bitset (a boolean mask) over the object path ids of
+    # the maze the persona perceives in (see Maze.object_paths): it is True
+    # for the paths that are already in the tree, so that perceiving them 
+    # again can be skipped. <_seen_paths_table> is the maze table it refers
+    # to. 
+    self.seen_paths = None
+    self._seen_paths_table = None
+
+
+  def add_path(self, world, sector, arena, game_object): 
+    """
+    Adds the world, sector, arena and game object of a tile to the tree. 
+    Empty names are skipped. 
+    """
+    if world: 
+      if world not in self.tree: 
+        self.tree[world] = {}
+    if sector: 
+      if sector not in self.tree[world]: 
+        self.tree[world][sector] = {}
+    if arena: 
+      if arena not in self.tree[world][sector]: 
+        self.tree[world][sector][arena] = []
+    if game_object: 
+      if game_object not in self.tree[world][sector][arena]: 
+        self.tree[world][sector][arena] += [game_object]
+
+
+  def has_path(self, world, sector, arena, game_object): 
+    """
+    Returns whether add_path() would leave the tree as it is. 
+    """
+    try: 
+      return ((not world or world in self.tree)
+              and (not sector or sector in self.tree[world])
+              and (not arena or arena in self.tree[world][sector])
+              and (not game_object 
+                   or game_object in self.tree[world][sector][arena]))
+    except (KeyError, TypeError): 
+      return False
+
+
+  def _bind_maze(self, maze): 
+    """
+    Sets up <seen_paths> for <maze>, marking every path of the maze that is
+    already known. 
+    """
+    if self._seen_paths_table is maze.object_paths: 
+      return
+    self.seen_paths = np.array([self.has_path(*path) 
+                                for path in maze.object_paths], dtype=bool)
+    self._seen_paths_table = maze.object_paths
+
+
+  def merge_paths(self, maze, path_ids): 
+    """
+    Bulk-merges object paths of <maze> into the tree, in the given order, 
+    e.g., all the paths of an area a persona spawns into. Paths that are 
+    already known are skipped. 
+
+    INPUT
+      maze: the current <Maze>. 
+      path_ids: an iterable of ids into maze.object_paths. 
+    """
+    self._bind_maze(maze)
+    for path_id in path_ids: 
+      if not self.seen_paths[path_id]: 
+        self.add_path(*maze.object_paths[path_id])
+        self.seen_paths[path_id] = True
+
+
+  def perceive_area(self, maze, left_end, right_end, top_end, bottom_end): 
+    """
+    Adds the tiles of a rectangle of <maze> to the tree. Only tiles whose 
+    path was never seen before are looked at, so perceiving known areas 
+    costs next to nothing. The tiles are merged in the order of 
+    Maze.get_nearby_tiles (x first), so the tree grows as if every tile was
+    added one after the other. 
+
+    INPUT
+      maze: the current <Maze>. 
+      left_end, right_end, top_end, bottom_end: the bounds of the rectangle,
+        the right and bottom ones exclusive (see Maze.get_nearby_bounds). 
+    """
+    self._bind_maze(maze)
+    window = maze.object_path_ids[top_end:bottom_end, left_end:right_end]
+    window = window.T.ravel()
+    new_ids = window[~self.seen_paths[window]]
+    if not new_ids.size: 
+      return
+    new_ids, first_seen = np.unique(new_ids, return_index=True)
+    self.merge_paths(maze, new_ids[np.argsort(first_seen)].tolist())
+
 
   def print_tree(self): 
     def _print_tree(tree, depth):
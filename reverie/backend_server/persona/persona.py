@@ -17,13 +17,15 @@ from persona.memory_structures.scratch import Scratch
 
 from persona.cognitive_modules.perceive import perceive
 from persona.cognitive_modules.retrieve import retrieve
-from persona.cognitive_modules.plan import plan
+from persona.cognitive_modules.plan import plan, plan_action, plan_react
 from persona.cognitive_modules.reflect import reflect
 from persona.cognitive_modules.execute import execute
 from persona.cognitive_modules.converse import open_convo_session
+from profiler import profiler
 
 class Persona:
-  def __init__(self, name: str, folder_mem_saved: str):
+  def __init__(self, name: str, folder_mem_saved: str, 
+               memory_journal: bool = False):
     # PERSONA BASE STATE
     # <name> is the full name of the persona. This is a unique identifier for
     # the persona within Reverie.
@@ -35,20 +37,26 @@ class Persona:
     # <s_mem> is the persona's spatial memory. 
     f_s_mem_saved = f"{folder_mem_saved}/bootstrap_memory/spatial_memory.json"
     self.s_mem = MemoryTree(f_s_mem_saved)
-    # <s_mem> is the persona's associative memory. 
+    # <s_mem> is the persona's associative memory. With <memory_journal>, new
+    # memories are journaled as they are created instead of being rewritten
+    # in full on every save.
     f_a_mem_saved = f"{folder_mem_saved}/bootstrap_memory/associative_memory"
-    self.a_mem = AssociativeMemory(f_a_mem_saved)
+    self.a_mem = AssociativeMemory(f_a_mem_saved, journal=memory_journal)
     # <scratch> is the persona's scratch (short term memory) space. 
     scratch_saved = f"{folder_mem_saved}/bootstrap_memory/scratch.json"
     self.scratch = Scratch(scratch_saved)
 
 
-  def save(self, save_folder): 
+  def save(self, save_folder, compact=False, step=None): 
     """
     Save persona's current state (i.e., memory). 
 
     INPUT: 
       save_folder: The folder where we wil be saving our persona's state. 
+      compact: Whether to fold the associative memory's journal into a full
+               snapshot, when journal mode is on. 
+      step: The simulation step being saved, recorded in the associative
+            memory's journal. 
     OUTPUT: 
       None
     """
@@ -64,7 +72,7 @@ class Persona:
     # [event.type, event.created, event.expiration, s, p, o]
     # e.g., event,2022-10-23 00:00:00,,Isabella Rodriguez,is,idle
     f_a_mem = f"{save_folder}/associative_memory"
-    self.a_mem.save(f_a_mem)
+    self.a_mem.save(f_a_mem, compact=compact, step=step)
 
     # Scratch contains non-permanent data associated with the persona. When 
     # it is saved, it takes a json form. When we load it, we move the values
@@ -99,7 +107,8 @@ class Persona:
         See associative_memory.py -- but to get you a sense of what it 
         receives as its input: "s, p, o, desc, persona.scratch.curr_time"
     """
-    return perceive(self, maze)
+    with profiler.phase("perceive", self.name):
+      return perceive(self, maze)
 
 
   def retrieve(self, perceived):
@@ -115,7 +124,8 @@ class Persona:
                  while the latter layer specifies the "curr_event", "events", 
                  and "thoughts" that are relevant.
     """
-    return retrieve(self, perceived)
+    with profiler.phase("retrieve", self.name):
+      return retrieve(self, perceived)
 
 
   def plan(self, maze, personas, new_day, retrieved):
@@ -140,7 +150,8 @@ class Persona:
     OUTPUT 
       The target action address of the persona (persona.scratch.act_address).
     """
-    return plan(self, maze, personas, new_day, retrieved)
+    with profiler.phase("plan", self.name):
+      return plan(self, maze, personas, new_day, retrieved)
 
 
   def execute(self, maze, personas, plan):
@@ -162,7 +173,8 @@ class Persona:
         writing her next novel (editing her novel) 
         @ double studio:double studio:common room:sofa
     """
-    return execute(self, maze, personas, plan)
+    with profiler.phase("execute", self.name):
+      return execute(self, maze, personas, plan)
 
 
   def reflect(self):
@@ -174,7 +186,8 @@ class Persona:
     OUTPUT: 
       None
     """
-    reflect(self)
+    with profiler.phase("reflect", self.name):
+      reflect(self)
 
 
   def move(self, maze, personas, curr_tile, curr_time):
@@ -196,6 +209,65 @@ class Persona:
         writing her next novel (editing her novel) 
         @ double studio:double studio:common room:sofa
     """
+    new_day = self._start_step(curr_tile, curr_time)
+
+    # Main cognitive sequence begins here. 
+    perceived = self.perceive(maze)
+    retrieved = self.retrieve(perceived)
+    plan = self.plan(maze, personas, new_day, retrieved)
+    if not self.scratch.is_noncognitive(): #noncognitive agents can't reflect at all
+      self.reflect()
+
+    # <execution> is a triple set that contains the following components: 
+    # <next_tile> is a x,y coordinate. e.g., (58, 9)
+    # <pronunciatio> is an emoji. e.g., "\ud83d\udca4"
+    # <description> is a string description of the movement. e.g., 
+    #   writing her next novel (editing her novel) 
+    #   @ double studio:double studio:common room:sofa
+    return self.execute(maze, personas, plan)
+
+
+  def think(self, maze, curr_tile, curr_time):
+    """
+    The part of move() that only concerns this persona: it perceives,
+    retrieves, and plans its next action, up to choosing the event it may
+    react to. Personas can think at the same time; react(), reflect() and
+    execute() then complete the move.
+
+    INPUT: 
+      maze: The Maze class of the current world. 
+      curr_tile: A tuple that designates the persona's current tile location 
+                 in (row, col) form. e.g., (58, 39)
+      curr_time: datetime instance that indicates the game's current time. 
+    OUTPUT: 
+      The focused event to pass to react().
+    """
+    new_day = self._start_step(curr_tile, curr_time)
+    perceived = self.perceive(maze)
+    retrieved = self.retrieve(perceived)
+    with profiler.phase("plan", self.name):
+      return plan_action(self, maze, new_day, retrieved)
+
+
+  def react(self, maze, personas, focused_event):
+    """
+    The part of move() that reacts to the <focused_event> returned by
+    think(). Reactions change the state of other personas, so personas react
+    one after another.
+
+    OUTPUT 
+      The target action address of the persona (persona.scratch.act_address).
+    """
+    with profiler.phase("plan", self.name):
+      return plan_react(self, maze, personas, focused_event)
+
+
+  def _start_step(self, curr_tile, curr_time):
+    """
+    Updates the persona's tile and time for a new step.
+    OUTPUT: 
+      new_day: False, "First day" or "New day" (see plan()).
+    """
     # Updating persona's scratch memory with <curr_tile>. 
     self.scratch.curr_tile = curr_tile
 
@@ -213,21 +285,7 @@ class Persona:
     #   new_day = "Same day"
       
     self.scratch.curr_time = curr_time
-
-    # Main cognitive sequence begins here. 
-    perceived = self.perceive(maze)
-    retrieved = self.retrieve(perceived)
-    plan = self.plan(maze, personas, new_day, retrieved)
-    if not self.scratch.is_noncognitive(): #noncognitive agents can't reflect at all
-      self.reflect()
-
-    # <execution> is a triple set that contains the following components: 
-    # <next_tile> is a x,y coordinate. e.g., (58, 9)
-    # <pronunciatio> is an emoji. e.g., "\ud83d\udca4"
-    # <description> is a string description of the movement. e.g., 
-    #   writing her next novel (editing her novel) 
-    #   @ double studio:double studio:common room:sofa
-    return self.execute(maze, personas, plan)
+    return new_day
 
 
   def open_convo_session(self, convo_mode, safe_mode=True, direct=False, question=None): 
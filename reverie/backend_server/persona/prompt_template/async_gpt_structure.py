@@ -0,0 +1,679 @@
+"""
+File: async_gpt_structure.py
+Description: asyncio twins of the request functions in gpt_structure.py.
+
+Every coroutine here mirrors the synchronous function of the same name in
+gpt_structure.py (same prompt handling, same error strings and the same
+validate/clean-up/fail-safe loop), but runs on AsyncOpenAI/AsyncAzureOpenAI so
+that many requests can be in flight at once. The number of in-flight requests
+is bounded by a global limit ("max-concurrency" in openai_config.json) and by
+optional per-model limits ("model-concurrency"). Identical requests in flight
+at the same time are only sent once (see single_flight.py). The LLM cache and
+the embedding store are on disk (and the store takes a file lock), so they are
+used from worker threads, off the event loop.
+
+Usage:
+  from persona.prompt_template import async_gpt_structure as agpt
+
+  responses = agpt.run_concurrently(
+    *[agpt.ChatGPT_request(prompt) for prompt in prompts]
+  )
+"""
+
+import asyncio
+import functools
+import json
+import traceback
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+from utils import use_openai, api_model
+from persona.prompt_template.gpt_structure import (
+  openai_config,
+  cost_logger,
+  cache_lookup,
+  cache_store,
+  count_coalesced,
+  embeddings_batch_size,
+  prepare_embedding_input,
+  lookup_embeddings,
+  claim_embeddings,
+  resolve_embeddings,
+  finish_embeddings,
+)
+from persona.prompt_template.llm_cache import LLMCache, LLMCacheMiss
+from persona.prompt_template.single_flight import AsyncSingleFlight
+from profiler import profiler
+from stub_llm_server import stub_endpoint
+
+if not use_openai:
+  model = api_model
+
+# Default number of requests allowed in flight at the same time, across all
+# models, when "max-concurrency" is not set in openai_config.json.
+DEFAULT_MAX_CONCURRENCY = 16
+
+
+def setup_async_client(type: str, config: dict):
+  """Setup the asynchronous OpenAI client.
+
+  Args:
+      type (str): the type of client. Either "azure", "openai" or "stub"
+        (the offline server in stub_llm_server.py).
+      config (dict): the configuration for the client.
+
+  Raises:
+      ValueError: if the client is invalid.
+
+  Returns:
+      The client object created, either AsyncAzureOpenAI or AsyncOpenAI.
+  """
+  if type == "azure":
+    client = AsyncAzureOpenAI(
+      azure_endpoint=config["endpoint"],
+      api_key=config["key"],
+      api_version=config["api-version"],
+    )
+  elif type == "openai":
+    client = AsyncOpenAI(
+      api_key=config["key"],
+    )
+  elif type == "stub":
+    client = AsyncOpenAI(
+      base_url=config["endpoint"],
+      api_key=config.get("key") or "stub",
+    )
+  else:
+    raise ValueError("Invalid client")
+  return client
+
+
+class _LoopState:
+  """Clients and semaphores bound to a single event loop.
+
+  asyncio primitives and the HTTP connection pools of the async clients belong
+  to the loop they were first used on, so every loop gets its own set.
+  """
+  def __init__(self):
+    if openai_config["client"] == "azure":
+      self.client = setup_async_client("azure", {
+        "endpoint": openai_config["model-endpoint"],
+        "key": openai_config["model-key"],
+        "api-version": openai_config["model-api-version"],
+      })
+    elif openai_config["client"] == "openai":
+      self.client = setup_async_client("openai", {
+        "key": openai_config["model-key"]
+      })
+    elif openai_config["client"] == "stub":
+      self.client = setup_async_client("stub", {
+        "endpoint": openai_config.get("model-endpoint",
+                                      stub_endpoint(openai_config)),
+        "key": openai_config.get("model-key"),
+      })
+    else:
+      raise ValueError("Invalid client")
+
+    if openai_config["embeddings-client"] == "azure":
+      self.embeddings_client = setup_async_client("azure", {
+        "endpoint": openai_config["embeddings-endpoint"],
+        "key": openai_config["embeddings-key"],
+        "api-version": openai_config["embeddings-api-version"],
+      })
+    elif openai_config["embeddings-client"] == "openai":
+      self.embeddings_client = setup_async_client("openai", {
+        "key": openai_config["embeddings-key"]
+      })
+    elif openai_config["embeddings-client"] == "stub":
+      self.embeddings_client = setup_async_client("stub", {
+        "endpoint": openai_config.get("embeddings-endpoint",
+                                      stub_endpoint(openai_config)),
+        "key": openai_config.get("embeddings-key"),
+      })
+    else:
+      raise ValueError("Invalid embeddings client")
+
+    self.global_limit = asyncio.Semaphore(
+      max(1, int(openai_config.get("max-concurrency", DEFAULT_MAX_CONCURRENCY)))
+    )
+    self.model_limits = {}
+    self.single_flight = None
+    if openai_config.get("single-flight", True):
+      self.single_flight = AsyncSingleFlight(on_coalesce=count_coalesced)
+
+  def model_limit(self, model_name):
+    """Returns the semaphore for <model_name>, or None if it is unbounded."""
+    if model_name not in self.model_limits:
+      limit = openai_config.get("model-concurrency", {}).get(model_name)
+      self.model_limits[model_name] = (
+        asyncio.Semaphore(max(1, int(limit))) if limit else None
+      )
+    return self.model_limits[model_name]
+
+
+_loop_states = {}
+
+
+def _state():
+  loop = asyncio.get_running_loop()
+  state = _loop_states.get(loop)
+  if state is None:
+    # Drop the state of loops that have been closed (e.g. by asyncio.run).
+    for closed in [other for other in _loop_states if other.is_closed()]:
+      del _loop_states[closed]
+    state = _loop_states[loop] = _LoopState()
+  return state
+
+
+class _limited:
+  """Async context manager holding the global and the per-model slot."""
+  def __init__(self, state, model_name):
+    self.global_limit = state.global_limit
+    self.model_limit = state.model_limit(model_name)
+
+  async def __aenter__(self):
+    await self.global_limit.acquire()
+    if self.model_limit:
+      try:
+        await self.model_limit.acquire()
+      except BaseException:
+        self.global_limit.release()
+        raise
+    return self
+
+  async def __aexit__(self, *exc):
+    if self.model_limit:
+      self.model_limit.release()
+    self.global_limit.release()
+    return False
+
+
+def run_concurrently(*coros):
+  """
+  Runs the given coroutines concurrently from synchronous code and returns
+  their results in the same order. Must not be called from a running loop.
+  ARGS:
+    coros: coroutines, e.g. ChatGPT_request(prompt) for a list of prompts.
+  RETURNS:
+    a list with the result of every coroutine.
+  """
+  async def gather():
+    return await asyncio.gather(*coros)
+  return asyncio.run(gather())
+
+
+def coalesce(function):
+  """Async version of gpt_structure.coalesce."""
+  @functools.wraps(function)
+  async def wrapper(*args, **kwargs):
+    single_flight = _state().single_flight
+    if single_flight is None:
+      return await function(*args, **kwargs)
+    key = LLMCache.key(function=function.__name__, args=args, kwargs=kwargs)
+    return await single_flight.do(key, lambda: function(*args, **kwargs))
+  return wrapper
+
+
+@coalesce
+async def ChatGPT_request(prompt, refresh=False):
+  """
+  Async version of gpt_structure.ChatGPT_request.
+  ARGS:
+    prompt: a str prompt
+  RETURNS:
+    a str of the LLM's response, or "LLM ERROR".
+  """
+  print("--- async ChatGPT_request() ---")
+  print("Prompt:", prompt, flush=True)
+
+  cache_key, hit, content = await asyncio.to_thread(
+    cache_lookup,
+    refresh=refresh,
+    kind="chat",
+    model=openai_config["model"],
+    prompt=prompt,
+  )
+  if hit:
+    print("Response content (cached):", content, flush=True)
+    return content.strip("`").removeprefix("json").strip()
+
+  state = _state()
+  try:
+    async with _limited(state, openai_config["model"]):
+      completion = await state.client.chat.completions.create(
+        model=openai_config["model"],
+        messages=[{"role": "user", "content": prompt}]
+      )
+    profiler.count_llm(completion)
+    content = completion.choices[0].message.content
+    print("Response content:", content, flush=True)
+    cost_logger.update_cost(
+      completion, input_cost=openai_config["model-costs"]["input"], output_cost=openai_config["model-costs"]["output"]
+    )
+    if content:
+      await asyncio.to_thread(cache_store, cache_key, content)
+      content = content.strip("`").removeprefix("json").strip()
+    return content
+
+  except Exception as e:
+    print(f"Error: {e}", flush=True)
+    traceback.print_exc()
+    return "LLM ERROR"
+
+
+@coalesce
+async def ChatGPT_structured_request(prompt, response_format, refresh=False):
+  """
+  Async version of gpt_structure.ChatGPT_structured_request.
+  ARGS:
+    prompt: a str prompt
+    response_format: a Pydantic model that defines the desired response format.
+  RETURNS:
+    the parsed response, or "LLM ERROR".
+  """
+  print("--- async ChatGPT_structured_request() ---")
+  print("Prompt:", prompt, flush=True)
+
+  cache_key, hit, parsed = await asyncio.to_thread(
+    cache_lookup,
+    refresh=refresh,
+    kind="chat-structured",
+    model=openai_config["model"],
+    prompt=prompt,
+    response_format=response_format,
+  )
+  if hit:
+    print("Response (cached):", parsed, flush=True)
+    return response_format.model_validate(parsed)
+
+  state = _state()
+  try:
+    async with _limited(state, openai_config["model"]):
+      completion = await state.client.beta.chat.completions.parse(
+        model=openai_config["model"],
+        response_format=response_format,
+        messages=[{"role": "user", "content": prompt}]
+      )
+    profiler.count_llm(completion)
+
+    print("Response:", completion, flush=True)
+    message = completion.choices[0].message
+
+    cost_logger.update_cost(
+      completion,
+      input_cost=openai_config["model-costs"]["input"],
+      output_cost=openai_config["model-costs"]["output"],
+    )
+
+    if message.parsed:
+      await asyncio.to_thread(
+        cache_store, cache_key, message.parsed.model_dump(mode="json")
+      )
+      return message.parsed
+    if message.refusal:
+      raise ValueError("Request refused: " + message.refusal)
+    raise ValueError("No parsed content or refusal found.")
+
+  except Exception as e:
+    print(f"Error: {e}", flush=True)
+    traceback.print_exc()
+    return "LLM ERROR"
+
+
+async def ChatGPT_safe_generate_response(
+  prompt,
+  example_output="",
+  special_instruction="",
+  repeat=3,
+  fail_safe_response="error",
+  func_validate=None,
+  func_clean_up=None,
+  verbose=False,
+):
+  if func_validate and func_clean_up:
+    prompt = '"""\n' + prompt + '\n"""\n'
+    if example_output or special_instruction:
+      prompt += (
+        f"Output the response to the prompt above in json. {special_instruction}\n"
+      )
+      if example_output:
+        prompt += "Example output json:\n"
+        prompt += '{"output": "' + str(example_output) + '"}'
+
+    for i in range(repeat):
+      print("Attempt", i + 1, flush=True)
+
+      try:
+        chatgpt_response = await ChatGPT_request(prompt, refresh=i > 0)
+        if not chatgpt_response:
+          raise Exception("Error: No valid response from LLM.")
+        curr_gpt_response = chatgpt_response.strip()
+        if example_output or special_instruction:
+          end_index = curr_gpt_response.rfind("}") + 1
+          curr_gpt_response = curr_gpt_response[:end_index]
+          curr_gpt_response = json.loads(curr_gpt_response)["output"]
+
+        if func_validate(curr_gpt_response, prompt=prompt):
+          return curr_gpt_response, func_clean_up(curr_gpt_response, prompt=prompt)
+
+      except LLMCacheMiss:
+        raise
+      except Exception as e:
+        print("Error:", e, flush=True)
+        traceback.print_exc()
+
+  print("Error: Fail safe triggered.", flush=True)
+  return fail_safe_response
+
+
+async def ChatGPT_safe_generate_structured_response(
+  prompt,
+  response_format,
+  example_output="",
+  special_instruction="",
+  repeat=3,
+  fail_safe_response="error",
+  func_validate=None,
+  func_clean_up=None,
+  verbose=False,
+):
+  if func_validate and func_clean_up:
+    prompt = '"""\n' + prompt + '\n"""\n'
+    if example_output or special_instruction:
+      prompt += (
+        f"Output the response to the prompt above in json. {special_instruction}\n"
+      )
+      if example_output:
+        prompt += "Example output json:\n"
+        prompt += str(example_output)
+
+    if verbose:
+      print("--- async ChatGPT_safe_generate_structured_response() ---")
+      print("LLM PROMPT")
+      print(prompt, flush=True)
+
+    for i in range(repeat):
+      print("Attempt", i + 1, flush=True)
+
+      try:
+        curr_gpt_response = await ChatGPT_structured_request(
+          prompt, response_format, refresh=i > 0
+        )
+        if not curr_gpt_response:
+          raise ValueError("Error: No valid response from LLM.")
+
+        if (
+          not isinstance(curr_gpt_response, str)
+          and func_validate(curr_gpt_response, prompt=prompt)
+        ):
+          return func_clean_up(curr_gpt_response, prompt=prompt)
+        else:
+          print("Error: Response validation failed. Response:")
+          print(curr_gpt_response, flush=True)
+
+      except LLMCacheMiss:
+        raise
+      except Exception as e:
+        print("Error:", e, flush=True)
+        traceback.print_exc()
+
+  print("Error: Fail safe triggered.", flush=True)
+  return fail_safe_response
+
+
+@coalesce
+async def GPT_request(prompt, gpt_parameter, refresh=False):
+  """
+  Async version of gpt_structure.GPT_request, without the fixed sleep before
+  every call; the concurrency limits take care of pacing instead.
+  ARGS:
+    prompt: a str prompt
+    gpt_parameter: a python dictionary with the keys indicating the names of
+                   the parameter and the values indicating the parameter
+                   values.
+  RETURNS:
+    a str of the LLM's response, or "REQUEST ERROR".
+  """
+  cache_key, hit, content = await asyncio.to_thread(
+    cache_lookup,
+    refresh=refresh,
+    kind="gpt",
+    model=gpt_parameter["engine"] if use_openai else model,
+    prompt=prompt,
+    params=gpt_parameter,
+  )
+  if hit:
+    print("Response (cached): ", content, flush=True)
+    return content
+
+  state = _state()
+  try:
+    if use_openai:
+      messages = [{
+        "role": "system", "content": prompt
+      }]
+      async with _limited(state, gpt_parameter["engine"]):
+        response = await state.client.chat.completions.create(
+          model=gpt_parameter["engine"],
+          messages=messages,
+          temperature=gpt_parameter["temperature"],
+          max_tokens=gpt_parameter["max_tokens"],
+          top_p=gpt_parameter["top_p"],
+          frequency_penalty=gpt_parameter["frequency_penalty"],
+          presence_penalty=gpt_parameter["presence_penalty"],
+          stream=gpt_parameter["stream"],
+          stop=gpt_parameter["stop"],
+        )
+    else:
+      async with _limited(state, model):
+        response = await state.client.completions.create(model=model, prompt=prompt)
+    profiler.count_llm(response)
+
+    print("Response: ", response, flush=True)
+    content = response.choices[0].message.content
+    if content:
+      await asyncio.to_thread(cache_store, cache_key, content)
+    return content
+
+  except Exception as e:
+    print("Error:", e, flush=True)
+    traceback.print_exc()
+    return "REQUEST ERROR"
+
+
+@coalesce
+async def GPT_structured_request(prompt, gpt_parameter, response_format, refresh=False):
+  """
+  Async version of gpt_structure.GPT_structured_request, without the fixed
+  sleep before every call.
+  ARGS:
+    prompt: a str prompt
+    gpt_parameter: a python dictionary with the keys indicating the names of
+                   the parameter and the values indicating the parameter
+                   values.
+    response_format: a Pydantic model that defines the desired response format.
+  RETURNS:
+    the parsed response, or "REQUEST ERROR".
+  """
+  cache_key, hit, parsed = await asyncio.to_thread(
+    cache_lookup,
+    refresh=refresh,
+    kind="gpt-structured",
+    model=gpt_parameter["engine"] if use_openai else model,
+    prompt=prompt,
+    params=gpt_parameter,
+    response_format=response_format,
+  )
+  if hit:
+    print("Response (cached): ", parsed, flush=True)
+    return response_format.model_validate(parsed)
+
+  state = _state()
+  try:
+    if use_openai:
+      messages = [{
+        "role": "system", "content": prompt
+      }]
+      async with _limited(state, gpt_parameter["engine"]):
+        response = await state.client.beta.chat.completions.parse(
+          model=gpt_parameter["engine"],
+          messages=messages,
+          response_format=response_format,
+          temperature=gpt_parameter["temperature"],
+          max_tokens=gpt_parameter["max_tokens"],
+          top_p=gpt_parameter["top_p"],
+          frequency_penalty=gpt_parameter["frequency_penalty"],
+          presence_penalty=gpt_parameter["presence_penalty"],
+          stop=gpt_parameter["stop"],
+        )
+    else:
+      async with _limited(state, model):
+        response = await state.client.completions.create(model=model, prompt=prompt)
+    profiler.count_llm(response)
+
+    print("Response: ", response, flush=True)
+    message = response.choices[0].message
+
+    if message.parsed:
+      await asyncio.to_thread(
+        cache_store, cache_key, message.parsed.model_dump(mode="json")
+      )
+      return message.parsed
+    if message.refusal:
+      raise ValueError("Request refused: " + message.refusal)
+    raise ValueError("No parsed content or refusal found.")
+  except Exception as e:
+    print("Error:", e, flush=True)
+    traceback.print_exc()
+    return "REQUEST ERROR"
+
+
+async def safe_generate_response(prompt,
+                                 gpt_parameter,
+                                 repeat=5,
+                                 fail_safe_response="error",
+                                 func_validate=None,
+                                 func_clean_up=None,
+                                 verbose=False):
+  if verbose:
+    print("--- async safe_generate_response() ---")
+    print("prompt:", prompt, flush=True)
+
+  if func_validate and func_clean_up:
+    for i in range(repeat):
+      print("Attempt", i + 1, flush=True)
+      curr_gpt_response = await GPT_request(prompt, gpt_parameter,
+                                                  refresh=i > 0)
+
+      try:
+        if func_validate(curr_gpt_response, prompt=prompt):
+          return func_clean_up(curr_gpt_response, prompt=prompt)
+        else:
+          print("Error: Response validation failed. Response:")
+          print(curr_gpt_response, flush=True)
+      except Exception as e:
+        print("Could not process response. Error:", e, flush=True)
+        traceback.print_exc()
+
+  print("Error: Fail safe triggered.", flush=True)
+  return fail_safe_response
+
+
+async def safe_generate_structured_response(
+  prompt,
+  gpt_parameter,
+  response_format,
+  repeat=5,
+  fail_safe_response="error",
+  func_validate=None,
+  func_clean_up=None,
+  verbose=False
+):
+  if verbose:
+    print("--- async safe_generate_structured_response() ---")
+    print("prompt:", prompt, flush=True)
+
+  if func_validate and func_clean_up:
+    for i in range(repeat):
+      print("Attempt", i + 1, flush=True)
+      curr_gpt_response = await GPT_structured_request(
+        prompt, gpt_parameter, response_format, refresh=i > 0
+      )
+
+      try:
+        if not isinstance(curr_gpt_response, str) and func_validate(
+          curr_gpt_response,
+          prompt=prompt
+        ):
+          return func_clean_up(curr_gpt_response, prompt=prompt)
+        print("Error: Response validation failed. Response:")
+        print(curr_gpt_response, flush=True)
+      except Exception as e:
+        print("Could not process response. Error:", e, flush=True)
+        traceback.print_exc()
+
+  print("Error: Fail safe triggered.", flush=True)
+  return fail_safe_response
+
+
+async def get_embedding(text, model=openai_config["embeddings"]):
+  return (await get_embeddings([text], model=model))[0]
+
+
+async def get_embeddings(texts, model=openai_config["embeddings"]):
+  """
+  Async version of gpt_structure.get_embeddings. The batches are sent
+  concurrently, within the concurrency limits.
+  ARGS:
+    texts: a list of str.
+    model: the embeddings model.
+  RETURNS:
+    a list with the embedding of every text, in the same order as <texts>.
+  """
+  texts = [prepare_embedding_input(text) for text in texts]
+  embeddings, missing, cache_keys = await asyncio.to_thread(
+    lookup_embeddings, texts, model
+  )
+
+  state = _state()
+  # The texts that another task is embedding already are waited for.
+  leading, waiting = claim_embeddings(state.single_flight, missing, model)
+  missing = list(leading)
+
+  def store_batch(fetched):
+    for text, embedding in fetched.items():
+      cache_store(cache_keys[text], embedding)
+
+  async def embed_batch(batch):
+    async with _limited(state, model):
+      response = await state.embeddings_client.embeddings.create(
+        input=batch, model=model
+      )
+    profiler.count_embeddings(response, len(batch))
+    cost_logger.update_cost(response=response, input_cost=openai_config["embeddings-costs"]["input"], output_cost=openai_config["embeddings-costs"]["output"])
+    fetched = dict()
+    for item in response.data:
+      fetched[batch[item.index]] = item.embedding
+    embeddings.update(fetched)
+    await asyncio.to_thread(store_batch, fetched)
+
+  try:
+    await asyncio.gather(*[
+      embed_batch(missing[start:start + embeddings_batch_size])
+      for start in range(0, len(missing), embeddings_batch_size)
+    ])
+  except BaseException as e:
+    resolve_embeddings(state.single_flight, leading, embeddings, e)
+    raise
+  resolve_embeddings(state.single_flight, leading, embeddings)
+
+  for text, (key, flight) in waiting.items():
+    try:
+      embeddings[text] = await state.single_flight.wait(flight)
+    except asyncio.CancelledError:
+      if not flight.cancelled():
+        raise
+      # The task embedding the text was cancelled, not this one.
+      embeddings[text] = (await get_embeddings([text], model))[0]
+
+  return await asyncio.to_thread(
+    finish_embeddings, texts, embeddings, model, leading
+  )
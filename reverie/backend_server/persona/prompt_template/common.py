@@ -53,3 +53,7 @@ class StatementsSummary(BaseModel):
 
 class Poignancy(BaseModel):
   poignancy: int
+
+
+class PoignancyList(BaseModel):
+  poignancies: list[int]
@@ -0,0 +1,182 @@
+"""
+File: embedding_store.py
+Description: Content-addressed embedding store shared by all personas and
+simulations.
+
+Embeddings are keyed on (model, sha256 of the text). Every model gets its own
+directory holding three files:
+  meta.json   -- the model name and the embedding dimension.
+  vectors.f32 -- the embeddings as consecutive float32 rows.
+  index.bin   -- fixed-size records (16-byte text digest, uint32 row) mapping
+                 texts to rows of vectors.f32.
+Both data files are append-only. The vectors are read through a numpy memmap
+and the index is kept in memory, picking up rows appended by other processes
+when a lookup misses. Writers serialize on a lock file, and append the vectors
+before the index records, so a reader never sees a record whose row has not
+been written yet.
+"""
+
+import hashlib
+import json
+import re
+import struct
+import threading
+from pathlib import Path
+
+import numpy as np
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+INDEX_RECORD = struct.Struct("<16sI")
+
+
+def text_digest(text):
+  return hashlib.sha256(text.encode("utf-8")).digest()[:16]
+
+
+class _ModelStore:
+  def __init__(self, path, model):
+    self.path = path
+    self.model = model
+    self.vectors_path = path / "vectors.f32"
+    self.index_path = path / "index.bin"
+    self.meta_path = path / "meta.json"
+    self.lock_path = path / ".lock"
+
+    self.dim = None
+    self.rows = dict()
+    self.index_offset = 0
+    self.vectors = None
+
+  def _read_meta(self):
+    if self.dim is None and self.meta_path.exists():
+      with open(self.meta_path, "r") as f:
+        self.dim = json.load(f)["dim"]
+
+  def _sync_index(self):
+    """Reads the index records appended since the last sync."""
+    try:
+      size = self.index_path.stat().st_size
+    except OSError:
+      return
+    size -= size % INDEX_RECORD.size
+    if size <= self.index_offset:
+      return
+    with open(self.index_path, "rb") as f:
+      f.seek(self.index_offset)
+      data = f.read(size - self.index_offset)
+    for digest, row in INDEX_RECORD.iter_unpack(data):
+      self.rows[digest] = row
+    self.index_offset = size
+
+  def _map_vectors(self, n_rows):
+    """Makes sure the memmap covers at least <n_rows> rows."""
+    if self.vectors is not None and len(self.vectors) >= n_rows:
+      return
+    size = self.vectors_path.stat().st_size // (4 * self.dim)
+    self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                             shape=(size, self.dim))
+
+  def get(self, digests):
+    """Returns {digest: embedding} for the digests that are in the store."""
+    if any(digest not in self.rows for digest in digests):
+      self._read_meta()
+      self._sync_index()
+    found = [(d, self.rows[d]) for d in digests if d in self.rows]
+    if not found:
+      return dict()
+    self._map_vectors(max(row for _, row in found) + 1)
+    return {d: self.vectors[row].tolist() for d, row in found}
+
+  def put(self, digests, embeddings):
+    if all(digest in self.rows for digest in digests):
+      return
+    self.path.mkdir(parents=True, exist_ok=True)
+    with open(self.lock_path, "a") as lock_file:
+      if fcntl:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+      try:
+        self._read_meta()
+        if self.dim is None:
+          self.dim = len(embeddings[0])
+          with open(self.meta_path, "w") as f:
+            json.dump({"model": self.model, "dim": self.dim}, f)
+        self._sync_index()
+
+        new = dict()
+        for digest, embedding in zip(digests, embeddings):
+          if digest not in self.rows and len(embedding) == self.dim:
+            new[digest] = embedding
+        if not new:
+          return
+
+        with open(self.vectors_path, "ab") as f:
+          # A writer that died mid-append may have left a partial row; it is
+          # cut off so that the new rows start where their index says.
+          row_size = 4 * self.dim
+          first_row = f.tell() // row_size
+          if f.tell() != first_row * row_size:
+            f.truncate(first_row * row_size)
+            f.seek(first_row * row_size)
+          f.write(np.asarray(list(new.values()), dtype=np.float32).tobytes())
+        records = b"".join(
+          INDEX_RECORD.pack(digest, first_row + count)
+          for count, digest in enumerate(new)
+        )
+        with open(self.index_path, "ab") as f:
+          f.write(records)
+      finally:
+        if fcntl:
+          fcntl.flock(lock_file, fcntl.LOCK_UN)
+    self._sync_index()
+
+
+class EmbeddingStore:
+  def __init__(self, path):
+    """
+    ARGS:
+      path: the directory holding one sub-directory per embeddings model.
+    """
+    self.path = Path(path)
+    self.lock = threading.Lock()
+    self.models = dict()
+
+  def _model_store(self, model):
+    if model not in self.models:
+      # The directory name stays readable, with a hash of the full model name
+      # so that names differing only in punctuation do not collide.
+      slug = re.sub(r"[^A-Za-z0-9._-]+", "_", model)
+      digest = hashlib.sha256(model.encode("utf-8")).hexdigest()[:8]
+      self.models[model] = _ModelStore(self.path / f"{slug}-{digest}", model)
+    return self.models[model]
+
+  def get_many(self, texts, model):
+    """
+    ARGS:
+      texts: a list of str.
+      model: the embeddings model.
+    RETURNS:
+      a dictionary from each of the <texts> found in the store to its
+      embedding (a list of floats).
+    """
+    digests = {text: text_digest(text) for text in texts}
+    with self.lock:
+      found = self._model_store(model).get(list(digests.values()))
+    return {text: found[d] for text, d in digests.items() if d in found}
+
+  def put_many(self, embeddings, model):
+    """
+    Adds the embeddings of a dictionary from text to embedding. Texts that are
+    already in the store are left untouched.
+    """
+    if not embeddings:
+      return
+    texts = list(embeddings.keys())
+    with self.lock:
+      self._model_store(model).put(
+        [text_digest(text) for text in texts],
+        [embeddings[text] for text in texts],
+      )
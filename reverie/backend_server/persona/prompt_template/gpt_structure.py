@@ -5,6 +5,7 @@ File: gpt_structure.py
 Description: Wrapper functions for calling OpenAI APIs.
 """
 
+import functools
 import json
 from pathlib import Path
 import time
@@ -13,6 +14,11 @@ from openai import AzureOpenAI, OpenAI
 from utils import openai_api_key, use_openai, api_model
 from openai_cost_logger import DEFAULT_LOG_PATH
 from persona.prompt_template.openai_logger_singleton import OpenAICostLogger_Singleton
+from persona.prompt_template.llm_cache import LLMCache, LLMCacheMiss
+from persona.prompt_template.embedding_store import EmbeddingStore
+from persona.prompt_template.single_flight import SingleFlight
+from profiler import profiler
+from stub_llm_server import stub_endpoint
 
 config_path = Path("../../openai_config.json")
 with open(config_path, "r") as f:
@@ -63,7 +69,8 @@ def setup_client(type: str, config: dict):
   """Setup the OpenAI client.
 
   Args:
-      type (str): the type of client. Either "azure" or "openai".
+      type (str): the type of client. Either "azure", "openai" or "stub"
+        (the offline server in stub_llm_server.py).
       config (dict): the configuration for the client.
 
   Raises:
@@ -82,6 +89,11 @@ def setup_client(type: str, config: dict):
     client = OpenAI(
       api_key=config["key"],
     )
+  elif type == "stub":
+    client = OpenAI(
+      base_url=config["endpoint"],
+      api_key=config.get("key") or "stub",
+    )
   else:
     raise ValueError("Invalid client")
   return client
@@ -94,6 +106,11 @@ if openai_config["client"] == "azure":
   })
 elif openai_config["client"] == "openai":
   client = setup_client("openai", { "key": openai_config["model-key"] })
+elif openai_config["client"] == "stub":
+  client = setup_client("stub", {
+    "endpoint": openai_config.get("model-endpoint", stub_endpoint(openai_config)),
+    "key": openai_config.get("model-key"),
+  })
 
 if openai_config["embeddings-client"] == "azure":  
   embeddings_client = setup_client("azure", {
@@ -103,6 +120,12 @@ if openai_config["embeddings-client"] == "azure":
   })
 elif openai_config["embeddings-client"] == "openai":
   embeddings_client = setup_client("openai", { "key": openai_config["embeddings-key"] })
+elif openai_config["embeddings-client"] == "stub":
+  embeddings_client = setup_client("stub", {
+    "endpoint": openai_config.get("embeddings-endpoint",
+                                  stub_endpoint(openai_config)),
+    "key": openai_config.get("embeddings-key"),
+  })
 else:
   raise ValueError("Invalid embeddings client")
 
@@ -112,24 +135,118 @@ cost_logger = OpenAICostLogger_Singleton(
   cost_upperbound = openai_config["cost-upperbound"]
 )
 
+# Maximum number of inputs sent in a single embeddings request.
+embeddings_batch_size = max(1, int(openai_config.get("embeddings-batch-size", 2048)))
+
+# The responses of the stub server are stored apart from those of the real
+# models, so that they never stand in for them.
+uses_stub = "stub" in (openai_config["client"], openai_config["embeddings-client"])
+stub_suffix = "_stub" if uses_stub else ""
+
+# Embedding store shared by all personas and simulations, consulted before the
+# LLM cache and the API.
+embedding_store_config = openai_config.get("embedding-store", {})
+embedding_store = None
+if embedding_store_config.get("enabled", True):
+  embedding_store = EmbeddingStore(embedding_store_config.get(
+    "path", f"../../environment/frontend_server/embedding_store{stub_suffix}"
+  ))
+
+llm_cache_config = openai_config.get("llm-cache", {})
+llm_cache = LLMCache(
+  path=llm_cache_config.get("path", f"../../llm_cache{stub_suffix}"),
+  mode=llm_cache_config.get("mode", "off"),
+  max_size_mb=llm_cache_config.get("max-size-mb", 1024),
+  on_lookup=cost_logger.update_cache,
+)
+
+
+def cache_lookup(refresh=False, **request):
+  """
+  Looks up a request in the LLM response cache.
+  ARGS:
+    refresh: in record mode, skip the lookup so that the request is sent
+             again and its new response replaces the stored one. The
+             safe_generate_* functions set it when they retry a response that
+             did not validate, which would otherwise come back from the cache.
+    request: everything that determines the response (model, prompt, schema,
+             sampling parameters).
+  RETURNS:
+    a (key, hit, value) tuple. The key is None when the cache is off.
+  """
+  if not llm_cache.enabled:
+    return None, False, None
+  key = llm_cache.key(**request)
+  if refresh and llm_cache.mode == "record":
+    return key, False, None
+  hit, value = llm_cache.get(key)
+  if hit:
+    profiler.count(cache_hits=1)
+  return key, hit, value
+
+
+def cache_store(key, value):
+  if key is not None:
+    llm_cache.put(key, value)
+
+
+def count_coalesced(key):
+  """Counts a call that was served by an identical request in flight."""
+  cost_logger.update_coalesced()
+  profiler.count(coalesced=1)
+
+
+# Identical requests made at the same time (e.g., by personas running
+# concurrently) are only sent once. See single_flight.py.
+single_flight = None
+if openai_config.get("single-flight", True):
+  single_flight = SingleFlight(on_coalesce=count_coalesced)
+
+
+def coalesce(function):
+  """
+  Decorates a request function so that concurrent calls with the same
+  arguments make a single request, whose result they all get. The calls are
+  keyed like the LLM cache keys requests.
+  """
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    if single_flight is None:
+      return function(*args, **kwargs)
+    key = LLMCache.key(function=function.__name__, args=args, kwargs=kwargs)
+    return single_flight.do(key, lambda: function(*args, **kwargs))
+  return wrapper
+
 
 def temp_sleep(seconds=0.1):
   time.sleep(seconds)
 
 
-def ChatGPT_single_request(prompt):
-  temp_sleep()
-
+@coalesce
+def ChatGPT_single_request(prompt, refresh=False):
   print("--- ChatGPT_single_request() ---")
   print("Prompt:", prompt, flush=True)
 
-  completion = client.chat.completions.create(
+  cache_key, hit, content = cache_lookup(
+    refresh=refresh,
+    kind="chat",
     model=openai_config["model"],
-    messages=[{"role": "user", "content": prompt}],
+    prompt=prompt,
   )
+  if hit:
+    print("Response content (cached):", content, flush=True)
+  else:
+    temp_sleep()
+    completion = client.chat.completions.create(
+      model=openai_config["model"],
+      messages=[{"role": "user", "content": prompt}],
+    )
+    profiler.count_llm(completion)
 
-  content = completion.choices[0].message.content
-  print("Response content:", content, flush=True)
+    content = completion.choices[0].message.content
+    print("Response content:", content, flush=True)
+    if content:
+      cache_store(cache_key, content)
 
   if content:
     content = content.strip("`").removeprefix("json").strip()
@@ -156,7 +273,8 @@ def ChatGPT_single_request(prompt):
   # return response
 
 
-def ChatGPT_request(prompt):
+@coalesce
+def ChatGPT_request(prompt, refresh=False):
   """
   Given a prompt and a dictionary of GPT parameters, make a request to OpenAI
   server and returns the response. 
@@ -172,17 +290,29 @@ def ChatGPT_request(prompt):
   print("--- ChatGPT_request() ---")
   print("Prompt:", prompt, flush=True)
 
+  cache_key, hit, content = cache_lookup(
+    refresh=refresh,
+    kind="chat",
+    model=openai_config["model"],
+    prompt=prompt,
+  )
+  if hit:
+    print("Response content (cached):", content, flush=True)
+    return content.strip("`").removeprefix("json").strip()
+
   try: 
     completion = client.chat.completions.create(
       model=openai_config["model"],
       messages=[{"role": "user", "content": prompt}]
     )
+    profiler.count_llm(completion)
     content = completion.choices[0].message.content
     print("Response content:", content, flush=True)
     cost_logger.update_cost(
       completion, input_cost=openai_config["model-costs"]["input"], output_cost=openai_config["model-costs"]["output"]
     )
     if content:
+      cache_store(cache_key, content)
       content = content.strip("`").removeprefix("json").strip()
     return content
   
@@ -191,7 +321,8 @@ def ChatGPT_request(prompt):
     traceback.print_exc()
     return "LLM ERROR"
 
-def ChatGPT_structured_request(prompt, response_format):
+@coalesce
+def ChatGPT_structured_request(prompt, response_format, refresh=False):
   """
   Given a prompt and a dictionary of GPT parameters, make a request to OpenAI
   server and returns the response. 
@@ -207,12 +338,24 @@ def ChatGPT_structured_request(prompt, response_format):
   print("--- ChatGPT_structured_request() ---")
   print("Prompt:", prompt, flush=True)
 
+  cache_key, hit, parsed = cache_lookup(
+    refresh=refresh,
+    kind="chat-structured",
+    model=openai_config["model"],
+    prompt=prompt,
+    response_format=response_format,
+  )
+  if hit:
+    print("Response (cached):", parsed, flush=True)
+    return response_format.model_validate(parsed)
+
   try: 
     completion = client.beta.chat.completions.parse(
       model=openai_config["model"],
       response_format=response_format,
       messages=[{"role": "user", "content": prompt}]
     )
+    profiler.count_llm(completion)
 
     print("Response:", completion, flush=True)
     message = completion.choices[0].message
@@ -224,6 +367,7 @@ def ChatGPT_structured_request(prompt, response_format):
     )
 
     if message.parsed:
+      cache_store(cache_key, message.parsed.model_dump(mode="json"))
       return message.parsed
     if message.refusal:
       raise ValueError("Request refused: " + message.refusal)
@@ -306,7 +450,7 @@ def ChatGPT_safe_generate_response(
       print("Attempt", i + 1, flush=True)
 
       try:
-        chatgpt_response = ChatGPT_request(prompt)
+        chatgpt_response = ChatGPT_request(prompt, refresh=i > 0)
         if not chatgpt_response:
           raise Exception("Error: No valid response from LLM.")
         curr_gpt_response = chatgpt_response.strip()
@@ -318,6 +462,8 @@ def ChatGPT_safe_generate_response(
         if func_validate(curr_gpt_response, prompt=prompt):
           return curr_gpt_response, func_clean_up(curr_gpt_response, prompt=prompt)
 
+      except LLMCacheMiss:
+        raise
       except Exception as e:
         print("Error:", e, flush=True)
         traceback.print_exc()
@@ -357,7 +503,9 @@ def ChatGPT_safe_generate_structured_response(
       print("Attempt", i + 1, flush=True)
 
       try:
-        curr_gpt_response = ChatGPT_structured_request(prompt, response_format)
+        curr_gpt_response = ChatGPT_structured_request(
+          prompt, response_format, refresh=i > 0
+        )
         if not curr_gpt_response:
           raise ValueError("Error: No valid response from LLM.")
 
@@ -370,6 +518,8 @@ def ChatGPT_safe_generate_structured_response(
           print("Error: Response validation failed. Response:")
           print(curr_gpt_response, flush=True)
 
+      except LLMCacheMiss:
+        raise
       except Exception as e:
         print("Error:", e, flush=True)
         traceback.print_exc()
@@ -381,7 +531,8 @@ def ChatGPT_safe_generate_structured_response(
 # ============================================================================
 # ###################[SECTION 2: ORIGINAL GPT-3 STRUCTURE] ###################
 # ============================================================================
-def GPT_request(prompt, gpt_parameter):
+@coalesce
+def GPT_request(prompt, gpt_parameter, refresh=False):
   """
   Given a prompt and a dictionary of GPT parameters, make a request to OpenAI
   server and returns the response. 
@@ -393,6 +544,17 @@ def GPT_request(prompt, gpt_parameter):
   RETURNS: 
     a str of GPT-3's response. 
   """
+  cache_key, hit, content = cache_lookup(
+    refresh=refresh,
+    kind="gpt",
+    model=gpt_parameter["engine"] if use_openai else model,
+    prompt=prompt,
+    params=gpt_parameter,
+  )
+  if hit:
+    print("Response (cached): ", content, flush=True)
+    return content
+
   temp_sleep()
 
   try:
@@ -413,9 +575,12 @@ def GPT_request(prompt, gpt_parameter):
               )
     else:
       response = client.completions.create(model=model, prompt=prompt)
+    profiler.count_llm(response)
 
     print("Response: ", response, flush=True)
     content = response.choices[0].message.content
+    if content:
+      cache_store(cache_key, content)
     return content
 
   except Exception as e:
@@ -424,7 +589,8 @@ def GPT_request(prompt, gpt_parameter):
     return "REQUEST ERROR"
 
 
-def GPT_structured_request(prompt, gpt_parameter, response_format):
+@coalesce
+def GPT_structured_request(prompt, gpt_parameter, response_format, refresh=False):
   """
   Given a prompt, a dictionary of GPT parameters, and a response format, make a request to OpenAI
   server and returns the response.
@@ -437,6 +603,18 @@ def GPT_structured_request(prompt, gpt_parameter, response_format):
   RETURNS:
     a str of GPT-3's response.
   """
+  cache_key, hit, parsed = cache_lookup(
+    refresh=refresh,
+    kind="gpt-structured",
+    model=gpt_parameter["engine"] if use_openai else model,
+    prompt=prompt,
+    params=gpt_parameter,
+    response_format=response_format,
+  )
+  if hit:
+    print("Response (cached): ", parsed, flush=True)
+    return response_format.model_validate(parsed)
+
   temp_sleep()
 
   try:
@@ -458,11 +636,13 @@ def GPT_structured_request(prompt, gpt_parameter, response_format):
       )
     else:
       response = client.completions.create(model=model, prompt=prompt)
+    profiler.count_llm(response)
 
     print("Response: ", response, flush=True)
     message = response.choices[0].message
 
     if message.parsed:
+      cache_store(cache_key, message.parsed.model_dump(mode="json"))
       return message.parsed
     if message.refusal:
       raise ValueError("Request refused: " + message.refusal)
@@ -523,7 +703,8 @@ def safe_generate_response(prompt,
   if func_validate and func_clean_up:
     for i in range(repeat):
       print("Attempt", i + 1, flush=True)
-      curr_gpt_response = GPT_request(prompt, gpt_parameter)
+      curr_gpt_response = GPT_request(prompt, gpt_parameter,
+                                            refresh=i > 0)
 
       try:
         if func_validate(curr_gpt_response, prompt=prompt):
@@ -556,7 +737,9 @@ def safe_generate_structured_response(
   if func_validate and func_clean_up:
     for i in range(repeat):
       print("Attempt", i + 1, flush=True)
-      curr_gpt_response = GPT_structured_request(prompt, gpt_parameter, response_format)
+      curr_gpt_response = GPT_structured_request(
+        prompt, gpt_parameter, response_format, refresh=i > 0
+      )
 
       try:
         if not isinstance(curr_gpt_response, str) and func_validate(
@@ -575,12 +758,137 @@ def safe_generate_structured_response(
 
 
 def get_embedding(text, model=openai_config["embeddings"]):
+  return get_embeddings([text], model=model)[0]
+
+
+def prepare_embedding_input(text):
   text = text.replace("\n", " ")
   if not text:
     text = "this is blank"
-  response = embeddings_client.embeddings.create(input=[text], model=model)
-  cost_logger.update_cost(response=response, input_cost=openai_config["embeddings-costs"]["input"], output_cost=openai_config["embeddings-costs"]["output"])
-  return response.data[0].embedding
+  return text
+
+
+def lookup_embeddings(texts, model):
+  """
+  Looks up the embeddings of <texts> in the embedding store, then in the LLM
+  cache.
+  ARGS:
+    texts: a list of str, already passed through prepare_embedding_input.
+    model: the embeddings model.
+  RETURNS:
+    a tuple (embeddings, missing, cache_keys): a dictionary of the embeddings
+    found, the list of distinct texts that still have to be embedded, and the
+    cache key of each of them.
+  """
+  unique = list(dict.fromkeys(texts))
+  embeddings = dict()
+  if embedding_store:
+    embeddings.update(embedding_store.get_many(unique, model))
+
+  missing = []
+  cache_keys = dict()
+  for text in unique:
+    if text in embeddings:
+      continue
+    cache_key, hit, embedding = cache_lookup(
+      kind="embedding", model=model, text=text
+    )
+    if hit:
+      embeddings[text] = embedding
+    else:
+      missing += [text]
+      cache_keys[text] = cache_key
+  return embeddings, missing, cache_keys
+
+
+def claim_embeddings(flights, texts, model):
+  """
+  Claims the embedding of every text in <texts> with <flights> (a
+  SingleFlight or an AsyncSingleFlight, or None).
+  RETURNS:
+    a tuple (leading, waiting) of {text: (key, flight)} dictionaries: the
+    texts the caller has to embed (with None claims if <flights> is None),
+    and the texts another caller is embedding already.
+  """
+  if flights is None:
+    return dict.fromkeys(texts), dict()
+  leading = dict()
+  waiting = dict()
+  for text in texts:
+    key = LLMCache.key(kind="embedding", model=model, text=text)
+    flight, leader = flights.claim(key)
+    if leader:
+      leading[text] = (key, flight)
+    else:
+      waiting[text] = (key, flight)
+  return leading, waiting
+
+
+def resolve_embeddings(flights, leading, embeddings, error=None):
+  """
+  Hands the embeddings of the texts claimed in <leading> to the callers
+  waiting for them, or <error> for the texts that could not be embedded.
+  """
+  for text, claim in leading.items():
+    if claim is None:
+      continue
+    key, flight = claim
+    if text in embeddings:
+      flights.resolve(key, flight, embeddings[text])
+    else:
+      flights.resolve(key, flight, error=error or RuntimeError(
+        f"No embedding returned for {text!r}"))
+
+
+def finish_embeddings(texts, embeddings, model, fetched):
+  """
+  Adds the embeddings of the <fetched> texts (the ones this call embedded) to
+  the embedding store and returns the embedding of every text in <texts>, in
+  order.
+  """
+  if embedding_store:
+    embedding_store.put_many(
+      {text: embeddings[text] for text in fetched if text in embeddings}, model
+    )
+  return [embeddings[text] for text in texts]
+
+
+def get_embeddings(texts, model=openai_config["embeddings"]):
+  """
+  Embeds a list of texts with as few requests as possible. Identical texts are
+  embedded once, and the texts missing from the embedding store and the cache
+  are sent in batches of up to "embeddings-batch-size" inputs per request.
+  ARGS:
+    texts: a list of str.
+    model: the embeddings model.
+  RETURNS:
+    a list with the embedding of every text, in the same order as <texts>.
+  """
+  texts = [prepare_embedding_input(text) for text in texts]
+  embeddings, missing, cache_keys = lookup_embeddings(texts, model)
+  # The texts that another thread is embedding already are waited for.
+  leading, waiting = claim_embeddings(single_flight, missing, model)
+  missing = list(leading)
+
+  try:
+    for start in range(0, len(missing), embeddings_batch_size):
+      batch = missing[start:start + embeddings_batch_size]
+      response = embeddings_client.embeddings.create(input=batch, model=model)
+      profiler.count_embeddings(response, len(batch))
+      cost_logger.update_cost(response=response, input_cost=openai_config["embeddings-costs"]["input"], output_cost=openai_config["embeddings-costs"]["output"])
+      for item in response.data:
+        text = batch[item.index]
+        embeddings[text] = item.embedding
+        cache_store(cache_keys[text], item.embedding)
+  except BaseException as e:
+    resolve_embeddings(single_flight, leading, embeddings, e)
+    raise
+  resolve_embeddings(single_flight, leading, embeddings)
+
+  for text, (key, flight) in waiting.items():
+    embeddings[text] = single_flight.wait(flight)
+
+  return finish_embeddings(texts, embeddings, model, leading)
 
 # def get_embedding(documents):
 #   api_url = "http://<instance-ip>:8000/embed"
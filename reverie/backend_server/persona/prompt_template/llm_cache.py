@@ -0,0 +1,149 @@
+"""
+File: llm_cache.py
+Description: Content-addressed on-disk cache for LLM and embedding responses.
+
+Every entry is stored under the sha256 of the request that produced it: the
+model, the rendered prompt, the response_format schema (for structured
+outputs) and the sampling parameters. Entries live in 256 shard directories
+named after the first two hex digits of the key, one JSON file per entry.
+
+The cache runs in one of three modes:
+  "off"    -- the cache is never read nor written.
+  "record" -- hits are served from disk, misses go to the model and the
+              response is stored.
+  "replay" -- hits are served from disk, misses raise LLMCacheMiss. A whole
+              simulation can then be rerun offline and deterministically.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+CACHE_MODES = ("off", "record", "replay")
+
+
+class LLMCacheMiss(Exception):
+  """Raised in replay mode when a request has no recorded response."""
+
+
+class LLMCache:
+  def __init__(self, path, mode="off", max_size_mb=1024, on_lookup=None):
+    """
+    ARGS:
+      path: the directory holding the cache entries.
+      mode: one of CACHE_MODES.
+      max_size_mb: once the entries take more than this many megabytes, the
+                   least recently used ones are evicted. 0 disables eviction.
+      on_lookup: optional callable, called with True on a hit and False on a
+                 miss (used to report hit/miss counters to the cost logger).
+    """
+    if mode not in CACHE_MODES:
+      raise ValueError(f"Invalid LLM cache mode: {mode}")
+    self.path = Path(path)
+    self.mode = mode
+    self.max_size = int(max_size_mb * 1024 * 1024)
+    self.on_lookup = on_lookup
+    self.lock = threading.Lock()
+    # Total size of the entries on disk, computed on the first write.
+    self.size = None
+
+  @property
+  def enabled(self):
+    return self.mode != "off"
+
+  @staticmethod
+  def key(**request):
+    """
+    Returns the content address of a request. All keyword arguments take part
+    in the key; pydantic model classes are replaced by their JSON schema.
+    """
+    def default(obj):
+      if hasattr(obj, "model_json_schema"):
+        return obj.model_json_schema()
+      return repr(obj)
+    blob = json.dumps(request, sort_keys=True, default=default)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+  def _entry_path(self, key):
+    return self.path / key[:2] / f"{key}.json"
+
+  def get(self, key):
+    """
+    Looks up <key>.
+    RETURNS:
+      a (hit, value) tuple. In replay mode a miss raises LLMCacheMiss.
+    """
+    entry_path = self._entry_path(key)
+    try:
+      with open(entry_path, "r") as f:
+        value = json.load(f)["value"]
+    except (OSError, ValueError, KeyError):
+      if self.on_lookup:
+        self.on_lookup(False)
+      if self.mode == "replay":
+        raise LLMCacheMiss(f"No recorded LLM response for request {key}")
+      return False, None
+
+    try:
+      # Bump the mtime so that eviction drops the least recently used entries.
+      os.utime(entry_path)
+    except OSError:
+      pass
+    if self.on_lookup:
+      self.on_lookup(True)
+    return True, value
+
+  def put(self, key, value):
+    """Stores <value> (anything JSON serializable) under <key>."""
+    if self.mode != "record":
+      return
+    entry_path = self._entry_path(key)
+    entry_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+      old_size = entry_path.stat().st_size
+    except OSError:
+      old_size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=entry_path.parent, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+      json.dump({"value": value}, f)
+    os.replace(tmp_path, entry_path)
+
+    with self.lock:
+      if self.size is None:
+        self.size = sum(size for _, size, _ in self._entries())
+      else:
+        # An overwritten entry no longer takes its old size.
+        self.size += entry_path.stat().st_size - old_size
+      if self.max_size and self.size > self.max_size:
+        self._evict()
+
+  def _entries(self):
+    """Yields (path, size, mtime) for every entry on disk."""
+    if not self.path.exists():
+      return
+    for shard in self.path.iterdir():
+      if not shard.is_dir():
+        continue
+      for entry_path in shard.glob("*.json"):
+        try:
+          stat = entry_path.stat()
+        except OSError:
+          continue
+        yield entry_path, stat.st_size, stat.st_mtime
+
+  def _evict(self):
+    """Removes the oldest entries until the cache is below 90% of its size."""
+    entries = sorted(self._entries(), key=lambda entry: entry[2])
+    self.size = sum(size for _, size, _ in entries)
+    target = self.max_size * 0.9
+    for entry_path, size, _ in entries:
+      if self.size <= target:
+        break
+      try:
+        entry_path.unlink()
+      except OSError:
+        continue
+      self.size -= size
@@ -36,6 +36,9 @@ class OpenAICostLogger_Singleton(metaclass=Singleton):
             log_folder=log_folder
         ) 
         self.lock = threading.Lock() # Lock to ensure thread safety when updating the cost logger.
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.coalesced = 0
         
     
     def update_cost(self, response: dict, input_cost: float, output_cost: float = 0):
@@ -51,4 +54,49 @@ class OpenAICostLogger_Singleton(metaclass=Singleton):
                 response=response,
                 input_cost=input_cost,
                 output_cost=output_cost
-            )
\ No newline at end of file
+            )
+
+
+    def update_cache(self, hit: bool):
+        """Counts a lookup in the LLM response cache.
+
+        Args:
+            hit (bool): whether the response was served from the cache.
+        """
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+
+    def get_cache_stats(self) -> dict:
+        """Returns the hit/miss counters of the LLM response cache.
+
+        Returns:
+            dict: the number of hits and misses, and the hit rate.
+        """
+        with self.lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / lookups if lookups else 0.0,
+            }
+
+
+    def update_coalesced(self):
+        """Counts a request that was not made because an identical request
+        was in flight (see single_flight.py)."""
+        with self.lock:
+            self.coalesced += 1
+
+
+    def get_coalescing_stats(self) -> dict:
+        """Returns the number of requests saved by coalescing.
+
+        Returns:
+            dict: the number of coalesced requests.
+        """
+        with self.lock:
+            return {"coalesced": self.coalesced}
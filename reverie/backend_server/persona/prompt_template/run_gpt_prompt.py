@@ -40,6 +40,7 @@ from .v3_ChatGPT.iterative_convo_v1 import run_gpt_generate_iterative_chat_utt
 from .v3_ChatGPT.memo_on_convo_v1 import run_gpt_prompt_memo_on_convo  # noqa: F401
 from .v3_ChatGPT.poignancy_chat_v1 import run_gpt_prompt_chat_poignancy  # noqa: F401
 from .v3_ChatGPT.poignancy_event_v1 import run_gpt_prompt_event_poignancy  # noqa: F401
+from .v3_ChatGPT.poignancy_event_batch_v1 import run_gpt_prompt_event_poignancy_batch  # noqa: F401
 from .v3_ChatGPT.summarize_chat_ideas_v1 import (
   run_gpt_prompt_agent_chat_summarize_ideas,  # noqa: F401
 )
@@ -0,0 +1,144 @@
+"""
+File: single_flight.py
+Description: Coalescing of identical concurrent requests ("single-flight").
+
+When several personas run at once, they often send byte-identical prompts
+(e.g., the poignancy of the same object event, or the pronunciatio of the same
+action) and ask for the embeddings of the same event descriptions. The first
+caller of a key makes the request; the callers that come with the same key
+while it is in flight wait for it and get its result (or its exception)
+instead of making a request of their own. Nothing is kept once the request is
+done -- that is the job of the LLM cache.
+
+SingleFlight coalesces the calls of threads, AsyncSingleFlight the calls of
+the tasks of one event loop.
+"""
+
+import asyncio
+import copy
+import threading
+
+
+class _Flight:
+  def __init__(self):
+    self.done = threading.Event()
+    self.value = None
+    self.error = None
+
+
+class SingleFlight:
+  def __init__(self, on_coalesce=None):
+    """
+    ARGS:
+      on_coalesce: optional callable, called with the key of every call that
+                   waits for a request in flight instead of making its own.
+    """
+    self.on_coalesce = on_coalesce
+    self.lock = threading.Lock()
+    self.flights = dict()
+
+  def claim(self, key):
+    """
+    Claims <key> for the calling thread.
+
+    RETURNS:
+      a (flight, leader) tuple. The leader makes the request and must
+      resolve() the flight; the others wait() for it.
+    """
+    with self.lock:
+      flight = self.flights.get(key)
+      if flight is None:
+        flight = self.flights[key] = _Flight()
+        return flight, True
+    if self.on_coalesce:
+      self.on_coalesce(key)
+    return flight, False
+
+  def resolve(self, key, flight, value=None, error=None):
+    """Hands the <value> (or <error>) of a request to the waiting calls."""
+    with self.lock:
+      if self.flights.get(key) is flight:
+        del self.flights[key]
+    flight.value = value
+    flight.error = error
+    flight.done.set()
+
+  def wait(self, flight):
+    """Returns a copy of the value of <flight>, or raises its error."""
+    flight.done.wait()
+    if flight.error is not None:
+      raise flight.error
+    return copy.deepcopy(flight.value)
+
+  def do(self, key, fn):
+    """
+    Returns fn(), unless a call with the same <key> is in flight; then its
+    result is returned instead.
+    """
+    flight, leader = self.claim(key)
+    if not leader:
+      return self.wait(flight)
+    try:
+      value = fn()
+    except BaseException as e:
+      self.resolve(key, flight, error=e)
+      raise
+    self.resolve(key, flight, value)
+    return value
+
+
+class AsyncSingleFlight:
+  def __init__(self, on_coalesce=None):
+    """
+    The asyncio twin of SingleFlight, for the tasks of a single event loop.
+    """
+    self.on_coalesce = on_coalesce
+    self.flights = dict()
+
+  def claim(self, key):
+    flight = self.flights.get(key)
+    if flight is None:
+      flight = self.flights[key] = asyncio.get_running_loop().create_future()
+      return flight, True
+    if self.on_coalesce:
+      self.on_coalesce(key)
+    return flight, False
+
+  def resolve(self, key, flight, value=None, error=None):
+    if self.flights.get(key) is flight:
+      del self.flights[key]
+    if isinstance(error, asyncio.CancelledError):
+      flight.cancel()
+    elif error is not None:
+      flight.set_exception(error)
+      # Retrieve it, in case nobody was waiting, so that asyncio does not
+      # report it as never retrieved.
+      flight.exception()
+    else:
+      flight.set_result(value)
+
+  async def wait(self, flight):
+    # A waiting task that is cancelled must not cancel the request.
+    return copy.deepcopy(await asyncio.shield(flight))
+
+  async def do(self, key, coro_fn):
+    """
+    Returns await coro_fn(), unless a call with the same <key> is in flight;
+    then its result is returned instead.
+    """
+    flight, leader = self.claim(key)
+    if not leader:
+      try:
+        return await self.wait(flight)
+      except asyncio.CancelledError:
+        if not flight.cancelled():
+          raise
+        # The task making the request was cancelled, not this one.
+        return await self.do(key, coro_fn)
+    try:
+      value = await coro_fn()
+    except BaseException as e:
+      self.resolve(key, flight, error=e)
+      raise
+    self.resolve(key, flight, value)
+    return value
@@ -0,0 +1,104 @@
+import traceback
+from typing import Any
+
+from ..common import openai_config, PoignancyList, get_prompt_file_path
+from ..gpt_structure import ChatGPT_safe_generate_structured_response
+from ..print_prompt import print_run_prompts
+
+
+def create_prompt(prompt_input: dict[str, Any]):
+  persona_name = prompt_input["persona_name"]
+  identity_stable_set = prompt_input["identity_stable_set"]
+  events = prompt_input["events"]
+
+  events_str = "\n".join(
+    f"{count + 1}. {event}" for count, event in enumerate(events)
+  )
+  prompt = f"""
+Here is a brief description of {persona_name}.
+{identity_stable_set}
+
+On the scale of 1 to 10, where 1 is purely mundane (e.g., brushing teeth, making bed) and 10 is extremely poignant (e.g., a break up, college acceptance), rate the likely poignancy of each of the following {len(events)} events for {persona_name}.
+
+Events:
+{events_str}
+Ratings (return one number between 1 and 10 per event, in the order of the events):
+"""
+  return prompt
+
+
+def run_gpt_prompt_event_poignancy_batch(
+  persona, event_descriptions, test_input=None, verbose=False
+):
+  """
+  Rates the poignancy of all of <event_descriptions> in a single request.
+  The batched twin of run_gpt_prompt_event_poignancy.
+
+  RETURNS:
+    None if the response does not have one rating per event; otherwise the
+    ratings, in the order of <event_descriptions>, and the prompt details.
+  """
+  def create_prompt_input(persona, event_descriptions, test_input=None):
+    prompt_input = {
+      "persona_name": persona.scratch.name,
+      "identity_stable_set": persona.scratch.get_str_iss(),
+      "events": event_descriptions,
+    }
+    return prompt_input
+
+  def get_fail_safe():
+    # The caller falls back to rating the events one at a time.
+    return None
+
+  # ChatGPT Plugin ===========================================================
+  def __chat_func_clean_up(gpt_response: PoignancyList, prompt=""):
+    response = gpt_response.poignancies
+    return response
+
+  def __chat_func_validate(gpt_response, prompt=""):
+    try:
+      poignancies = __chat_func_clean_up(gpt_response, prompt)
+      if len(poignancies) != len(event_descriptions):
+        return False
+      return all(1 <= poignancy <= 10 for poignancy in poignancies)
+    except Exception:
+      traceback.print_exc()
+      return False
+
+  gpt_param = {
+    "engine": openai_config["model"],
+    "max_tokens": 20 + 5 * len(event_descriptions),
+    "temperature": 0,
+    "top_p": 1,
+    "stream": False,
+    "frequency_penalty": 0,
+    "presence_penalty": 0,
+    "stop": None,
+  }
+  prompt_file = get_prompt_file_path(__file__)
+  prompt_input = create_prompt_input(persona, event_descriptions)
+  prompt = create_prompt(prompt_input)
+  example_output = '{"poignancies": [5, 2, 7]}'
+  special_instruction = (
+    "The output should ONLY contain a list with ONE integer value on the "
+    f"scale of 1 to 10 for each of the {len(event_descriptions)} events."
+  )
+  fail_safe = get_fail_safe()
+  output = ChatGPT_safe_generate_structured_response(
+    prompt,
+    PoignancyList,
+    example_output,
+    special_instruction,
+    3,
+    fail_safe,
+    __chat_func_validate,
+    __chat_func_clean_up,
+    True,
+  )
+
+  if verbose:
+    print_run_prompts(prompt_file, persona, gpt_param, prompt_input, prompt, output)
+
+  if output:
+    return output, [output, prompt, gpt_param, prompt_input, fail_safe]
+  # ChatGPT Plugin ===========================================================
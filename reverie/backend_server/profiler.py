@@ -0,0 +1,252 @@
+"""
+File: profiler.py
+Description: Per-phase profiler for the simulation step.
+
+The profiler records, for every step, the wall time of each phase of the
+step and the LLM work done during it, per persona:
+  perceive, retrieve, plan (with plan.long_term, plan.determine_action and
+  plan.react), reflect and execute -- the phases of Persona.move;
+  maze_update, move_personas and movement_output -- the bookkeeping of
+  ReverieServer._process_environment_update (recorded as persona "server");
+  step -- the whole step.
+Phases nest, and the time and counters of a phase include those of the
+phases within it (e.g., "plan" includes "plan.determine_action").
+
+The counters are LLM requests and their prompt and completion tokens,
+embedding requests with their inputs and tokens, LLM cache hits, and the calls
+coalesced with an identical request in flight (see single_flight.py). They are
+reported by gpt_structure.py and async_gpt_structure.py, and attributed to
+the phases open in the calling thread (or asyncio task).
+
+Every step is appended to the timeline file given to start(), one JSON line
+per (step, persona, phase):
+  {"step": 12, "persona": "Isabella Rodriguez", "phase": "perceive",
+   "time": 0.0123, "llm_calls": 0, ...}
+summary() tabulates the steps recorded since start(), and
+"python profiler.py <timeline>" tabulates a timeline file.
+"""
+
+import contextvars
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+COUNTERS = ("llm_calls", "prompt_tokens", "completion_tokens",
+            "embedding_calls", "embedding_inputs", "embedding_tokens",
+            "cache_hits", "coalesced")
+
+# The persona and the phases open in the current thread or asyncio task.
+_context = contextvars.ContextVar("profiler_context", default=(None, ()))
+
+
+class PhaseTotals:
+  def __init__(self):
+    """
+    Totals per phase over a number of steps, across personas and per
+    persona.
+    """
+    self.steps = set()
+    self.phases = dict()
+    self.personas = dict()
+
+  def add(self, row):
+    """Adds a timeline row (see the module docstring)."""
+    self.steps.add(row["step"])
+    for totals in (self.phases.setdefault(row["phase"], dict()),
+                   self.personas.setdefault((row["persona"], row["phase"]),
+                                            dict())):
+      totals["time"] = totals.get("time", 0) + row["time"]
+      totals["count"] = totals.get("count", 0) + 1
+      for counter in COUNTERS:
+        totals[counter] = totals.get(counter, 0) + row.get(counter, 0)
+
+  def format(self, top=5):
+    """
+    Returns a table of the phases, and the personas that spent the most time
+    in the phases of Persona.move.
+    """
+    n_steps = len(self.steps)
+    if not n_steps:
+      return "No steps profiled."
+    step_time = self.phases.get("step", {}).get("time", 0)
+
+    lines = [f"{n_steps} steps, {step_time:.2f}s "
+             f"({step_time / n_steps:.3f}s per step)"]
+    header = (f"{'phase':<24}{'total s':>10}{'s/step':>9}{'share':>7}"
+              f"{'llm':>7}{'tokens in':>11}{'tokens out':>11}"
+              f"{'embed':>7}{'cached':>8}{'shared':>8}")
+    lines += [header, "-" * len(header)]
+    # The phases of Persona.move are summed over the personas, so their share
+    # can exceed 100% when personas run at the same time.
+    for phase, totals in sorted(self.phases.items(),
+                                key=lambda item: -item[1]["time"]):
+      share = totals["time"] / step_time if step_time else 0
+      lines += [f"{phase:<24}{totals['time']:>10.2f}"
+                f"{totals['time'] / n_steps:>9.3f}{share:>7.0%}"
+                f"{totals['llm_calls']:>7}{totals['prompt_tokens']:>11}"
+                f"{totals['completion_tokens']:>11}"
+                f"{totals['embedding_calls']:>7}{totals['cache_hits']:>8}"
+                f"{totals['coalesced']:>8}"]
+
+    persona_times = dict()
+    for (persona, phase), totals in self.personas.items():
+      if persona != "server" and "." not in phase and phase != "step":
+        persona_times[persona] = persona_times.get(persona, 0) + totals["time"]
+    if persona_times:
+      lines += ["", "Slowest personas (time in perceive..execute):"]
+      for persona, persona_time in sorted(persona_times.items(),
+                                          key=lambda item: -item[1])[:top]:
+        llm_calls = sum(totals["llm_calls"]
+                        for (p, phase), totals in self.personas.items()
+                        if p == persona and "." not in phase)
+        lines += [f"  {persona:<30}{persona_time:>10.2f}s"
+                  f"{llm_calls:>7} llm calls"]
+    return "\n".join(lines)
+
+
+class StepProfiler:
+  def __init__(self):
+    self.enabled = False
+    self.path = None
+    self.lock = threading.Lock()
+    self.step = None
+    self.records = dict()
+    self.totals = PhaseTotals()
+
+  def start(self, path):
+    """
+    Starts profiling, appending the timeline to <path>.
+    """
+    with self.lock:
+      self.enabled = True
+      self.path = path
+      self.totals = PhaseTotals()
+
+  def stop(self):
+    with self.lock:
+      self.enabled = False
+      self.step = None
+      self.records = dict()
+
+  def _record(self, persona, phase):
+    key = (persona, phase)
+    if key not in self.records:
+      self.records[key] = dict.fromkeys(("time",) + COUNTERS, 0)
+    return self.records[key]
+
+  def begin_step(self, step):
+    if not self.enabled:
+      return
+    with self.lock:
+      self.step = step
+      self.records = dict()
+      self.step_start = time.perf_counter()
+
+  def end_step(self):
+    """Writes the step that begin_step() started to the timeline."""
+    if not self.enabled or self.step is None:
+      return
+    with self.lock:
+      self._record("server", "step")["time"] = (time.perf_counter()
+                                               - self.step_start)
+      rows = []
+      for (persona, phase), record in self.records.items():
+        row = {"step": self.step, "persona": persona, "phase": phase}
+        row.update(record)
+        row["time"] = round(row["time"], 6)
+        rows += [row]
+        self.totals.add(row)
+      self.step = None
+      self.records = dict()
+    with open(self.path, "a") as outfile:
+      outfile.write("".join(json.dumps(row) + "\n" for row in rows))
+
+  @contextmanager
+  def phase(self, name, persona=None):
+    """
+    Times the code within the block as phase <name>. <persona> is the persona
+    the phase runs for; nested phases inherit it.
+    """
+    if not self.enabled:
+      yield
+      return
+    outer_persona, phases = _context.get()
+    if persona and persona != outer_persona:
+      # A persona's phases are not part of the phases it was started from
+      # (e.g., the server's "move_personas"), whether it runs in a thread of
+      # its own or not.
+      phases = ()
+    persona = persona or outer_persona or "server"
+    token = _context.set((persona, phases + (name,)))
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      _context.reset(token)
+      with self.lock:
+        if self.step is not None:
+          self._record(persona, name)["time"] += elapsed
+
+  def count(self, **counters):
+    """
+    Adds to the counters of the step and of the phases open in the calling
+    context.
+    """
+    if not self.enabled:
+      return
+    persona, phases = _context.get()
+    with self.lock:
+      if self.step is None:
+        return
+      records = [self._record("server", "step")]
+      records += [self._record(persona, phase) for phase in phases]
+      for record in records:
+        for counter, value in counters.items():
+          record[counter] += value
+
+  def count_llm(self, response):
+    """Counts an LLM request and the tokens of its <response>."""
+    usage = getattr(response, "usage", None)
+    self.count(
+      llm_calls=1,
+      prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+      completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+    )
+
+  def count_embeddings(self, response, n_inputs):
+    """Counts an embeddings request of <n_inputs> texts."""
+    usage = getattr(response, "usage", None)
+    self.count(
+      embedding_calls=1,
+      embedding_inputs=n_inputs,
+      embedding_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+    )
+
+  def summary(self):
+    """Returns a table of the steps profiled since start()."""
+    with self.lock:
+      return self.totals.format()
+
+
+def summarize_file(path):
+  """Returns a table of the steps in the timeline file at <path>."""
+  totals = PhaseTotals()
+  with open(path) as f:
+    for line in f:
+      if line.strip():
+        totals.add(json.loads(line))
+  return totals.format()
+
+
+# The profiler of this process, shared by the server and the personas.
+profiler = StepProfiler()
+
+
+if __name__ == "__main__":
+  if len(sys.argv) < 2:
+    print("Usage: python profiler.py <sim_folder>/profile.jsonl")
+    sys.exit(1)
+  print(summarize_file(sys.argv[1]))
@@ -26,9 +26,10 @@ import math
 import os
 import shutil
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict, Any, Tuple
 
-from global_methods import read_file_to_list, check_if_file_exists, copyanything, freeze
+from global_methods import read_file_to_list, check_if_file_exists, freeze
 from utils import (
   maze_assets_loc,
   fs_storage,
@@ -38,7 +39,18 @@ from utils import (
   mqtt_client_id,
   mqtt_movement_topic,
   mqtt_environment_topic,
+  persona_workers as default_persona_workers,
+  memory_journal as default_memory_journal,
+  environment_wait,
+  headless_environment_stride,
+  movement_log as use_movement_log,
+  fork_mode as default_fork_mode,
+  profile_steps,
 )
+from environment_source import make_environment_source
+from movement_log import MovementLog, movement_log_folder
+from sim_fork import fork_simulation, replace_file
+from profiler import profiler
 from maze import Maze
 from persona.persona import Persona
 from persona.cognitive_modules.converse import load_history_via_whisper
@@ -63,7 +75,10 @@ class ReverieServer:
     self,
     fork_sim_code: str,
     sim_code: str,
-    use_mqtt: bool = False
+    use_mqtt: bool = False,
+    persona_workers: Optional[int] = None,
+    memory_journal: Optional[bool] = None,
+    fork_mode: Optional[str] = None,
   ):
 
     print ("(reverie): Temp storage: ", fs_temp_storage)
@@ -78,9 +93,13 @@ class ReverieServer:
     # <sim_code> indicates our current simulation. The first step here is to 
     # copy everything that's in <fork_sim_code>, but edit its 
     # reverie/meta/json's fork variable. 
+    # <fork_mode> denotes how the history of <fork_sim_code> is carried over
+    # ("copy", "link" or "lineage", see sim_fork.py).
     self.sim_code = sim_code
     sim_folder = f"{fs_storage}/{self.sim_code}"
-    copyanything(fork_folder, sim_folder)
+    if fork_mode is None:
+      fork_mode = default_fork_mode
+    fork_simulation(fork_folder, sim_folder, fork_mode)
 
     with open(f"{sim_folder}/reverie/meta.json") as json_file:  
       reverie_meta = json.load(json_file)
@@ -145,23 +164,56 @@ class ReverieServer:
     # self.persona_convo = dict()
 
     # Loading in all personas.
+    # <memory_journal> denotes whether the personas' associative memories are
+    # saved incrementally through a journal (see memory_journal.py).
+    if memory_journal is None:
+      memory_journal = default_memory_journal
     init_env_file = f"{sim_folder}/environment/{str(self.step)}.json"
     init_env = json.load(open(init_env_file))
     for persona_name in reverie_meta['persona_names']: 
       persona_folder = f"{sim_folder}/personas/{persona_name}"
       p_x = init_env[persona_name]["x"]
       p_y = init_env[persona_name]["y"]
-      curr_persona = Persona(persona_name, persona_folder)
+      curr_persona = Persona(persona_name, persona_folder, memory_journal)
 
       # We set the persona's current tile to the tile that it is in the environment file
       self.personas[persona_name] = curr_persona
       self.personas_tile[persona_name] = (p_x, p_y)
-      self.maze.tiles[p_y][p_x]["events"].add(curr_persona.scratch.get_curr_event_and_desc())
+      self.maze.add_event_from_tile(curr_persona.scratch.get_curr_event_and_desc(), (p_x, p_y))
 
     # REVERIE SETTINGS PARAMETERS:  
     # <server_sleep> denotes the amount of time that our while loop rests each
-    # cycle; this is to not kill our machine. 
+    # cycle; this is to not kill our machine. It is also the interval at 
+    # which the "poll" environment source checks for environment files.
     self.server_sleep = 0.1
+    # <environment_source> is what the main loop waits on for the 
+    # environment of the next step (see environment_source.py). It is set 
+    # up when the server starts, according to the mode it runs in.
+    self.environment_source = None
+    self._environment_in_process = None
+    # <headless_environments> holds the environments that the headless engine
+    # produced for the current and the previous step, which may not be
+    # written to disk yet (see headless_environment_stride in utils.py).
+    self.headless_environments = dict()
+    # <movement_log> is the append-only log that the personas' movements of
+    # each step go to (see movement_log.py), or None to write a
+    # movement/{step}.json file per step.
+    self.movement_log = None
+    if use_movement_log:
+      self.movement_log = MovementLog(movement_log_folder(sim_folder))
+    # With <profile_steps>, the time, LLM calls and tokens of each phase of
+    # every step are recorded to profile.jsonl (see profiler.py). It can also
+    # be turned on with the "profile on" command.
+    if profile_steps:
+      profiler.start(f"{sim_folder}/profile.jsonl")
+    # <persona_workers> denotes the number of personas whose cognitive
+    # sequence (perceive, retrieve, plan, reflect, execute) runs at the same
+    # time. With 1, the personas move one after another as they always have.
+    # Otherwise a step takes roughly as long as its slowest persona.
+    if persona_workers is None:
+      persona_workers = default_persona_workers
+    self.persona_workers = max(1, int(persona_workers))
+    self._persona_pool = None
 
     # MQTT SETUP
     self.use_mqtt = use_mqtt
@@ -204,30 +256,32 @@ class ReverieServer:
       environment = data["environment"]
 
       # Save environment data
-      sim_folder = f"{fs_storage}/{self.sim_code}"
-      with open(f"{sim_folder}/environment/{step}.json", "w") as outfile:
-        outfile.write(json.dumps(environment, indent=2))
+      self._write_environment(step, environment)
+
+      # Hand the environment straight to the main loop as well.
+      if self.environment_source:
+        self.environment_source.put(step, environment)
 
     except Exception as e:
       print(f"Error handling environment update: {e}")
       traceback.print_exc()
 
-  def _process_environment_update(self, environment: Dict[str, Any], headless: bool = False, game_obj_cleanup: Optional[Dict[Tuple, Tuple[int, int]]] = None) -> None:
+  def _write_environment(self, step: int, environment: Dict[str, Any]) -> None:
     """
-    Process environment update and generate next movement.
-    This function handles the core simulation logic:
-    1. Updates persona positions based on environment data
-    2. Handles object actions and events
-    3. Generates next movements for all personas
-    4. Runs any configured plugins
-    5. Handles headless mode if enabled
-    6. Publishes movement data via MQTT if enabled
+    Writes the environment of <step> to environment/{step}.json. The file is
+    replaced, since it may be hardlinked from the simulation we forked from.
     """
-    if game_obj_cleanup is None:
-      game_obj_cleanup = {}
+    sim_folder = f"{fs_storage}/{self.sim_code}"
+    replace_file(f"{sim_folder}/environment/{step}.json",
+                 json.dumps(environment, indent=2))
 
-    # We first move our personas in the backend environment to match
-    # the frontend environment.
+  def _update_maze(self, environment: Dict[str, Any], game_obj_cleanup: Dict[Tuple, Tuple[int, int]]) -> None:
+    """
+    Moves the personas on the backend tile map to where the frontend
+    environment puts them, and activates the object actions of the personas
+    that have arrived at their destination (recording them in
+    <game_obj_cleanup>).
+    """
     for persona_name, persona in self.personas.items():
       # <curr_tile> is the tile that the persona was at previously.
       curr_tile = self.personas_tile[persona_name]
@@ -265,6 +319,25 @@ class ReverieServer:
         )
         self.maze.remove_event_from_tile(blank, new_tile)
 
+  def _process_environment_update(self, environment: Dict[str, Any], headless: bool = False, game_obj_cleanup: Optional[Dict[Tuple, Tuple[int, int]]] = None) -> None:
+    """
+    Process environment update and generate next movement.
+    This function handles the core simulation logic:
+    1. Updates persona positions based on environment data
+    2. Handles object actions and events
+    3. Generates next movements for all personas
+    4. Runs any configured plugins
+    5. Handles headless mode if enabled
+    6. Publishes movement data via MQTT if enabled
+    """
+    if game_obj_cleanup is None:
+      game_obj_cleanup = {}
+
+    # We first move our personas in the backend environment to match
+    # the frontend environment.
+    with profiler.phase("maze_update"):
+      self._update_maze(environment, game_obj_cleanup)
+
     # Then we need to actually have each of the personas perceive and
     # move. The movement for each of the personas comes in the form of
     # x y coordinates where the persona will move towards. e.g., (50, 34)
@@ -275,18 +348,18 @@ class ReverieServer:
 
     sim_folder = f"{fs_storage}/{self.sim_code}"
 
+    with profiler.phase("move_personas"):
+      persona_moves = self._move_personas()
+
+    # The movements are committed in the fixed persona order regardless of
+    # the order in which the personas finished thinking.
     for persona_name, persona in self.personas.items():
       # <next_tile> is a x,y coordinate. e.g., (58, 9)
       # <pronunciatio> is an emoji. e.g., "\ud83d\udca4"
       # <description> is a string description of the movement. e.g.,
       #   writing her next novel (editing her novel)
       #   @ double studio:double studio:common room:sofa
-      next_tile, pronunciatio, description = persona.move(
-        self.maze,
-        self.personas,
-        self.personas_tile[persona_name],
-        self.curr_time,
-      )
+      next_tile, pronunciatio, description = persona_moves[persona_name]
       movements["persona"][persona_name] = {}
       movements["persona"][persona_name]["movement"] = next_tile
       movements["persona"][persona_name]["pronunciatio"] = pronunciatio
@@ -308,18 +381,22 @@ class ReverieServer:
       "%B %d, %Y, %H:%M:%S"
     )
 
-    # We then write the personas' movements to a file that will be sent
-    # to the frontend server.
+    # We then write the personas' movements to the movement log (or a file)
+    # that the frontend server reads them from.
     # Example json output:
     # {"persona": {"Maria Lopez": {"movement": [58, 9]}},
     #  "persona": {"Klaus Mueller": {"movement": [38, 12]}},
     #  "meta": {curr_time: <datetime>}}
-    movementFolder = f"{sim_folder}/movement"
-    if not os.path.exists(movementFolder):
-      os.mkdir(movementFolder)
-    curr_move_file = f"{sim_folder}/movement/{self.step}.json"
-    with open(curr_move_file, "w") as outfile:
-      outfile.write(json.dumps(movements, indent=2))
+    with profiler.phase("movement_output"):
+      if self.movement_log:
+        self.movement_log.append(self.step, movements)
+      else:
+        movementFolder = f"{sim_folder}/movement"
+        if not os.path.exists(movementFolder):
+          os.mkdir(movementFolder)
+        curr_move_file = f"{sim_folder}/movement/{self.step}.json"
+        # Replaced rather than rewritten, like the environment files.
+        replace_file(curr_move_file, json.dumps(movements, indent=2))
 
     # Publish movement data via MQTT if enabled
     if self.use_mqtt:
@@ -375,8 +452,8 @@ class ReverieServer:
     self.step += 1
     self.curr_time += datetime.timedelta(seconds=self.sec_per_step)
 
-    # If we're running in headless mode, also create the environment file
-    # to immediately trigger the next simulation step
+    # If we're running in headless mode, we also produce the environment of
+    # the next step to immediately trigger the next simulation step
     if headless:
       if self.use_mqtt:
         data = {
@@ -386,10 +463,97 @@ class ReverieServer:
         print(f"Headless mode: Self-publishing environment data to MQTT topic {self.environment_topic}: {data}", flush=True)
         self.mqtt_client.publish(self.environment_topic, data)
       else:
-        with open(
-          f"{sim_folder}/environment/{self.step}.json", "w"
-        ) as outfile:
-          outfile.write(json.dumps(next_env, indent=2))
+        # The environment goes straight to the main loop, and is only kept
+        # in memory until it is written at the configured stride or when
+        # saving.
+        self.headless_environments[self.step] = next_env
+        for step in list(self.headless_environments):
+          if step < self.step - 1:
+            del self.headless_environments[step]
+        if (headless_environment_stride
+            and self.step % headless_environment_stride == 0):
+          self._write_environment(self.step, next_env)
+        self.environment_source.put(self.step, next_env)
+
+  def _move_personas(self) -> Dict[str, Tuple]:
+    """
+    Run the cognitive sequence of every persona for the current step and
+    return their executions keyed by persona name.
+
+    With <persona_workers> > 1, the parts of the sequence that only concern
+    one persona run concurrently on a bounded thread pool, and the parts that
+    touch other personas run one persona after another, in a fixed order:
+      1. think (perceive, retrieve, long term planning, the next action) --
+         concurrently;
+      2. react (chatting, waiting), which reads and writes the scratch and
+         memory of other personas -- in persona order;
+      3. reflect -- concurrently;
+      4. execute, which reads where the other personas are -- in persona
+         order.
+    The maze is only read while the personas move; all tile event updates
+    happen in _process_environment_update. The result therefore does not
+    depend on thread scheduling. It can differ from the one-after-another
+    stepping of persona_workers = 1, where a persona's reaction happens
+    before the personas after it think.
+    """
+    if self.persona_workers <= 1 or len(self.personas) <= 1:
+      return {persona_name: persona.move(self.maze,
+                                         self.personas,
+                                         self.personas_tile[persona_name],
+                                         self.curr_time)
+              for persona_name, persona in self.personas.items()}
+
+    if self._persona_pool is None:
+      self._persona_pool = ThreadPoolExecutor(
+        max_workers=self.persona_workers,
+        thread_name_prefix="persona",
+      )
+
+    def run_concurrently(fn):
+      futures = {persona_name: self._persona_pool.submit(fn, persona_name)
+                 for persona_name in self.personas}
+      return {persona_name: future.result()
+              for persona_name, future in futures.items()}
+
+    focused_events = run_concurrently(
+      lambda persona_name: self.personas[persona_name].think(
+        self.maze, self.personas_tile[persona_name], self.curr_time
+      )
+    )
+    plans = {persona_name: persona.react(self.maze, self.personas,
+                                         focused_events[persona_name])
+             for persona_name, persona in self.personas.items()}
+
+    def reflect(persona_name):
+      persona = self.personas[persona_name]
+      # Noncognitive agents can't reflect at all.
+      if not persona.scratch.is_noncognitive():
+        persona.reflect()
+    run_concurrently(reflect)
+
+    return {persona_name: persona.execute(self.maze, self.personas,
+                                          plans[persona_name])
+            for persona_name, persona in self.personas.items()}
+
+  def _get_environment_source(self, headless: bool):
+    """
+    Returns the environment source for the main loop. The environments come
+    in-process in MQTT and headless mode, and as files from the frontend
+    otherwise.
+    """
+    in_process = self.use_mqtt or headless
+    if (self.environment_source is None
+        or self._environment_in_process != in_process):
+      if self.environment_source:
+        self.environment_source.close()
+      self.environment_source = make_environment_source(
+        f"{fs_storage}/{self.sim_code}/environment",
+        environment_wait,
+        in_process=in_process,
+        poll_interval=self.server_sleep,
+      )
+      self._environment_in_process = in_process
+    return self.environment_source
 
   def start_server(self, int_counter: int, headless: bool = False) -> None:
     """
@@ -405,9 +569,6 @@ class ReverieServer:
     OUTPUT
       None
     """
-    # <sim_folder> points to the current simulation folder.
-    sim_folder = f"{fs_storage}/{self.sim_code}"
-
     # When a persona arrives at a game object, we give a unique event
     # to that object.
     # e.g., ('double studio[...]:bed', 'is', 'unmade', 'unmade')
@@ -418,6 +579,8 @@ class ReverieServer:
     # <game_obj_cleanup> is used for that.
     game_obj_cleanup = dict()
 
+    environment_source = self._get_environment_source(headless)
+
     if self.use_mqtt:
       # Subscribe to environment updates from frontend
       print(f"Subscribing to environment updates from MQTT topic {self.environment_topic}", flush=True)
@@ -437,44 +600,36 @@ class ReverieServer:
         #   self.mqtt_client.unsubscribe(self.environment_topic)
         break
 
-      # <curr_env_file> file is the file that our frontend outputs. When the
-      # frontend has done its job and moved the personas, then it will put a
-      # new environment file that matches our step count. That's when we run
-      # the content of this for loop. Otherwise, we just wait.
-      curr_env_file = f"{sim_folder}/environment/{self.step}.json"
-      if check_if_file_exists(curr_env_file):
-        try: 
-          with open(curr_env_file) as json_file:
-            new_env = json.load(json_file)
-            env_retrieved = True
-        except Exception as e:
-          print(f"Error loading environment file: {e}")
-          traceback.print_exc()
-          env_retrieved = False
-
-        if env_retrieved:
-          # This is where we go through <game_obj_cleanup> to clean up all
-          # object actions that were used in this cycle.
-          for key, val in game_obj_cleanup.items():
-            # We turn all object actions to their blank form (with None).
-            self.maze.turn_event_from_tile_idle(key, val)
-          # Then we initialize game_obj_cleanup for this cycle.
-          game_obj_cleanup = dict()
-
-          # Process environment update
-          self._process_environment_update(new_env, headless, game_obj_cleanup)
-          int_counter -= 1
-
-      # Sleep so we don't burn our machines.
-      time.sleep(self.server_sleep)
-
-  def save(self) -> None:
+      # The environment of the current step comes from the frontend (as the
+      # environment/{step}.json file it outputs, or over MQTT) once it has
+      # moved the personas, or from the previous step in headless mode. 
+      # That's when we run the content of this for loop. Otherwise, we wait
+      # on the environment source, which returns as soon as it arrives.
+      new_env = environment_source.wait(self.step)
+      profiler.begin_step(self.step)
+
+      # This is where we go through <game_obj_cleanup> to clean up all
+      # object actions that were used in this cycle.
+      with profiler.phase("maze_update"):
+        for key, val in game_obj_cleanup.items():
+          # We turn all object actions to their blank form (with None).
+          self.maze.turn_event_from_tile_idle(key, val)
+      # Then we initialize game_obj_cleanup for this cycle.
+      game_obj_cleanup = dict()
+
+      # Process environment update
+      self._process_environment_update(new_env, headless, game_obj_cleanup)
+      profiler.end_step()
+      int_counter -= 1
+
+  def save(self, compact: bool = False) -> None:
     """
     Save all Reverie progress -- this includes Reverie's global state as well
     as all the personas.
 
     INPUT
-      None
+      compact: Whether to fold the personas' memory journals into full
+               snapshots (only relevant in memory journal mode).
     OUTPUT
       None
       * Saves all relevant data to the designated memory directory
@@ -499,13 +654,26 @@ class ReverieServer:
     # Save the personas.
     for persona_name, persona in self.personas.items(): 
       save_folder = f"{sim_folder}/personas/{persona_name}/bootstrap_memory"
-      persona.save(save_folder)
+      persona.save(save_folder, compact=compact, step=self.step)
+
+    # Write the environment of the current step if the headless engine only
+    # kept it in memory, so that the simulation can be resumed from here.
+    if (self.step in self.headless_environments
+        and not os.path.exists(f"{sim_folder}/environment/{self.step}.json")):
+      self._write_environment(self.step, self.headless_environments[self.step])
 
     # Close MQTT client if using it
     if self.use_mqtt:
       print("Closing MQTT client")
       self.mqtt_client.close()
 
+    if self.environment_source:
+      self.environment_source.close()
+      self.environment_source = None
+
+    if self.movement_log:
+      self.movement_log.close()
+
   def start_path_tester_server(self):
     """
     Starts the path tester server. This is for generating the spatial memory
@@ -652,6 +820,12 @@ class ReverieServer:
           # Example: save
           self.save()
 
+        elif sim_command.lower() == "save and compact":
+          # Saves the current simulation progress, folding the personas'
+          # memory journals into full snapshots.
+          # Example: save and compact
+          self.save(compact=True)
+
         elif sim_command[:3].lower() == "run":
           # Runs the number of steps specified in the prompt.
           # Example: run 1000
@@ -681,6 +855,24 @@ class ReverieServer:
           int_count = int(sim_command.split()[-1])
           self.start_server(int_count, headless=True)
 
+        elif sim_command.lower() == "profile on":
+          # Starts recording where the time of each step goes, to
+          # profile.jsonl in the simulation folder (see profiler.py).
+          # Example: profile on
+          profiler.start(f"{sim_folder}/profile.jsonl")
+          ret_str += f"Profiling steps to {sim_folder}/profile.jsonl"
+
+        elif sim_command.lower() == "profile off":
+          # Stops recording the steps.
+          # Example: profile off
+          profiler.stop()
+
+        elif sim_command.lower() == "profile summary":
+          # Prints the time, LLM calls and tokens per phase of the steps
+          # profiled since profiling was turned on.
+          # Example: profile summary
+          ret_str += profiler.summary()
+
         elif "print persona schedule" in sim_command[:22].lower():
           # Print the decomposed schedule of the persona specified in the
           # prompt.
@@ -819,14 +1011,17 @@ class ReverieServer:
       except Exception as e:
         print("(reverie): Error: ", e)
         traceback.print_exc()
-        # remove movement file if it exists
+        # remove the movements of this step if they were written
         movement_file = f"{sim_folder}/movement/{self.step}.json"
         if os.path.exists(movement_file):
           os.remove(movement_file)
+        if self.movement_log:
+          self.movement_log.truncate(self.step)
         # remove environment file if it exists
         env_file = f"{sim_folder}/environment/{self.step}.json"
         if os.path.exists(env_file):
           os.remove(env_file)
+        self.headless_environments.pop(self.step, None)
         print(f"(reverie): Error at step {self.step}")
         if self.step > 0:
           self.step -= 1
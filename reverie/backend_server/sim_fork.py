@@ -0,0 +1,194 @@
+"""
+File: sim_fork.py
+Description: Forking a simulation folder into a new simulation.
+
+A fork used to deep-copy the whole folder of the simulation it forks from,
+including the movement and environment history of every step. The history is
+never written in place once the fork is made (a step that is run again
+replaces its files, see replace_file()), so the fork modes only need to
+materialize what the new simulation rewrites: reverie/meta.json, the
+personas' bootstrap_memory, and the environment file of the current step.
+  "copy"    -- copies everything, as before.
+  "link"    -- materializes those files and hardlinks the history (or clones
+               it with a reflink, or copies it where neither is supported).
+               The last segment and the index of the movement log are
+               materialized as well, since the new simulation appends to them.
+  "lineage" -- materializes those files only, and records the simulation it
+               was forked from in reverie/lineage.json. The movement readers
+               in movement_log.py follow the lineage back to the steps that
+               were run before the fork. The forked-from simulations have to
+               be kept around for as long as their descendants are.
+The reverie/lineage.json of a simulation is copied along in the "copy" and
+"link" modes, so that forks of a lineage fork still find its ancestors.
+"""
+
+import json
+import os
+import shutil
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+FORK_MODES = ("copy", "link", "lineage")
+
+# The folders that only hold the history of a simulation's steps.
+HISTORY_FOLDERS = ("environment", "movement", "movement_log")
+
+# ioctl request for cloning a whole file on filesystems with reflinks (e.g.,
+# btrfs and XFS), see ioctl_ficlone(2).
+FICLONE = 0x40049409
+
+
+def read_lineage(sim_folder):
+  """
+  Returns the simulations whose history a simulation builds on, from the
+  simulation itself back to the first one that was not forked by lineage.
+
+  ARGS:
+    sim_folder: the simulation folder.
+  RETURNS:
+    a list of (folder, first_step) tuples: each folder holds the history
+    from its first_step up to the first_step of the folder before it.
+  """
+  lineage = []
+  visited = set()
+  folder = sim_folder
+  while folder and os.path.realpath(folder) not in visited:
+    visited.add(os.path.realpath(folder))
+    try:
+      with open(f"{folder}/reverie/lineage.json") as json_file:
+        parent = json.load(json_file)
+    except (FileNotFoundError, ValueError):
+      lineage += [(folder, 0)]
+      break
+    lineage += [(folder, parent["fork_step"])]
+    folder = os.path.join(os.path.dirname(folder), parent["fork_sim_code"])
+  return lineage
+
+
+def clone_file(src, dst):
+  """
+  Copies <src> to <dst>, sharing its blocks through a reflink where the
+  filesystem supports it.
+  """
+  if fcntl:
+    try:
+      with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+      shutil.copystat(src, dst)
+      return
+    except OSError:
+      pass
+  shutil.copy2(src, dst)
+
+
+def link_file(src, dst):
+  """
+  Hardlinks <dst> to <src>, falling back to clone_file() across filesystems
+  or where hardlinks are not supported.
+  """
+  try:
+    os.link(src, dst)
+  except OSError:
+    clone_file(src, dst)
+
+
+def replace_file(path, content):
+  """
+  Writes the str <content> to <path> through a temporary file that replaces
+  it, rather than writing the file in place. A history file that is
+  hardlinked from the simulation we forked from (see "link" above) then gets
+  a file of its own, and the forked-from simulation is left untouched.
+  """
+  with open(path + ".tmp", "w") as outfile:
+    outfile.write(content)
+  os.replace(path + ".tmp", path)
+
+
+def _current_environment_file(fork_folder, step):
+  """
+  Returns the name of the environment file of <step> in <fork_folder>, or of
+  the latest one if that is missing.
+  """
+  env_folder = f"{fork_folder}/environment"
+  if os.path.exists(f"{env_folder}/{step}.json"):
+    return f"{step}.json"
+  steps = [int(file_name[:-5]) for file_name in os.listdir(env_folder)
+           if file_name.endswith(".json") and file_name[:-5].isdigit()]
+  return f"{max(steps)}.json" if steps else None
+
+
+def _link_movement_log(src, dst):
+  """
+  Links the closed segments of the movement log in <src> and materializes
+  the last segment and the index, which the new simulation appends to.
+  """
+  os.makedirs(dst)
+  segments = sorted(file_name for file_name in os.listdir(src)
+                    if file_name.endswith(".jsonl"))
+  for file_name in os.listdir(src):
+    if file_name in segments[:-1]:
+      link_file(f"{src}/{file_name}", f"{dst}/{file_name}")
+    else:
+      clone_file(f"{src}/{file_name}", f"{dst}/{file_name}")
+
+
+def fork_simulation(fork_folder, sim_folder, mode="copy"):
+  """
+  Creates the folder of a new simulation that forks from <fork_folder>.
+
+  ARGS:
+    fork_folder: the folder of the simulation we are forking from.
+    sim_folder: the folder of the new simulation; it must not exist yet.
+    mode: one of FORK_MODES.
+  RETURNS:
+    None
+  """
+  if mode not in FORK_MODES:
+    raise ValueError(f"Invalid fork mode: {mode}")
+  if mode == "copy":
+    shutil.copytree(fork_folder, sim_folder)
+    return
+
+  with open(f"{fork_folder}/reverie/meta.json") as json_file:
+    step = json.load(json_file)["step"]
+
+  # Everything but the history is materialized.
+  shutil.copytree(
+    fork_folder, sim_folder, copy_function=clone_file,
+    ignore=lambda src, names: (
+      [name for name in names if name in HISTORY_FOLDERS]
+      if os.path.samefile(src, fork_folder) else []
+    ),
+  )
+
+  env_file = None
+  if os.path.isdir(f"{fork_folder}/environment"):
+    env_file = _current_environment_file(fork_folder, step)
+  os.makedirs(f"{sim_folder}/environment")
+  if env_file:
+    clone_file(f"{fork_folder}/environment/{env_file}",
+               f"{sim_folder}/environment/{env_file}")
+
+  if mode == "lineage":
+    with open(f"{sim_folder}/reverie/lineage.json", "w") as outfile:
+      outfile.write(json.dumps({
+        "fork_sim_code": os.path.basename(os.path.normpath(fork_folder)),
+        "fork_step": step,
+      }, indent=2))
+    return
+
+  for folder in HISTORY_FOLDERS:
+    src = f"{fork_folder}/{folder}"
+    dst = f"{sim_folder}/{folder}"
+    if not os.path.isdir(src):
+      continue
+    if folder == "movement_log":
+      _link_movement_log(src, dst)
+      continue
+    os.makedirs(dst, exist_ok=True)
+    for file_name in os.listdir(src):
+      if not os.path.exists(f"{dst}/{file_name}"):
+        link_file(f"{src}/{file_name}", f"{dst}/{file_name}")
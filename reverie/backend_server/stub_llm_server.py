@@ -0,0 +1,634 @@
+"""
+File: stub_llm_server.py
+Description: Offline stand-in for the OpenAI API, for load testing.
+
+The server speaks the subset of the OpenAI HTTP API that gpt_structure.py and
+async_gpt_structure.py use:
+  POST /v1/chat/completions -- plain and structured (response_format with a
+                               JSON schema) chat completions;
+  POST /v1/completions      -- text completions;
+  POST /v1/embeddings       -- embeddings;
+  GET  /v1/models           -- the model list;
+  GET  /stats               -- counters of the requests served so far.
+It never calls out to the network. Structured outputs are generated from the
+JSON schema of the request, so they always validate against the prompt
+template's response_format model; for the models whose values the simulation
+relies on (areas and objects picked from the options in the prompt, schedules
+that add up to the planned duration, ...), the values are taken from the
+prompt as well. Embeddings are pseudo-embeddings: the normalized sum of a
+fixed random vector per word, so texts sharing words are similar. Both are
+deterministic -- the same request always gets the same response.
+
+Every response reports its token usage (estimated at 4 characters a token), so
+the cost logger and the profiler count it like the real thing. Latency and
+errors are drawn from configurable distributions, set under "stub-server" in
+openai_config.json:
+  "stub-server": {
+    "host": "127.0.0.1",
+    "port": 8090,
+    "seed": 0,
+    "latency": {"distribution": "lognormal", "median": 0.8, "sigma": 0.4,
+                "per-output-token": 0.01},
+    "embeddings-latency": {"distribution": "fixed", "value": 0.05},
+    "error-rate": 0.01,
+    "error-status": [429, 500, 503],
+    "max-in-flight": 64,
+    "embeddings-dimensions": 768
+  }
+The latency distributions are "fixed" (value), "uniform" (min, max), "normal"
+(mean, stddev), "lognormal" (median, sigma) and "exponential" (mean), in
+seconds; "per-output-token" adds a delay per completion token. A request fails
+with one of "error-status" at "error-rate", and with 429 when "max-in-flight"
+requests are already being served (0: no limit).
+
+Usage:
+  python stub_llm_server.py [--port 8090] [--config ../../openai_config.json]
+and set "client" and "embeddings-client" to "stub" in openai_config.json (the
+clients connect to "model-endpoint"/"embeddings-endpoint", by default the
+host and port of "stub-server").
+"""
+
+import argparse
+import base64
+import datetime
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8090
+DEFAULT_EMBEDDINGS_DIMENSIONS = 768
+
+# Phrases the stub answers with, wherever the prompt does not pin the value.
+ACTIVITIES = [
+  "reading a book",
+  "having a cup of coffee",
+  "working on a project",
+  "taking a walk in the park",
+  "chatting with a neighbor",
+  "writing in a journal",
+  "tidying up the room",
+  "cooking a meal",
+  "checking emails",
+  "studying for an exam",
+  "painting a picture",
+  "listening to music",
+]
+EMOJIS = ["📖", "☕", "💻", "🚶", "💬", "✍️", "🧹", "🍳", "📧", "📚", "🎨", "🎵"]
+
+# Ranges of the integer fields of the response formats, by field name.
+INTEGER_RANGES = {
+  "poignancy": (1, 10),
+  "safety_score": (1, 10),
+  "urgency": (0, 10),
+  "wake_up_hour": (5, 9),
+  "duration": (5, 60),
+}
+
+HOUR_STRINGS = [f"{hour % 12 or (0 if hour < 12 else 12):02d}:00 "
+                f"{'AM' if hour < 12 else 'PM'}" for hour in range(24)]
+
+
+def stub_endpoint(openai_config):
+  """
+  Returns the base URL of the stub server configured in <openai_config>.
+  """
+  config = openai_config.get("stub-server", {})
+  host = config.get("host", DEFAULT_HOST)
+  port = config.get("port", DEFAULT_PORT)
+  return f"http://{host}:{port}/v1"
+
+
+def count_tokens(text):
+  """Estimates the number of tokens of <text>."""
+  return max(1, math.ceil(len(text) / 4))
+
+
+def seeded_rng(*parts):
+  """Returns a random.Random seeded with a hash of <parts>."""
+  digest = hashlib.sha256(
+    json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+  ).digest()
+  return random.Random(int.from_bytes(digest[:8], "little"))
+
+
+def sample_latency(spec, rng, output_tokens=0):
+  """
+  Draws a latency, in seconds, from the distribution <spec> (see the module
+  docstring).
+  """
+  if not spec:
+    return 0
+  distribution = spec.get("distribution", "fixed")
+  if distribution == "fixed":
+    latency = spec.get("value", 0)
+  elif distribution == "uniform":
+    latency = rng.uniform(spec.get("min", 0), spec.get("max", 0))
+  elif distribution == "normal":
+    latency = rng.gauss(spec.get("mean", 0), spec.get("stddev", 0))
+  elif distribution == "lognormal":
+    latency = rng.lognormvariate(math.log(spec.get("median", 1)),
+                                 spec.get("sigma", 0))
+  elif distribution == "exponential":
+    latency = rng.expovariate(1 / spec["mean"]) if spec.get("mean") else 0
+  else:
+    raise ValueError(f"Invalid latency distribution: {distribution}")
+  latency += spec.get("per-output-token", 0) * output_tokens
+  return max(0, latency)
+
+
+@lru_cache(maxsize=65536)
+def _word_vector(word, dimensions, seed):
+  rng = np.random.default_rng(seeded_rng(seed, word).getrandbits(64))
+  return rng.standard_normal(dimensions).astype(np.float32)
+
+
+def pseudo_embedding(text, dimensions=DEFAULT_EMBEDDINGS_DIMENSIONS, seed=0):
+  """
+  Returns the pseudo-embedding of <text>: the normalized sum of a fixed random
+  vector per word.
+  """
+  words = re.findall(r"\w+", text.lower()) or [text]
+  vector = np.zeros(dimensions, dtype=np.float32)
+  for word in words:
+    vector += _word_vector(word, dimensions, seed)
+  norm = np.linalg.norm(vector)
+  return vector / norm if norm else vector
+
+
+# ============================================================================
+# Structured outputs
+# ============================================================================
+
+def _resolve(schema, defs):
+  while "$ref" in schema:
+    schema = defs[schema["$ref"].split("/")[-1]]
+  return schema
+
+
+def generate_instance(schema, rng, defs=None, field=None):
+  """
+  Generates a value that validates against the JSON <schema>.
+
+  ARGS:
+    schema: a JSON schema, as sent in response_format by the OpenAI client.
+    rng: the random.Random the values are drawn with.
+    defs: the "$defs" of the root schema.
+    field: the name of the property the value is for, if any.
+  RETURNS:
+    the value.
+  """
+  defs = schema.get("$defs", defs or {})
+  schema = _resolve(schema, defs)
+  if "const" in schema:
+    return schema["const"]
+  if "enum" in schema:
+    return rng.choice(schema["enum"])
+  for key in ("anyOf", "oneOf"):
+    if key in schema:
+      options = [option for option in schema[key]
+                 if _resolve(option, defs).get("type") != "null"]
+      return generate_instance(rng.choice(options or schema[key]), rng, defs,
+                               field)
+
+  schema_type = schema.get("type", "object")
+  if isinstance(schema_type, list):
+    schema_type = next((t for t in schema_type if t != "null"), "null")
+  if schema_type == "object":
+    return {name: generate_instance(property_schema, rng, defs, name)
+            for name, property_schema in schema.get("properties", {}).items()}
+  if schema_type == "array":
+    low = schema.get("minItems", 2)
+    high = max(low, schema.get("maxItems", max(low, 4)))
+    return [generate_instance(schema.get("items", {}), rng, defs, field)
+            for _ in range(rng.randint(low, high))]
+  if schema_type == "integer":
+    low, high = INTEGER_RANGES.get(field, (1, 10))
+    return rng.randint(max(low, schema.get("minimum", low)),
+                       min(high, schema.get("maximum", high)))
+  if schema_type == "number":
+    return round(rng.uniform(schema.get("minimum", 0),
+                             schema.get("maximum", 1)), 3)
+  if schema_type == "boolean":
+    return rng.random() < 0.5
+  if schema_type == "null":
+    return None
+  if field == "emoji":
+    return rng.choice(EMOJIS)
+  return rng.choice(ACTIVITIES)
+
+
+def _last_options(prompt):
+  """Returns the options of the last "[a, b, c]" list in <prompt>."""
+  lists = re.findall(r"\[([^\[\]]+)\]", prompt)
+  if not lists:
+    return None
+  return [option.strip() for option in lists[-1].split(",") if option.strip()]
+
+
+def _split_minutes(total, rng):
+  """Splits <total> minutes into chunks of 10 to 60 minutes."""
+  chunks = []
+  while total > 0:
+    chunk = min(total, 5 * rng.randint(2, 12))
+    chunks += [chunk]
+    total -= chunk
+  return chunks
+
+
+def _pick_option(field):
+  def hint(prompt, rng):
+    options = _last_options(prompt)
+    return {field: rng.choice(options)} if options else None
+  return hint
+
+
+def _task_decomposition(prompt, rng):
+  durations = re.findall(r"total duration in minutes: (\d+)", prompt)
+  if not durations:
+    return None
+  minutes_left = int(durations[-1])
+  subtasks = []
+  for duration in _split_minutes(minutes_left, rng):
+    minutes_left -= duration
+    subtasks += [{"task": rng.choice(ACTIVITIES), "duration": duration,
+                  "minutes_left": minutes_left}]
+  return {"subtasks": subtasks}
+
+
+def _hourly_schedule(prompt, rng):
+  date = re.search(r'"datetime":"([^"]*), ', prompt)
+  date = date.group(1) if date else ""
+  wake_up_hour = rng.randint(5, 9)
+  schedule = []
+  activity = "sleeping"
+  for hour, hour_str in enumerate(HOUR_STRINGS):
+    if wake_up_hour <= hour < 23 and (hour == wake_up_hour
+                                      or rng.random() < 0.5):
+      activity = rng.choice(ACTIVITIES)
+    elif hour == 23:
+      activity = "sleeping"
+    schedule += [{"datetime": f"{date}, {hour_str}", "activity": activity}]
+  return {"hourly_schedule": schedule}
+
+
+def _new_schedule(prompt, rng):
+  time_range = re.search(r" originally planned schedule from (.+?) to (.+?):",
+                         prompt)
+  if not time_range:
+    return None
+  # Parsed the way the prompt template's validation parses it.
+  start, end = [datetime.datetime.strptime(time_str.strip(), "%H:%M %p")
+                for time_str in time_range.groups()]
+  total = int((end - start).total_seconds() / 60)
+  if total <= 0:
+    return None
+  main_task = rng.choice(ACTIVITIES)
+  schedule = []
+  for duration in _split_minutes(total, rng):
+    activity_end = start + datetime.timedelta(minutes=duration)
+    schedule += [{"start_time": start.strftime("%H:%M"),
+                  "end_time": activity_end.strftime("%H:%M"),
+                  "main_task": main_task,
+                  "subtask": rng.choice(ACTIVITIES)}]
+    start = activity_end
+  return {"schedule": schedule}
+
+
+def _insight_guidance(prompt, rng):
+  n_insights = re.search(r"What (\d+) high-level insights", prompt)
+  n_statements = len(re.findall(r"^\d+\. ", prompt, re.MULTILINE))
+  if not n_insights or not n_statements:
+    return None
+  return {"insights": [
+    {"insight": rng.choice(ACTIVITIES),
+     "because_of": rng.sample(range(n_statements), min(3, n_statements))}
+    for _ in range(int(n_insights.group(1)))
+  ]}
+
+
+def _poignancy_list(prompt, rng):
+  n_events = re.search(r"each of the following (\d+) events", prompt)
+  if not n_events:
+    return None
+  low, high = INTEGER_RANGES["poignancy"]
+  return {"poignancies": [rng.randint(low, high)
+                          for _ in range(int(n_events.group(1)))]}
+
+
+# Values taken from the prompt, by the name of the response format model. A
+# hint returns None when the prompt does not have what it looks for, and the
+# value is then generated from the schema alone.
+STRUCTURED_HINTS = {
+  "ActionLoc": _pick_option("area"),
+  "GameObject": _pick_option("object"),
+  "TaskDecomposition": _task_decomposition,
+  "HourlySchedule": _hourly_schedule,
+  "NewSchedule": _new_schedule,
+  "InsightGuidance": _insight_guidance,
+  "PoignancyList": _poignancy_list,
+}
+
+
+def structured_output(name, schema, prompt, rng):
+  """
+  Returns the structured output for the response format <name> with JSON
+  <schema>, given the <prompt>.
+  """
+  hint = STRUCTURED_HINTS.get(name)
+  if hint:
+    value = hint(prompt, rng)
+    if value is not None:
+      return value
+  return generate_instance(schema, rng)
+
+
+# ============================================================================
+# Server
+# ============================================================================
+
+class StubError(Exception):
+  def __init__(self, status, message):
+    super().__init__(message)
+    self.status = status
+
+
+class StubLLM:
+  def __init__(self, config=None):
+    """
+    The responses and the simulated latency and errors of the stub server.
+
+    ARGS:
+      config: the "stub-server" section of openai_config.json.
+    """
+    self.config = config or {}
+    self.seed = self.config.get("seed", 0)
+    self.dimensions = self.config.get("embeddings-dimensions",
+                                      DEFAULT_EMBEDDINGS_DIMENSIONS)
+    self.max_in_flight = self.config.get("max-in-flight", 0)
+    # Latency and errors are drawn independently of the request, so that they
+    # follow their distributions however often a prompt repeats.
+    self.rng = random.Random(self.seed)
+    self.lock = threading.Lock()
+    self.in_flight = 0
+    self.stats = {"requests": 0, "errors": 0, "rejected": 0,
+                  "chat_completions": 0, "completions": 0, "embeddings": 0,
+                  "embedding_inputs": 0, "prompt_tokens": 0,
+                  "completion_tokens": 0, "response_formats": dict()}
+
+  def _count(self, **counters):
+    with self.lock:
+      for counter, value in counters.items():
+        self.stats[counter] += value
+
+  def enter(self):
+    """Admits a request, or raises StubError if it is to fail."""
+    with self.lock:
+      self.stats["requests"] += 1
+      if self.max_in_flight and self.in_flight >= self.max_in_flight:
+        self.stats["rejected"] += 1
+        raise StubError(429, "Too many requests in flight")
+      if self.rng.random() < self.config.get("error-rate", 0):
+        self.stats["errors"] += 1
+        raise StubError(self.rng.choice(self.config.get("error-status", [500])),
+                        "Simulated error")
+      self.in_flight += 1
+
+  def leave(self):
+    with self.lock:
+      self.in_flight -= 1
+
+  def _sleep(self, latency_key, output_tokens):
+    with self.lock:
+      latency = sample_latency(self.config.get(latency_key), self.rng,
+                               output_tokens)
+    time.sleep(latency)
+
+  def chat_completion(self, body):
+    messages = body.get("messages", [])
+    prompt = "\n".join(str(message.get("content", "")) for message in messages)
+    rng = seeded_rng(self.seed, body.get("model"), prompt,
+                     body.get("response_format"))
+
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+      json_schema = response_format["json_schema"]
+      name = json_schema.get("name", "")
+      with self.lock:
+        formats = self.stats["response_formats"]
+        formats[name] = formats.get(name, 0) + 1
+      content = json.dumps(structured_output(
+        name, json_schema.get("schema", {}), prompt, rng
+      ))
+    elif response_format.get("type") == "json_object":
+      content = json.dumps({"output": rng.choice(ACTIVITIES)})
+    else:
+      content = f"{rng.choice(ACTIVITIES).capitalize()}."
+
+    usage = self._usage(prompt, content)
+    self._count(chat_completions=1)
+    self._sleep("latency", usage["completion_tokens"])
+    return {
+      "id": f"chatcmpl-stub-{uuid.uuid4().hex}",
+      "object": "chat.completion",
+      "created": int(time.time()),
+      "model": body.get("model", "stub"),
+      "choices": [{
+        "index": 0,
+        "message": {"role": "assistant", "content": content, "refusal": None},
+        "logprobs": None,
+        "finish_reason": "stop",
+      }],
+      "usage": usage,
+    }
+
+  def completion(self, body):
+    prompt = body.get("prompt", "")
+    if isinstance(prompt, list):
+      prompt = "\n".join(str(part) for part in prompt)
+    rng = seeded_rng(self.seed, body.get("model"), prompt)
+    text = f" {rng.choice(ACTIVITIES)}"
+
+    usage = self._usage(prompt, text)
+    self._count(completions=1)
+    self._sleep("latency", usage["completion_tokens"])
+    return {
+      "id": f"cmpl-stub-{uuid.uuid4().hex}",
+      "object": "text_completion",
+      "created": int(time.time()),
+      "model": body.get("model", "stub"),
+      "choices": [{"index": 0, "text": text, "logprobs": None,
+                   "finish_reason": "stop"}],
+      "usage": usage,
+    }
+
+  def embeddings(self, body):
+    texts = body.get("input", [])
+    if isinstance(texts, str) or (texts and isinstance(texts[0], int)):
+      texts = [texts]
+    texts = [text if isinstance(text, str) else " ".join(map(str, text))
+             for text in texts]
+    dimensions = body.get("dimensions") or self.dimensions
+
+    data = []
+    for index, text in enumerate(texts):
+      embedding = pseudo_embedding(text, dimensions, self.seed)
+      if body.get("encoding_format") == "base64":
+        embedding = base64.b64encode(embedding.tobytes()).decode("ascii")
+      else:
+        embedding = embedding.tolist()
+      data += [{"object": "embedding", "index": index, "embedding": embedding}]
+
+    prompt_tokens = sum(count_tokens(text) for text in texts)
+    self._count(embeddings=1, embedding_inputs=len(texts),
+                prompt_tokens=prompt_tokens)
+    self._sleep("embeddings-latency", 0)
+    return {
+      "object": "list",
+      "data": data,
+      "model": body.get("model", "stub"),
+      "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+
+  def _usage(self, prompt, content):
+    prompt_tokens = count_tokens(prompt)
+    completion_tokens = count_tokens(content)
+    self._count(prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens)
+    return {"prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+  def get_stats(self):
+    with self.lock:
+      return json.loads(json.dumps(self.stats))
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+  # Keep-alive, like the API, so the clients' connection pools are exercised.
+  protocol_version = "HTTP/1.1"
+
+  ROUTES = {
+    "/chat/completions": "chat_completion",
+    "/completions": "completion",
+    "/embeddings": "embeddings",
+  }
+
+  def _send_json(self, status, payload):
+    data = json.dumps(payload).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _send_error(self, status, message):
+    self._send_json(status, {"error": {
+      "message": message, "type": "stub_error", "param": None, "code": status,
+    }})
+
+  def do_GET(self):
+    path = self.path.split("?")[0].rstrip("/")
+    if path == "/stats":
+      self._send_json(200, self.server.stub.get_stats())
+    elif path.endswith("/models"):
+      self._send_json(200, {"object": "list", "data": [
+        {"id": "stub", "object": "model", "created": 0, "owned_by": "stub"}
+      ]})
+    else:
+      self._send_error(404, f"Unknown path: {self.path}")
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length", 0))
+    try:
+      body = json.loads(self.rfile.read(length) or b"{}")
+    except ValueError:
+      self._send_error(400, "Invalid JSON body")
+      return
+
+    path = self.path.split("?")[0].rstrip("/")
+    route = next((method for suffix, method in self.ROUTES.items()
+                  if path.endswith(suffix)), None)
+    if not route:
+      self._send_error(404, f"Unknown path: {self.path}")
+      return
+
+    stub = self.server.stub
+    try:
+      stub.enter()
+    except StubError as e:
+      self._send_error(e.status, str(e))
+      return
+    try:
+      payload = getattr(stub, route)(body)
+    except Exception as e:
+      self._send_error(500, f"Stub failed: {e}")
+      return
+    finally:
+      stub.leave()
+    self._send_json(200, payload)
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      super().log_message(format, *args)
+
+
+def make_server(config=None, host=None, port=None, verbose=False):
+  """
+  Creates the stub server; call serve_forever() on it to serve.
+
+  ARGS:
+    config: the "stub-server" section of openai_config.json.
+    host, port: override the host and port of <config>; port 0 picks a free
+                port (see server.server_address).
+    verbose: whether to log every request.
+  RETURNS:
+    a ThreadingHTTPServer.
+  """
+  config = config or {}
+  host = host if host is not None else config.get("host", DEFAULT_HOST)
+  port = port if port is not None else config.get("port", DEFAULT_PORT)
+  server = ThreadingHTTPServer((host, port), StubRequestHandler)
+  server.daemon_threads = True
+  server.stub = StubLLM(config)
+  server.verbose = verbose
+  return server
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Offline stub OpenAI server")
+  parser.add_argument("--config", default="../../openai_config.json",
+                      help="openai_config.json with a \"stub-server\" section")
+  parser.add_argument("--host", default=None)
+  parser.add_argument("--port", type=int, default=None)
+  parser.add_argument("--verbose", action="store_true",
+                      help="log every request")
+  args = parser.parse_args()
+
+  try:
+    with open(args.config) as f:
+      config = json.load(f).get("stub-server", {})
+  except FileNotFoundError:
+    config = {}
+  server = make_server(config, args.host, args.port, args.verbose)
+  host, port = server.server_address[:2]
+  print(f"Stub LLM server listening on http://{host}:{port}/v1", flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+if __name__ == "__main__":
+  main()
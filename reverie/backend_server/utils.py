@@ -9,6 +9,8 @@ env_visuals = f"{maze_assets_loc}/the_ville/visuals"
 
 fs_storage = "../../environment/frontend_server/storage"
 fs_temp_storage = "../../environment/frontend_server/temp_storage"
+# Per-map caches derived from the maze files (e.g., path distance fields).
+maze_cache = "../../environment/frontend_server/maze_cache"
 
 collision_block_id = "32125"
 
@@ -22,3 +24,43 @@ mqtt_port = "1883"
 mqtt_client_id = "reverie_backend"
 mqtt_movement_topic = "backend/movement"
 mqtt_environment_topic = "gateway/environment"
+
+# How the server waits for the environment of the next step: "auto", "queue"
+# (in-process handoff, only for MQTT and headless runs), "inotify" or "poll"
+# (for environment files written by the frontend). See environment_source.py.
+environment_wait = "auto"
+# Headless runs hand the environment of each step straight to the next one,
+# and only write environment/{step}.json every headless_environment_stride
+# steps (0: only when the simulation is saved).
+headless_environment_stride = 0
+
+# Number of personas whose cognitive sequence runs at the same time during a
+# step. 1 keeps the original one-after-another stepping.
+persona_workers = 1
+# Threads, shared by all personas, for the LLM calls of a new action that do
+# not depend on each other (e.g., its emoji and its event triple run while its
+# location is picked). 0 or 1 makes the calls one after another.
+action_fanout_workers = 16
+
+# Write-ahead journal for the personas' associative memory. When enabled, new
+# memory nodes are appended to a journal as they are created, and saving only
+# rewrites the full memory files once the journal exceeds
+# memory_journal_compact_size bytes.
+memory_journal = False
+memory_journal_compact_size = 32 * 1024 * 1024
+
+# Append the personas' movements of each step to the simulation's movement log
+# (movement_log/, see movement_log.py) instead of writing a
+# movement/{step}.json file per step.
+movement_log = True
+
+# How a new simulation carries over the history (movements and environments of
+# past steps) of the simulation it forks from: "copy" copies everything,
+# "link" hardlinks the history, and "lineage" only refers to the forked-from
+# simulation, which then has to be kept. See sim_fork.py.
+fork_mode = "link"
+
+# Record the time, LLM calls and tokens of each phase of every step to
+# profile.jsonl in the simulation folder (see profiler.py). Profiling can also
+# be turned on and off with the "profile on"/"profile off" commands.
+profile_steps = False
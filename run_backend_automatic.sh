@@ -69,6 +69,10 @@ while [[ $# -gt 0 ]]; do
             echo "(${FILE_NAME}): MQTT mode enabled"
             shift
             ;;
+        --workers|-w)
+            ARGS="${ARGS} --workers ${2}"
+            shift 2
+            ;;
         *)
             echo "Unknown argument: $1"
             exit 1
@@ -1,5 +1,6 @@
 import os
 import re
+import sys
 import shutil
 import argparse
 from collections import defaultdict
@@ -9,6 +10,10 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 # Get the project root directory (parent of utils)
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 
+sys.path.append(os.path.join(PROJECT_ROOT, "reverie", "backend_server"))
+from movement_log import movement_steps
+from sim_fork import read_lineage
+
 
 def parse_sim_name(folder_name):
   # Extract the base name and the s-number
@@ -19,19 +24,7 @@ def parse_sim_name(folder_name):
 
 
 def get_movement_steps_range(folder_path):
-  movement_dir = os.path.join(folder_path, "movement")
-  if not os.path.exists(movement_dir):
-    return None
-
-  step_files = []
-  for file in os.listdir(movement_dir):
-    if file.endswith(".json"):
-      try:
-        step_num = int(file.split(".")[0])
-        step_files.append(step_num)
-      except ValueError:
-        continue
-
+  step_files = movement_steps(folder_path)
   if not step_files:
     return None
 
@@ -81,11 +74,17 @@ def cleanup_simulation_folders(directory, dry_run=True, interactive=True):
     )
     latest_folder_path = os.path.join(directory, latest_folder)
 
+    # Folders that the latest folder was forked from by lineage still hold
+    # part of its history, so they are kept as well.
+    ancestors = set(
+      os.path.basename(folder) for folder, _ in read_lineage(latest_folder_path)[1:]
+    )
+
     # Print all folders for this simulation name
     print(f"\nSimulation: {base_name}")
     print("Available folders:")
     for s_num, folder_name in sorted(folders, key=lambda x: x[0]):
-      status = "KEEP" if s_num == max_s_num else "DELETE"
+      status = "KEEP" if s_num == max_s_num or folder_name in ancestors else "DELETE"
       print(f"  {status}: {folder_name}")
 
     # Get movement steps range for the latest folder
@@ -102,7 +101,8 @@ def cleanup_simulation_folders(directory, dry_run=True, interactive=True):
 
     # Get folders to delete
     folders_to_delete = [
-      (s_num, folder_name) for s_num, folder_name in folders if s_num < max_s_num
+      (s_num, folder_name) for s_num, folder_name in folders
+      if s_num < max_s_num and folder_name not in ancestors
     ]
 
     if not folders_to_delete:
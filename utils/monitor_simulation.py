@@ -1,32 +1,33 @@
 import os
+import sys
 import time
 import json
-import glob
 
 # Get the absolute path to the script's directory
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 # Get the project root directory (parent of utils)
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 
+sys.path.append(os.path.join(PROJECT_ROOT, "reverie", "backend_server"))
+from movement_log import movement_steps, read_movement
+
 frontend_path = os.path.join(PROJECT_ROOT, "environment", "frontend_server")
-last_file = None
+last_step = None
 
 while True:
   with open(f"{frontend_path}/temp_storage/curr_sim_code.json", "r") as f:
     data = json.load(f)
     curr_sim_code = data["sim_code"]
 
-  movement_path = f"{frontend_path}/storage/{curr_sim_code}/movement"
-  path_length = len(movement_path) + 1
-  list_of_files = glob.glob(f"{movement_path}/*.json")
-  latest_file = sorted(list_of_files, key=lambda s: int(s[path_length:-5]))[-1]
+  sim_folder = f"{frontend_path}/storage/{curr_sim_code}"
+  steps = movement_steps(sim_folder)
+  latest_step = (curr_sim_code, steps[-1]) if steps else None
 
-  if latest_file != last_file:
+  if latest_step and latest_step != last_step:
     os.system("clear")
-    with open(latest_file, "r") as f:
-      print(f.read())
-      print(latest_file)
+    print(json.dumps(read_movement(sim_folder, steps[-1]), indent=2))
+    print(f"{sim_folder} step {steps[-1]}")
 
-    last_file = latest_file
+    last_step = latest_step
 
   time.sleep(0.2)
@@ -1,5 +1,4 @@
 import os
-import json
 import re
 import sys
 
@@ -8,57 +7,43 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 # Get the project root directory (parent of utils)
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 
+sys.path.append(os.path.join(PROJECT_ROOT, "reverie", "backend_server"))
+from movement_log import read_movements
+
 
 def get_unique_conversations(simulation_name):
   sim_folder = os.path.join(PROJECT_ROOT, "environment", "frontend_server", "storage")
   regex_name = re.compile(re.escape(simulation_name + "-"))
 
   for file_name in os.listdir(sim_folder):
-    step = 0
     output = []
 
     if regex_name.search(file_name):
-      step_folder = os.path.join(sim_folder, file_name, "movement")
-      files = [filename for filename in os.listdir(step_folder)]
-      files = sorted(files, key=lambda files: int(files[:-5]))
+      movements = read_movements(os.path.join(sim_folder, file_name))
 
-      for filename in files:
-        filepath = os.path.join(step_folder, filename)
+      for step, data in movements:
         output.append(f"Step {str(step)}:")
 
-        try:
-          with open(filepath, "r") as file:
-            data = json.load(file)
-
-            for k, v in data.items():
-              output.append(k)
-
-              if k == "persona":
-                for key, value in v.items():
-                  output.append(f"   {key}")
-
-                  for attribute, val in value.items():
-                    if attribute != "chat" or (attribute == "chat" and val is None):
-                      output.append(f"      {attribute}: {val}")
-                    else:
-                      output.append(f"      {attribute}:")
-
-                      for convo in val:
-                        output.append(f"         {convo[0]}: {convo[1]}")
-              else:
-                for key, value in v.items():
-                  output.append(f"   {key}: {value}")
+        for k, v in data.items():
+          output.append(k)
 
-              output.append("\n")
+          if k == "persona":
+            for key, value in v.items():
+              output.append(f"   {key}")
 
-        except json.JSONDecodeError:
-          continue
+              for attribute, val in value.items():
+                if attribute != "chat" or (attribute == "chat" and val is None):
+                  output.append(f"      {attribute}: {val}")
+                else:
+                  output.append(f"      {attribute}:")
 
-        except Exception as e:
-          print(f"Error processing file {filename}: {e}")
-          continue
+                  for convo in val:
+                    output.append(f"         {convo[0]}: {convo[1]}")
+          else:
+            for key, value in v.items():
+              output.append(f"   {key}: {value}")
 
-        step += 1
+          output.append("\n")
 
       output_filename = os.path.join(
         sim_folder,
@@ -8,21 +8,23 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 # Get the project root directory (parent of utils)
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 
+sys.path.append(os.path.join(PROJECT_ROOT, "reverie", "backend_server"))
+from movement_log import read_movements
+
 
 def get_unique_conversations(simulation_name):
   step_folder = os.path.join(PROJECT_ROOT, "environment", "frontend_server", "storage")
 
-  # Use glob to find all files that start with the simulation_name
-  search_pattern = os.path.join(step_folder, f"{simulation_name}*/movement/*")
-  filepaths = glob.glob(search_pattern)
+  # Find all the simulation folders that start with the simulation_name
+  search_pattern = os.path.join(step_folder, f"{simulation_name}*")
+  sim_folders = sorted(glob.glob(search_pattern))
 
   observed_conversations = set()
   file_contents = []
 
-  # Iterate over all matching files
-  for filepath in filepaths:
-    with open(filepath, "r") as file:
-      data = json.load(file)
+  # Iterate over the movements of every step of the matching simulations
+  for sim_folder in sim_folders:
+    for _, data in read_movements(sim_folder):
       personas = data.get("persona", {})
 
       # Loop over all personas except one, since conversations are always